@@ -40,10 +40,13 @@ import os.path,os
 import pyflag.DB as DB
 import pyflag.Farm as Farm
 import pyflag.Scanner as Scanner
+import pyflag.CacheManager as CacheManager
 import pyflag.pyflaglog as pyflaglog
 import os
 import pyflag.FlagFramework as FlagFramework
 import pyflag.Registry as Registry
+import pyflag.format as format
+import cStringIO
 from pyflag.ColumnTypes import StringType, TimestampType, InodeIDType, FilenameType, IntegerType, DeletedType, SetType, BigIntegerType
 
 config.add_option("SCHEMA_VERSION", default=3, absolute=True,
@@ -200,6 +203,48 @@ class OffsetFile(FileSystem.File):
 
         result.row("Offset",extract)
 
+class RunFile(FileSystem.File):
+    """ A file made up of runs of our parent Inode.
+
+    This is used for fragmented files found by the carvers. The inode
+    name is the id of our binary run map (see format.RunMap.save()) in
+    the runs table.
+    """
+    specifier = 'R'
+    def __init__(self, case, fd, inode):
+        FileSystem.File.__init__(self, case, fd, inode)
+
+        dbh = DB.DBO(case)
+        dbh.execute("select runs from runs where id=%r", inode.split('|')[-1][1:])
+        row = dbh.fetch()
+        if not row:
+            raise IOError("No runs found for %s" % inode)
+
+        self.runs = format.RunMap(fd)
+        self.runs.load(cStringIO.StringIO(row['runs']))
+        self.size = self.runs.size()
+
+    def read(self, length=None):
+        try:
+            return FileSystem.File.read(self,length)
+        except IOError:
+            pass
+
+        available = self.size - self.readptr
+        if length==None or length > available:
+            length = available
+
+        self.runs.seek(self.readptr)
+        result = self.runs.read(length)
+        self.readptr += len(result)
+        return result
+
+    def explain(self, query, result):
+        self.fd.explain(query,result)
+
+        result.row("Runs", "Extract %s bytes from %s runs starting at byte %s" % (
+            self.size, len(self.runs.starts), self.runs.offsets[0]))
+
 class Help(Reports.report):
     """ This facility displays helpful messages """
     hidden = True
@@ -252,6 +297,36 @@ class OffsetFileTests(tests.FDTest):
         self.assertEqual(data2, data)
         self.assertEqual(fd2.tell(), 2000)
 
+class RunFileTests(unittest.TestCase):
+    """ Testing RunFile handling """
+    test_case = "PyFlagNTFSTestCase"
+    test_inode = "Itest|K33-128-4"
+
+    def test01AddRuns(self):
+        """ Test reading back a fragmented file added by a carver """
+        fsfd = DBFS(self.test_case)
+        fd = fsfd.open(inode=self.test_inode)
+        data = fd.read()
+
+        ## More runs than would fit into the inode column as text:
+        runs = [ (offset, 50) for offset in range(2900, -1, -100) ]
+        expected = ''.join([ data[o:o+l] for o,l in runs ])
+        carver = Scanner.Carver(fsfd)
+        self.assertEqual(carver.add_runs(fd, runs, "fragmented.jpg", []), len(expected))
+
+        dbh = DB.DBO(self.test_case)
+        dbh.execute("select inode from file where name='fragmented.jpg' order by inode_id desc limit 1")
+        inode = dbh.fetch()['inode']
+        self.assert_(inode.startswith(self.test_inode + "|R"))
+
+        fd = fsfd.open(inode=inode)
+        self.assertEqual(fd.size, len(expected))
+        self.assertEqual(fd.read(), expected)
+
+        ## Reads across the runs:
+        fd.seek(75)
+        self.assertEqual(fd.read(100), expected[75:175])
+
 config.add_option("PERIOD", default=60, type='int',
                   help="Run house keeping every this many seconds")
 
@@ -280,7 +355,11 @@ class Periodic(Farm.Task):
 
     def run(self, *args):
         pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Running Housekeeping tasks on %s" % time.ctime())
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "File descriptor pool: %(open)s open, %(hits)s hits, %(misses)s misses, %(evictions)s evictions" % IO.FD_POOL.stats())
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Scanner memory: %(usage)s MB used, %(peak)s MB peak, %(skipped)s files over budget queued for scanning (recently %(skipped_inodes)s)" % Scanner.MEMORY_BUDGET.stats())
         try:
+            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Job queue: %(jobs)s pending jobs, %(high_priority_jobs)s pending high priority jobs" % Farm.queue_depth())
+            Farm.requeue_expired_jobs()
             FlagFramework.post_event('periodic', None)
         finally:
             self.schedule()
@@ -289,7 +368,7 @@ class Exit(Farm.Task):
     """ A task to force the worker to exit """
     def run(self, case, *args):
         pyflaglog.log(pyflaglog.INFO, "Exiting Worker due to broadcast")
-        os._exit(0)
+        Farm.flush_and_exit(0)
         
 class Scan(Farm.Task):
     """ A task to distribute scanning among all workers """
@@ -302,6 +381,20 @@ class Scan(Farm.Task):
             Scanner.scanfile(ddfs, fd, factories)
             fd.close()
 
+    def prefetch(self, rows):
+        ## Fetch the scanner_cache of all the inodes in one query per case:
+        inodes = {}
+        for row in rows:
+            inodes.setdefault(row['arg1'], []).append(row['arg2'])
+
+        for case, inodes in inodes.items():
+            Scanner.SCANNER_CACHE.prefetch(case, inodes)
+
+    def flush(self):
+        Scanner.SCANNER_CACHE.flush()
+        CacheManager.MANAGER.flush()
+        Scanner.SCANNER_STATISTICS.flush()
+
 class DropCase(Farm.Task):
     """ This class is responsible for cleaning up cached data
     structures related to the case
@@ -384,6 +477,11 @@ class CaseDBInit(FlagFramework.EventHandler):
         `inode` VARCHAR(250) NOT NULL,
         `data` TEXT)""")
 
+        ## Run maps of fragmented carved files (see RunFile):
+        case_dbh.execute("""CREATE TABLE IF NOT EXISTS runs (
+        `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        `runs` MEDIUMBLOB NOT NULL)""")
+
         case_dbh.execute("""CREATE TABLE IF NOT EXISTS `filesystems` (
         `iosource` VARCHAR( 50 ) NOT NULL ,
         `property` VARCHAR( 50 ) NOT NULL ,
@@ -433,6 +531,11 @@ class CaseDBInit(FlagFramework.EventHandler):
         priority int default 10,
         when_valid TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL,
 	`cookie` INT(11) not null,
+        pid int default 0,
+        claim varchar(100) default NULL,
+        cost bigint default 0,
+        lease int unsigned default 0,
+        attempts int default 0,
 	key `id`(id)
 	)""")
 
@@ -488,6 +591,27 @@ class CaseDBInit(FlagFramework.EventHandler):
             dbh.execute("select * from high_priority_jobs limit 1")
         except:
             dbh.execute("create table if not exists high_priority_jobs like jobs")
+
+        ## Claiming workers mark their jobs with a claim token:
+        for table in ('jobs', 'high_priority_jobs'):
+            DB.check_column_in_table(None, table, 'claim', 'varchar(100) default NULL')
+            dbh.check_index(table, 'claim')
+            DB.check_column_in_table(None, table, 'cost', 'bigint default 0')
+            DB.check_column_in_table(None, table, 'lease', 'int unsigned default 0')
+            DB.check_column_in_table(None, table, 'attempts', 'int default 0')
+
+        ## Jobs which repeatedly killed their workers end up here:
+        dbh.execute("""create table if not exists quarantined_jobs (
+        `id` int unsigned auto_increment,
+        `time` timestamp,
+        command varchar(250),
+        arg1 text,
+        arg2 text,
+        arg3 text,
+        `cookie` INT(11) not null,
+        attempts int default 0,
+        key `id`(id)
+        )""")
         
         ## Schedule the first periodic task:
         task = Periodic()
@@ -505,6 +629,8 @@ class CaseDBInit(FlagFramework.EventHandler):
         DB.DBO.DBH.expire(key_re)
         DB.DBIndex_Cache.expire(key_re)
         Scanner.factories.expire(key_re)
+        CacheManager.MANAGER.reset(case)
+        FileSystem.BLOCK_CACHE.expire(case)
 
 
 class FileTable(FlagFramework.CaseTable):
@@ -550,6 +676,16 @@ class InodeTable(FlagFramework.CaseTable):
                                           ],
                                         ]
 
+class ScanCheckpointTable(FlagFramework.CaseTable):
+    """ Progress of interrupted large file scans (see Scanner.scan_large_file) """
+    name = 'scan_checkpoint'
+    primary = 'inode_id'
+    columns = [ [ InodeIDType, {} ],
+                [ StringType, dict(name = 'Scanners', column = 'scanners', width=1000)],
+                [ BigIntegerType, dict(name = 'Offset', column = 'offset')],
+                ]
+    modes = {}
+
 class CaseConfiguration(Reports.report):
     """
     Case Configuration
@@ -613,6 +749,8 @@ class PyFlagStatistics(Reports.report):
         row = dbh.fetch()
         result.row("Version", config.VERSION)
         result.row("Outstanding jobs", row['count'])
+        dbh.execute("select count(*) as count from quarantined_jobs")
+        result.row("Quarantined jobs", dbh.fetch()['count'])
 
         cdbh = DB.DBO(query['case'])
         cdbh.execute("select count(*) as count from inode")
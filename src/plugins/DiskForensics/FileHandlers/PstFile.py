@@ -46,13 +46,15 @@ class PstScan(Scanner.GenScanFactory):
         group = "FileScanners"
         default = True
 
-    class Scan(Scanner.StoreAndScanType):
+    class Scan(Scanner.StreamScanType):
         types = (
             'application/x-msoutlook',
             )
         
         def external_process(self,fd):
-            """ This is run on the extracted file """
+            """ readpst needs a real file so we have the cache
+            manager write one out (it streams from the VFS).
+            """
             filename = CacheManager.MANAGER.provide_cache_filename(self.case, self.fd.inode)
 
             dirname = filename+"_"
@@ -78,7 +80,7 @@ class PstScan(Scanner.GenScanFactory):
 
                 ## Scan the inbox:
                 fd = self.ddfs.open(inode_id = new_inode_id)
-                Scanner.scanfile(self.ddfs, fd, self.factories)
+                Scanner.scan_child(self.ddfs, fd, self.factories)
 
 
 class PstScannerTest(pyflag.tests.ScannerTest):
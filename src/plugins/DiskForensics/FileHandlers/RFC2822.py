@@ -101,7 +101,7 @@ class RFC2822(Scanner.GenScanFactory):
         Scanner.GenScanFactory.__init__(self,fsfd)
         dbh=DB.DBO(self.case)
 
-    class Scan(Scanner.StoreAndScanType):
+    class Scan(Scanner.StreamScanType):
         types = [ 'message/rfc2822', 'message/x-application-mbox' ]
 
         def external_process(self, fd):
@@ -111,28 +111,42 @@ class RFC2822(Scanner.GenScanFactory):
                 self.process_mbox(fd)
 
         def process_mbox(self, fd):
-            """ This is borrowed from python's mailbox module """
+            """ This is borrowed from python's mailbox module. Each
+            message is processed as soon as we find its end so we
+            never hold more than one message at a time.
+            """
             path, inode, inode_id = self.ddfs.lookup(inode = fd.inode)
             
-            starts, stops = [], []
+            start = None
+            count = 0
             while True:
                 line_pos = fd.tell()
                 line = fd.readline()
                 if line.startswith('From '):
-                    if len(stops) < len(starts):
-                        stops.append(line_pos - len(os.linesep))
-                    starts.append(line_pos)
+                    stop = line_pos - len(os.linesep)
                 elif line == '':
-                    stops.append(line_pos)
-                    break
-                
-            for i in range(len(starts)):
-                new_inode = "o%s:%s" % (starts[i], stops[i] - starts[i])
-                new_inode_id = self.ddfs.VFSCreate(inode, new_inode,
-                                                   "Msg %s" % i)
-                
-                tmpfd = self.ddfs.open(inode_id = new_inode_id)
-                self.process_message(tmpfd)
+                    stop = line_pos
+                else:
+                    continue
+
+                if start is not None:
+                    next_pos = fd.tell()
+                    self.add_message(inode, count, start, stop)
+                    count += 1
+
+                    ## Processing the message may move the file pointer:
+                    fd.seek(next_pos)
+
+                if not line: break
+                start = line_pos
+
+        def add_message(self, inode, count, start, stop):
+            new_inode = "o%s:%s" % (start, stop - start)
+            new_inode_id = self.ddfs.VFSCreate(inode, new_inode,
+                                               "Msg %s" % count)
+
+            tmpfd = self.ddfs.open(inode_id = new_inode_id)
+            self.process_message(tmpfd)
                                        
         def process_message(self, fd):
             count = 0
@@ -193,7 +207,7 @@ class RFC2822(Scanner.GenScanFactory):
 
                     ## Now call the scanners on new file:
                     new_fd = self.ddfs.open(inode_id=new_inode_id)
-                    Scanner.scanfile(self.ddfs,new_fd,self.factories)
+                    Scanner.scan_child(self.ddfs,new_fd,self.factories)
                     new_fd.close()
 
                     count+=1
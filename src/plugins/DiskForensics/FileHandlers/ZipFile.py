@@ -43,6 +43,9 @@ import plugins.DiskForensics.DiskForensics as DiskForensics
 import pyflag.Store as Store
 import FileFormats.Zip as Zip
 import pyflag.Time as Time
+import bisect
+import pyflag.conf
+config=pyflag.conf.ConfObject()
 
 class ZipScan(GenScanFactory):
     """ Recurse into Zip Files """
@@ -54,15 +57,17 @@ class ZipScan(GenScanFactory):
     def destroy(self):
         pass
     
-    class Scan(StoreAndScanType):
+    class Scan(StreamScanType):
         types = (
             'application/(x-)?zip',
             )
 
         def external_process(self,fd):
-            """ This is run on the extracted file """
+            """ This is run on the zip file itself - zipfile only reads
+            the central directory, and the members are read straight
+            from the zip file when they are scanned.
+            """
             pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Decompressing Zip File %s" % fd.inode)
-            cache_key = "%s:%s" % (self.case , self.fd.inode)
 
             ## Try to read the fd as a zip file
             z = zipfile.ZipFile(fd)
@@ -74,34 +79,27 @@ class ZipScan(GenScanFactory):
             evidence_tz = Time.get_evidence_tz_name(self.case, self.fd)
             
             ## List all the files in the zip file:
-            dircount = 0
-            inodes = []
-            namelist = z.namelist()
-            for i in range(len(namelist)):
+            for info in z.infolist():
                 ## Add the file into the VFS
                 try:
                     ## Convert the time to case timezone
-                    t = Time.convert(z.infolist()[i].date_time, case=self.case, evidence_tz=evidence_tz)
+                    t = Time.convert(info.date_time, case=self.case, evidence_tz=evidence_tz)
                 except:
                     t=0
 
                 ## If the entry corresponds to just a directory we ignore it.
-                if not posixpath.basename(namelist[i]): continue
+                if not posixpath.basename(info.filename): continue
 
-                info = z.infolist()[i]
                 inode = "%s|Z%s:%s" % (self.inode,info.header_offset, info.compress_size)
-                inodes.append(inode)
-                
                 inode_id = self.ddfs.VFSCreate(None,
-                                               inode,DB.expand("%s/%s",(pathname,namelist[i])),
+                                               inode,DB.expand("%s/%s",(pathname,info.filename)),
                                                size=info.file_size,
                                                mtime=t, _fast=True)
                 
-            for inode in inodes:
                 ## Now call the scanners on this new file (FIXME limit
                 ## the recursion level here)
-                fd = self.ddfs.open(inode_id = inode_id)
-                Scanner.scanfile(self.ddfs,fd,self.factories)
+                child = self.ddfs.open(inode_id = inode_id)
+                Scanner.scan_child(self.ddfs,child,self.factories)
 
 class GZScan(ZipScan):
     """ Decompress Gzip files """
@@ -155,7 +153,7 @@ class GZScan(ZipScan):
                 new_inode="%s|G0" % (self.inode)
                 ## Scan the new file using the scanner train:
                 fd=self.ddfs.open(inode=new_inode)
-                Scanner.scanfile(self.ddfs,fd,self.factories)
+                Scanner.scan_child(self.ddfs,fd,self.factories)
 
 class TarScan(GenScanFactory):
     """ Recurse into Tar Files """
@@ -167,66 +165,357 @@ class TarScan(GenScanFactory):
     def destroy(self):
         pass
     
-    class Scan(StoreAndScanType):
+    class Scan(StreamScanType):
         types = (
             'application/x-tar',
             )
 
         def external_process(self,fd):
-            """ This is run on the extracted file """
-            #Get a TarFile object - We must access a complete file
-            #here
-            fd.cache()
+            """ This is run on the tar file itself. We walk the member
+            headers (seeking over their data) and scan each member as
+            we find it.
+            """
             tar=tarfile.TarFile(fileobj=fd)
             
-            ## List all the files in the tar file:
-            inodes = []
-            dircount = 0
-            namelist = tar.getnames()
-            for i in range(len(namelist)):
+            while 1:
+                member = tar.next()
+                if member is None: break
 
-                ## If the entry corresponds to just a directory we ignore it.
-                if not os.path.basename(namelist[i]): continue
+                ## We do not need to remember the members we have
+                ## already seen:
+                tar.members = []
+
+                ## Directories, links etc have no data:
+                if not member.isreg() or not os.path.basename(member.name): continue
                 
-                ## Add the file into the VFS
+                ## Add the file into the VFS. Members are found by the
+                ## offset and size of their data:
+                part = "T%s:%s" % (member.offset_data, member.size)
                 self.ddfs.VFSCreate(
-                    self.inode,"T%s" % i,namelist[i],
-                    size=tar.getmember(namelist[i]).size,
-                    _mtime=tar.getmember(namelist[i]).mtime,
-                    uid=tar.getmember(namelist[i]).uid,
-                    gid=tar.getmember(namelist[i]).gid,
-                    mode=oct(tar.getmember(namelist[i]).mode),
+                    self.inode,part,member.name,
+                    size=member.size,
+                    _mtime=member.mtime,
+                    uid=member.uid,
+                    gid=member.gid,
+                    mode=oct(member.mode),
                     )
                 
-                new_inode="%s|T%s" % (self.inode,i)
-                inodes.append(new_inode)
-            for inode in inodes:
                 ## Scan the new file using the scanner train:
-                fd=self.ddfs.open(inode=inode)
-                Scanner.scanfile(self.ddfs,fd,self.factories)
+                child=self.ddfs.open(inode="%s|%s" % (self.inode, part))
+                Scanner.scan_child(self.ddfs,child,self.factories)
 
 ZIPCACHE = Store.Store(max_size=5)
-		
+
+config.add_option("INFLATE_CHECKPOINT", default=1024*1024, type='int',
+                  help="Distance (in uncompressed bytes) between the decompressor "
+                  "checkpoints kept for seeking in compressed files")
+
+config.add_option("INFLATE_INDEX_MEMORY", default=64, type='int',
+                  help="Memory (in MB) used by the decompressor checkpoints of all compressed files")
+
+## The checkpoint indexes of compressed files we have read, keyed by
+## case and inode. The sizes are the memory used by their checkpoints
+## (max_bytes is set from config.INFLATE_INDEX_MEMORY when used):
+INFLATE_INDEXES = Store.Store(max_size=50)
+
+## Approximate memory held by a copy of a decompressor (its 32kb
+## window and state):
+DECOMPRESSOR_SIZE = 40 * 1024
+
+class InflateIndex:
+    """ A list of decompressor checkpoints for a compressed stream.
+
+    Each checkpoint records a copy of the decompressor state at some
+    offset in the uncompressed data, and where in the compressed data
+    it continues from. To seek we restore the nearest checkpoint
+    before the offset and only decompress from there, rather than
+    decompressing the whole file.
+
+    The index is shared by all the File objects opened on the same
+    inode. Note that zlib can not save its state to disk so the index
+    only lives in memory. No index may use more than a quarter of
+    config.INFLATE_INDEX_MEMORY - when it does every other checkpoint
+    is dropped and the spacing doubled.
+    """
+    def __init__(self, key):
+        self.key = key
+        ## Each checkpoint is (uncompressed offset, compressed offset,
+        ## decompressor, unconsumed compressed data):
+        self.checkpoints = []
+        self.offsets = []
+        ## The uncompressed size once we have seen the end:
+        self.size = None
+        ## Memory used by the checkpoints:
+        self.bytes = 0
+        ## Distance between checkpoints:
+        self.spacing = config.INFLATE_CHECKPOINT
+
+    def add(self, offset, coffset, d, tail):
+        if self.offsets and offset <= self.offsets[-1]: return
+
+        self.offsets.append(offset)
+        self.checkpoints.append((offset, coffset, d.copy(), tail))
+        self.bytes += DECOMPRESSOR_SIZE + len(tail)
+
+        if self.bytes > config.INFLATE_INDEX_MEMORY * 1024 * 1024 / 4 and \
+               len(self.checkpoints) > 2:
+            self.thin()
+
+        ## Account for our new size:
+        INFLATE_INDEXES.put(self, key=self.key, size=self.bytes)
+
+    def thin(self):
+        """ Drops every other checkpoint (keeping the first) """
+        self.checkpoints = self.checkpoints[::2]
+        self.offsets = [ c[0] for c in self.checkpoints ]
+        self.bytes = sum([ DECOMPRESSOR_SIZE + len(c[3]) for c in self.checkpoints ])
+        self.spacing *= 2
+
+    def find(self, offset):
+        """ Returns the last checkpoint before offset """
+        return self.checkpoints[bisect.bisect_right(self.offsets, offset) - 1]
+
+def gzip_header_size(data):
+    """ Returns the size of the gzip member header at the start of
+    data, or None if data does not start with a gzip header.
+    """
+    if len(data) < 10 or data[:3] != '\x1f\x8b\x08': return None
+
+    flags = ord(data[3])
+    size = 10
+    try:
+        ## FEXTRA
+        if flags & 4:
+            size += 2 + ord(data[size]) + 256 * ord(data[size+1])
+
+        ## FNAME and FCOMMENT are zero terminated:
+        for flag in (8, 16):
+            if flags & flag:
+                end = data.index('\x00', size)
+                size = end + 1
+
+        ## FHCRC
+        if flags & 2:
+            size += 2
+    except (IndexError, ValueError):
+        return None
+
+    if size > len(data): return None
+    return size
+
+class InflatedFile(File):
+    """ A base class for files which are deflated streams within
+    their parent.
+
+    Data is decompressed in bounded pieces as it is read and
+    checkpoints of the decompressor are kept in an InflateIndex so
+    that seeking does not require decompressing (or caching) the
+    whole file. Subclasses must call init_inflate() with the location
+    of the compressed data.
+    """
+    blocksize = 64 * 1024
+
+    ## The compressed stream is a sequence of gzip members (otherwise
+    ## it is a raw deflate stream):
+    gzip_members = False
+
+    index = None
+
+    def init_inflate(self, offset, length=None):
+        """ The compressed data starts at offset in our parent and is
+        length bytes long (or continues to the end).
+        """
+        self.compressed_offset = offset
+        self.compressed_end = None
+        if length is not None:
+            self.compressed_end = offset + length
+
+        ## If we know our size from an earlier reader, use it:
+        try:
+            self.size = self.size or INFLATE_INDEXES.get(
+                "%s|%s" % (self.case, self.inode)).size or 0
+        except KeyError:
+            pass
+
+    def load_index(self):
+        """ Finds the checkpoint index for this file and positions the
+        decompressor at the start.
+        """
+        if self.index is not None: return
+
+        offset = self.compressed_offset
+        key = "%s|%s" % (self.case, self.inode)
+        try:
+            self.index = INFLATE_INDEXES.get(key)
+        except KeyError:
+            INFLATE_INDEXES.max_bytes = config.INFLATE_INDEX_MEMORY * 1024 * 1024
+            self.index = InflateIndex(key)
+            coffset = offset
+            if self.gzip_members:
+                coffset = self.member_start(offset)
+                if coffset is None:
+                    raise IOError("%s is not a gzip file" % self.inode)
+
+            self.index.add(0, coffset, zlib.decompressobj(-15), '')
+
+        if self.index.size is not None:
+            self.size = self.index.size
+
+        self.restore(0)
+
+    def member_start(self, offset):
+        """ Returns the offset of the deflated data of the gzip member
+        at offset (or None if there is none).
+        """
+        self.fd.seek(offset)
+        size = gzip_header_size(self.fd.read(1024))
+        if size is None: return None
+
+        return offset + size
+
+    def restore(self, offset):
+        """ Sets up the decompressor from the last checkpoint before offset """
+        self.inflate_pos, self.inflate_coffset, d, self.inflate_tail = \
+                          self.index.find(offset)
+        self.inflate_d = d.copy()
+        self.inflate_buffer = ''
+        self.inflate_eof = False
+
+    def inflate(self):
+        """ Returns the next piece of decompressed data or '' at the end
+        of the stream.
+        """
+        while not self.inflate_eof:
+            cdata = self.inflate_tail
+            if not cdata:
+                length = self.blocksize
+                if self.compressed_end is not None:
+                    length = min(length, self.compressed_end - self.inflate_coffset)
+
+                if length > 0:
+                    self.fd.seek(self.inflate_coffset)
+                    cdata = self.fd.read(length)
+
+                if not cdata:
+                    self.inflate_eof = True
+                    break
+
+                self.inflate_coffset += len(cdata)
+
+            try:
+                data = self.inflate_d.decompress(cdata, self.blocksize)
+            except zlib.error, e:
+                pyflaglog.log(pyflaglog.DEBUG, "Error decompressing %s at offset %s: %s" % (
+                    self.inode, self.inflate_pos, e))
+                self.inflate_eof = True
+                break
+
+            self.inflate_tail = self.inflate_d.unconsumed_tail
+
+            ## The end of the deflate stream:
+            if self.inflate_d.unused_data:
+                self.next_member()
+
+            if data:
+                end = self.inflate_pos + len(self.inflate_buffer) + len(data)
+                if not self.inflate_eof and \
+                       end >= self.index.offsets[-1] + self.index.spacing:
+                    self.index.add(end, self.inflate_coffset, self.inflate_d,
+                                   self.inflate_tail)
+
+                return data
+
+        ## We now know how big we are:
+        self.index.size = self.inflate_pos + len(self.inflate_buffer)
+        self.size = self.index.size
+        return ''
+
+    def next_member(self):
+        """ Called at the end of a deflate stream to move to the next
+        gzip member if there is one.
+        """
+        self.inflate_eof = True
+        if not self.gzip_members: return
+
+        ## The member ends with an 8 byte trailer:
+        end = self.inflate_coffset - len(self.inflate_d.unused_data) + 8
+        start = self.member_start(end)
+        if start is None: return
+
+        self.inflate_d = zlib.decompressobj(-15)
+        self.inflate_coffset = start
+        self.inflate_tail = ''
+        self.inflate_eof = False
+
+    def read(self, length=None):
+        try:
+            return File.read(self,length)
+        except IOError:
+            pass
+
+        if length is None:
+            length = sys.maxint
+
+        self.load_index()
+        if self.readptr < self.inflate_pos:
+            self.restore(self.readptr)
+
+        result = []
+        while length > 0:
+            start = self.readptr - self.inflate_pos
+            if start < len(self.inflate_buffer):
+                data = self.inflate_buffer[start:start+length]
+                result.append(data)
+                self.readptr += len(data)
+                length -= len(data)
+                continue
+
+            ## Skip over the data we have not been asked for:
+            if start > len(self.inflate_buffer) + self.index.spacing:
+                checkpoint = self.index.find(self.readptr)
+                if checkpoint[0] > self.inflate_pos:
+                    self.restore(self.readptr)
+                    continue
+
+            self.inflate_pos += len(self.inflate_buffer)
+            self.inflate_buffer = ''
+            self.inflate_buffer = self.inflate()
+            if not self.inflate_buffer: break
+
+        return ''.join(result)
+
+    def seek(self, offset, rel=None):
+        ## We need to know our size to seek from the end:
+        if rel==2 and not self.cached_fd and not self.size:
+            self.load_index()
+            if self.index.size is None:
+                self.restore(self.index.offsets[-1])
+                while 1:
+                    data = self.inflate()
+                    if not data: break
+                    self.inflate_pos += len(data)
+
+                self.restore(0)
+
+        return File.seek(self, offset, rel)
+
 ## These are the corresponding VFS modules:
-class ZipFile(File):
+class ZipFile(InflatedFile):
     """ A file like object to read files from within zip files.
 
-    We essentially decompress the file on the disk because the file
-    may be exceptionally large.
+    Deflated members are decompressed as they are read.
     """
     specifier = 'Z'
     
     def __init__(self, case, fd, inode):
         File.__init__(self, case, fd, inode)
 
-        ## Make sure our parent is cached:
-        self.fd.cache()
-
         ## Parse out inode - if we got the compressed length provided,
         ## we use that, otherwise we calculate it from the zipfile
         ## header
         parts = inode.split('|')
         ourpart = parts[-1][1:]
+        self.compressed_length = None
         try:
             offset, size = ourpart.split(":")
             self.compressed_length = int(size)
@@ -249,87 +538,35 @@ class ZipFile(File):
         self.type = int(self.header['compression_method'])
 
         ## Where does the data start?
-        self.init()
+        self.data_offset = self.header.buffer.offset + self.header.size()
+        if self.type == Zip.ZIP_DEFLATED:
+            self.init_inflate(self.data_offset, self.compressed_length)
+        elif self.type != Zip.ZIP_STORED:
+            raise IOError("Compression method %s is not supported" % self.type)
 
-    def init(self):
-        self.d = zlib.decompressobj(-15)
-        self.left_over = ''
-        self.blocksize = 1024*10
-        self.clength = self.compressed_length
-        offset = self.header.buffer.offset + self.header.size()
-
-        ## Seek our fd to there:
-        self.fd.seek(offset)
-        
     def read(self,length=None):
-        ## Call our baseclass to see if we have cached data:
-        try:
-            return File.read(self,length)
-        except IOError:
-            pass
+        if self.type == Zip.ZIP_DEFLATED or self.cached_fd:
+            return InflatedFile.read(self, length)
 
-        ## Read as much as possible
-        if length==None:
-            length = sys.maxint
-            
-        ## This is done in order to decompress the file in small
-        ## chunks. We try to return as much data as was required
-        ## and not much more
-        try:
-            ## Consume the data left over from previous reads
-            result = self.left_over[:length]
-            self.left_over=self.left_over[length:]
-
-            ## We keep reading compressed data until we can satify
-            ## the desired length
-            while len(result)<length and self.clength>0:
-                ## Read up to 1k of the file:
-                available_clength = min(self.blocksize,self.clength)
-                cdata = self.fd.read(available_clength)
-                self.clength -= available_clength
-
-                if self.type == Zip.ZIP_DEFLATED:
-                    ## Now Decompress that:
-                    try:
-                        ddata = self.d.decompress(cdata)
-                    except:
-                        ddata = ''
-                elif self.type == Zip.ZIP_STORED:
-                    ddata = cdata
-                else:
-                    raise RuntimeError("Compression method %s is not supported" % self.type)
-
-                ## How much data do we require?
-                required_length = length - len(result)
-                result += ddata[:required_length]
-
-                ## This will be '' if we have not finished making
-                ## up the result, and store the rest for next time
-                ## if we have
-                self.left_over = ddata[required_length:]
-
-        except (IndexError, KeyError, zipfile.BadZipfile),e:
-            raise IOError("Zip_File: (%s)" % e)
+        ## Stored files are just read from our parent:
+        available = self.compressed_length - self.readptr
+        if length is None or length > available:
+            length = available
 
+        if length <= 0: return ''
+        self.fd.seek(self.data_offset + self.readptr)
+        result = self.fd.read(length)
         self.readptr += len(result)
         return result
 
     def seek(self, offset, rel=None):
-        File.seek(self,offset,rel)
+        if self.type == Zip.ZIP_DEFLATED:
+            return InflatedFile.seek(self, offset, rel)
 
-        if self.cached_fd: return
+        if rel==2 and not self.size:
+            self.size = self.compressed_length
 
-        if self.readptr == 0:
-            self.init()
-
-        ## We want to reinitialise the file pointer:
-        elif self.readptr!=0 and self.type == Zip.ZIP_DEFLATED:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Required to seek to offset %s in Zip File %s (%s,%s). This is inefficient, forcing disk caching." % (self.readptr, self.inode, offset,rel))
-            self.init()
-            self.cache()
-
-            self.seek(offset, rel)
-            return
+        return File.seek(self, offset, rel)
 
     def explain(self, query, result):
         self.fd.explain(query, result)
@@ -338,116 +575,27 @@ class ZipFile(File):
                    "offset %s with length %s" % (self.offset, self.compressed_length))
         result.row("","Filename - %s" % self.header['zip_path'])
 
-### FIXME - This is dangerous!!! We decompress into memory
-class GZ_file(File):
+class GZ_file(InflatedFile):
     """ A file like object to read gzipped files. """
     specifier = 'G'
+    gzip_members = True
     
     def __init__(self, case, fd, inode):
         File.__init__(self, case, fd, inode)
-        self.gz = None
-
-    def read(self, length=None):
-        try:
-            return File.read(self,length)
-        except IOError:
-            pass
-
-        if not self.gz:
-            self.fd.seek(0)
-            self.gz = gzip.GzipFile(fileobj=self.fd, mode='r')
-
-        count = 0
-        step = 1024
-
-        result = ''
-        
-        ## Copy ourself into the file - This is in case we have errors
-        ## in the file, we try to read as much as possible:
-        while 1:
-            try:
-                data=self.gz.read(step)
-            except IOError,e:
-                step /= 2
-                if step<10:
-                    pyflaglog.log(pyflaglog.DEBUG, "Error reading from %s(%s), could only get %s bytes (wanted %s/%s)" % (self.fd.inode, e, count, length,self.size));
-                    break
-                
-                else:
-                    continue
-
-            except Exception, e:
-                #pyflaglog.log(pyflaglog.WARNING, "Unable to decompress inode (%s) %s" % (self.inode, e))
-                break
-            
-            count += len(data)
-            if len(data)==0: break
-            result+=data
-
-        return result
-
-    def seek(self,offset,rel=None):
-        File.seek(self,offset,rel)
-
-        if self.cached_fd: return
-
-        ## If we were asked to seek in a gzip file:
-        if self.readptr!=0:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Asked to seek to %s in gzip file %s. This is expensive, caching on disk." % (self.readptr, self.inode))
-            self.cache()
-
-            self.seek(offset,rel)
-
-        ## Force a new decompressor when rereading:
-        self.gz = None
+        self.init_inflate(0)
 
     def explain(self, query, result):
         self.fd.explain(query, result)
 
         result.row("Gzip File", "Use Gzip algorithm to decompress %s" % self.fd.inode)
 
-class DeflateFile(GZ_file):
+class DeflateFile(InflatedFile):
     """ A File like object to read deflated files """
     specifier = "d"
 
-    def read(self, length=None):
-        try:
-            return File.read(self,length)
-        except IOError:
-            pass
-
-        if not self.gz:
-            self.fd.seek(0)
-            self.gz = gzip.zlib.decompressobj(-15)
-
-        count = 0
-        step = 1024
-
-        result = ''
-        
-        ## Copy ourself into the file - This is in case we have errors
-        ## in the file, we try to read as much as possible:
-        while 1:
-            try:
-                data=self.gz.decompress(self.fd.read(step))
-            except IOError,e:
-                step /= 2
-                if step<10:
-                    pyflaglog.log(pyflaglog.DEBUG, "Error reading from %s, could only get %s bytes" % (self.fd.inode, count));
-                    break
-                
-                else:
-                    continue
-
-            except Exception, e:
-                pyflaglog.log(pyflaglog.WARNING, "Unable to decompress inode %s" % e)
-                break
-            
-            count += len(data)
-            if len(data)==0: break
-            result+=data
-
-        return result
+    def __init__(self, case, fd, inode):
+        File.__init__(self, case, fd, inode)
+        self.init_inflate(0)
 
     def explain(self, query, result):
         self.fd.explain(query, result)
@@ -461,6 +609,18 @@ class Tar_file(File):
     def __init__(self, case, fd, inode):
         File.__init__(self, case, fd, inode)
 
+        ## Newer inodes give the offset and size of the data in the
+        ## tar file so we can read it directly:
+        parts = inode.split('|')
+        self.data = None
+        try:
+            offset, size = parts[-1][1:].split(":")
+            self.data_offset = int(offset)
+            self.size = int(size)
+            return
+        except ValueError:
+            pass
+
         ## Tar file handling requires repeated access into the tar
         ## file. Caching our input fd really helps to speed things
         ## up...
@@ -469,7 +629,6 @@ class Tar_file(File):
         # strategy:
         # inode is the index into the namelist of the tar file (i hope this is consistant!!)
         # just read that file!
-        parts = inode.split('|')
 
         try:
             t = ZIPCACHE.get(self.fd.inode)
@@ -496,6 +655,17 @@ class Tar_file(File):
         except IOError:
             pass
 
+        if self.data is None:
+            available = self.size - self.readptr
+            if len is None or len > available:
+                len = available
+
+            if len <= 0: return ''
+            self.fd.seek(self.data_offset + self.readptr)
+            result = self.fd.read(len)
+            self.readptr += result.__len__()
+            return result
+
         if len:
             temp=self.data[self.readptr:self.readptr+len]
             self.readptr+=len
@@ -572,6 +742,49 @@ class ZipScanTest(pyflag.tests.ScannerTest):
         #count = dbh.fetch()['count']
         #self.failIf(count==0, "Could not find any tar files?")
 
+    def test_inflate(self):
+        """ Test seeking and reading in compressed files """
+        import random
+
+        ## Two gzip members:
+        data = [ "".join([ "%s %s\n" % (i, random.random()) for i in range(50000) ])
+                 for j in range(2) ]
+        compressed = StringIO.StringIO()
+        for d in data:
+            member = gzip.GzipFile(fileobj=compressed, mode='wb')
+            member.write(d)
+            member.close()
+
+        expected = "".join(data)
+
+        old = config.INFLATE_CHECKPOINT, config.INFLATE_INDEX_MEMORY
+        config.INFLATE_CHECKPOINT = 64 * 1024
+        ## Small enough for the index to be thinned:
+        config.INFLATE_INDEX_MEMORY = 1
+        try:
+            fd = GZ_file(self.test_case, compressed, "Iinflate_test|G0")
+            self.assertEqual(fd.read(), expected)
+            self.assert_(fd.index.spacing > config.INFLATE_CHECKPOINT)
+            self.assert_(fd.index.bytes <= 1024 * 1024 / 4 + DECOMPRESSOR_SIZE)
+
+            ## Seek backwards, forwards and across the members:
+            for offset in [ len(data[0]) - 500, 10, len(expected) - 10,
+                            len(expected) / 3, len(data[0]) ]:
+                fd.seek(offset)
+                self.assertEqual(fd.read(1000), expected[offset:offset+1000])
+
+            fd.seek(0, 2)
+            self.assertEqual(fd.tell(), len(expected))
+
+            ## A new reader uses the checkpoints of the first:
+            fd2 = GZ_file(self.test_case, compressed, "Iinflate_test|G0")
+            fd2.seek(len(expected) - 100)
+            self.assertEqual(fd2.read(), expected[-100:])
+            self.assert_(fd2.index is fd.index)
+        finally:
+            config.INFLATE_CHECKPOINT, config.INFLATE_INDEX_MEMORY = old
+            INFLATE_INDEXES.expire("Iinflate_test")
+
 import pyflag.tests
 
 class ZipScanTest2(pyflag.tests.ScannerTest):
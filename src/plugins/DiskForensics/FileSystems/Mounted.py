@@ -193,6 +193,7 @@ class MountedFS(DBFS):
                     arg2 = inode,
                     arg3= scanner_string,
                     cookie=cookie,
+                    cost = s.st_size,
                     )
                                  
             ## Fixme - handle symlinks
@@ -264,6 +264,7 @@ class Sleuthkit(DBFS):
                     arg2 = inodestr,
                     arg3= scanner_string,
                     cookie=cookie,
+                    cost = args.get('size', 0),
                     )
             return inode_id
 
@@ -77,6 +77,8 @@ class IndexScan(GenScanFactory):
         if not INDEX: reindex()
 
     class Scan(MemoryScan):
+        resumable = True
+
         def __init__(self, inode,ddfs,outer,factories=None,fd=None):
             MemoryScan.__init__(self, inode,ddfs,outer,factories,fd=fd)
 
@@ -123,6 +125,19 @@ class IndexScan(GenScanFactory):
                         length = length
                         )
 
+        def checkpoint(self):
+            self.dbh.mass_insert_commit()
+            self.dbh.mass_insert_start('LogicalIndexOffsets')
+
+        def resume(self, offset):
+            offset = MemoryScan.resume(self, offset)
+
+            ## Hits after the offset may have been stored before we
+            ## were interrupted:
+            self.dbh.execute("delete from LogicalIndexOffsets where inode_id=%r and offset>=%r",
+                             (self.inode_id, offset))
+            return offset
+
         def slack(self,data,metadata=None):
             """ deal with slack space the same as any other data """
             return self.process(data, metadata)
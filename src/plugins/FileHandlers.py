@@ -39,19 +39,15 @@ class FileMethod(IO.FileHandler):
         else:
             file = path
 
-        ## We need to handle gzip files transparently here:
-        try:
+        ## We need to handle gzip files transparently here. Other
+        ## files are read through the descriptor pool so we do not
+        ## hold a descriptor for each open image:
+        fd = IO.FD_POOL.open(file)
+        if fd.read(2) == '\x1f\x8b':
             ## Allow log files to be compressed.
             fd=gzip.open(file,'rb')
-            
-            ## gzip doesnt really verify the file until you read something:
-            magic=fd.read(10)
-            if len(magic)!=10:
-                fd = open(file,'rb')
-            else:
-                fd.seek(0)
-        except:
-            fd=open(file,'rb')
+        else:
+            fd.seek(0)
 
         return fd
 
@@ -72,7 +72,7 @@ class scan_path(pyflagsh.command):
             
         ## FIXME For massive images this should be broken up, as in the old GUI method
         dbh=DB.DBO(self.environment._CASE)
-        dbh.execute("select inode.inode from inode join file on file.inode = inode.inode where file.path rlike %r", fnmatch.translate(path))
+        dbh.execute("select inode.inode, inode.size from inode join file on file.inode = inode.inode where file.path rlike %r", fnmatch.translate(path))
 
         pdbh = DB.DBO()
         pdbh.mass_insert_start('jobs')
@@ -90,6 +90,7 @@ class scan_path(pyflagsh.command):
                 arg2 = row['inode'],
                 arg3 = ','.join(scanners),
                 cookie=cookie,
+                cost = row['size'] or 0,
                 )#
     
         pdbh.mass_insert_commit()
@@ -156,7 +157,7 @@ class scan(pyflagsh.command):
 
         ## Try to glob the inode list:
         dbh=DB.DBO(self.environment._CASE)
-        dbh.execute("select inode from inode where inode rlike %r",fnmatch.translate(self.args[0]))
+        dbh.execute("select inode, size from inode where inode rlike %r",fnmatch.translate(self.args[0]))
         pdbh = DB.DBO()
         pdbh.mass_insert_start('jobs')
         ## This is a cookie used to identify our requests so that we
@@ -176,6 +177,7 @@ class scan(pyflagsh.command):
                 arg2 = row['inode'],
                 arg3 = ','.join(scanners),
                 cookie=cookie,
+                cost = row['size'] or 0,
                 )
 
         pdbh.mass_insert_commit()
@@ -370,3 +372,21 @@ class load_and_scan(scan):
         self.wait_for_scan(fs.cookie)
         
         yield "Loading complete"
+
+class scanner_stats(pyflagsh.command):
+    """ Dump the scanner statistics of the current case """
+    def help(self):
+        return "scanner_stats [type]: Prints tab separated scanner statistics totalled per scanner (or per scanner and file type)"
+
+    def execute(self):
+        import plugins.ScannerStatistics as ScannerStatistics
+
+        Scanner.SCANNER_STATISTICS.flush()
+        group_by = "scanner"
+        if self.args and self.args[0] == 'type':
+            group_by = "scanner,type"
+
+        columns = group_by.split(",") + Scanner.STATISTICS_FIELDS
+        yield "\t".join(columns)
+        for row in ScannerStatistics.summarise(self.environment._CASE, group_by):
+            yield "\t".join([ "%s" % row[c] for c in columns ])
@@ -108,6 +108,8 @@ class LoadPresetLog(Reports.report):
 
             result.textfield("Table name:","table")
             result.fileselector("log files to use", 'datafile')
+            result.checkbox("Only load data not already in this table",
+                            "incremental", "yes")
 
             try:
                 if query.getarray('datafile'):
@@ -149,7 +151,8 @@ class LoadPresetLog(Reports.report):
         """ Load the log file into the table """
         log = LogFile.load_preset(query['case'], query['preset'], query.getarray('datafile'))
         
-        for progress in log.load(query['table'], filter=query.get('filter')):
+        for progress in log.load(query['table'], filter=query.get('filter'),
+                                 incremental=query.get('incremental') == 'yes'):
             self.progress_str = progress
             
     def reset(self, query):
@@ -15,6 +15,8 @@ from format import *
 class EventLogLog(Simple.SimpleLog):
     """ Log parser for Windows Event log files """
     name = "Event Logs"
+    ## We parse the files ourselves:
+    parallel_load = False
 
     def get_fields(self):
         if self.datafile==None:
@@ -38,7 +38,7 @@ config=pyflag.conf.ConfObject()
 import re
 import plugins.LogAnalysis.Whois as Whois
 import pyflag.Registry as Registry
-from pyflag.ColumnTypes import ColumnType, StringType
+from pyflag.ColumnTypes import ColumnType, StringType, IntegerType, TimestampType
 
 description = "Log Analysis"
 order = 35
@@ -152,34 +152,39 @@ class BandWidth(Reports.report):
         result.end_form(None)
         result.end_table()
 
+        ## The bins come from a rollup of the log table so we do not
+        ## need to group the entire table for each page:
+        rollup = LogFile.get_rollup(dbh, query['logtable'], query['timestamp'],
+                                    bin_size, [query['size']])
+        size = "sum_%s" % query['size']
+
         if query.has_key('graph'):
             new_query=query.clone()
             del new_query['graph']
             del new_query['limit']
             result.link("Click here to view table",new_query)
 
-            params={'timestamp':query['timestamp'],'bin_size':bin_size,'size':query['size'],'logtable':query['logtable']}
             try:
                 start=int(query['limit'])
                 if not start: raise KeyError
             except KeyError:
-                dbh.execute('select unix_timestamp(min(%(timestamp)s)) as `min` from %(logtable)s'%params)
-                start=dbh.fetch()['min']
-
-            params['start']=start
+                dbh.execute("select min(`bin`) as `min` from `%s`", rollup)
+                start=dbh.fetch()['min'] or 0
 
             result.para("")
-            dbh.execute('select unix_timestamp(%(timestamp)s) as `timestamp`,floor(unix_timestamp(%(timestamp)s)/%(bin_size)s)*%(bin_size)s as `Unix Timestamp`,from_unixtime(floor(unix_timestamp(%(timestamp)s)/%(bin_size)s)*%(bin_size)s) as `DateTime`,sum(%(size)s) as `Count` from %(logtable)s  where `%(timestamp)s`>from_unixtime("%(start)s") and   `%(timestamp)s`<from_unixtime("%(start)s"+100*%(bin_size)s) group by `Unix Timestamp`  order by  `Unix Timestamp` asc   limit 0, 100' % params )
+            dbh.execute("select `bin`, `time`, `%s` as `Count` from `%s` where `bin` >= %r "
+                        "and `bin` < %r order by `bin` asc limit 0, 100",
+                        (size, rollup, start, start + 100*bin_size))
             x=[]
             y=[]
             z=[]
             for row in dbh:
-                x.append(row['DateTime'])
+                x.append(row['time'])
                 y.append(row['Count'])
-                z.append(row['timestamp'])
+                z.append(row['bin'])
 
             try:
-                result.next=z[-1]
+                result.next=z[-1] + bin_size
                 result.previous=z[0]-100*bin_size
             except IndexError:
                 del query['limit']
@@ -195,12 +200,11 @@ class BandWidth(Reports.report):
         result.link("Click here to view graph",query,graph=1)
 
         result.table(
-            columns=('floor(unix_timestamp(%s)/%s)*%s' % (query['timestamp'],bin_size,bin_size) ,'from_unixtime(floor(unix_timestamp(%s)/%s)*%s)' % (query['timestamp'],bin_size,bin_size) ,'sum(%s)'%query['size']), 
-            names=('Unix Timestamp','DateTime','Count'),
-            links=[],
-            table=query['logtable'],
+            elements = [ IntegerType('Unix Timestamp', 'bin'),
+                         TimestampType('DateTime', 'time'),
+                         IntegerType('Count', size) ],
+            table=rollup,
             case=query['case'],
-            groupby='`Unix Timestamp`'
             )
 
 class RemoveLogTable(Reports.report):
@@ -331,3 +335,6 @@ class LogTablesInit(FlagFramework.EventHandler):
         `table_name` varchar(250) NOT NULL,
         primary key (`table_name`)
         ) engine=MyISAM""")
+
+        ## How much of each datafile was loaded by incremental loads
+        LogFile.check_progress_table(dbh)
@@ -176,27 +176,54 @@ class SimpleLog(LogFile.Log):
     """
     name = "Simple"
     
+    def compile_prefilters(self):
+        """ Returns a function which applies our prefilters to a string.
+
+        The prefilter object (and its regexes) are only set up once
+        here, rather than for each record.
+        """
+        p = prefilter()
+        ## Bind the relevant methods on the prefilter object:
+        filters = [ getattr(p, i) for i in self.prefilters ]
+        if not filters:
+            return lambda string: string
+
+        def apply_prefilters(string):
+            for f in filters:
+                string = f(string)
+
+            return string
+
+        return apply_prefilters
+
     def prefilter_record(self,string):
         """ Prefilters the record (string) and returns a new string which is the filtered record.
         """
-        p = prefilter()
-        for i in self.prefilters:
-            #Call the relevant methods on the prefilter object:
-            string = p.filters[i][0](p,string)
+        return self.compile_prefilters()(string)
 
-        return string
+    def compile_record(self):
+        """ Returns a function which turns a record into an array of
+        cells. This is called once for each pass over the log file.
+        """
+        apply_prefilters = self.compile_prefilters()
+        split = self.delimiter.split
+
+        def process_record(row):
+            splitUpRow = split(apply_prefilters(row))
+            ## Make sure the last item is stripped
+            splitUpRow[-1] = splitUpRow[-1].strip()
+            return splitUpRow
+
+        return process_record
 
     def get_fields(self):
         """ A generator that returns all the columns in a log file.
 
         @returns: A generator that generates arrays of cells
         """
+        process_record = self.compile_record()
         for row in self.read_record():
-            row = self.prefilter_record(row)
-            splitUpRow = self.delimiter.split(row)
-            ## Make sure the last item is stripped
-            splitUpRow[-1] = splitUpRow[-1].strip()
-            yield splitUpRow
+            yield process_record(row)
 
     def parse(self, query, datafile='datafile'):
         """ This function parses the query string into the appropriate fields array """
@@ -269,7 +296,8 @@ class SimpleLog(LogFile.Log):
             result.start_table()
             ## Show the filtered sample:
             result.row("Prefiltered data:",align="left")
-            sample=[ self.prefilter_record(record) for record in sample ]
+            apply_prefilters = self.compile_prefilters()
+            sample=[ apply_prefilters(record) for record in sample ]
             [result.row(s,bgcolor='lightgray') for s in sample]
             result.end_table()
 
@@ -357,7 +385,7 @@ class SimpleLog(LogFile.Log):
         result.row(*type)
         result.row(*index)
 
-import time
+import time, gzip, os
 
 ## Unit tests for Simple log file:
 class SimpleLogTest(LogFile.LogDriverTester):
@@ -459,3 +487,131 @@ class SimpleLogTest(LogFile.LogDriverTester):
         dbh.execute("select count(*) as c from `%s_log`", self.test_table_two)
         row = dbh.fetch()
         self.assertEqual(row['c'], 12)
+
+    def test05Benchmark(self):
+        """ Compare the compiled record pipeline with per line prefiltering """
+        log = LogFile.load_preset(self.test_case, self.log_preset, [self.test_file])
+        log.prefilters = ['PFRemoveChars', 'PFDateFormatChange2']
+        lines = list(log.read_record())
+
+        ## This is how records used to be processed:
+        def uncompiled(row):
+            p = prefilter()
+            for i in log.prefilters:
+                row = p.filters[i][0](p,row)
+
+            splitUpRow = log.delimiter.split(row)
+            splitUpRow[-1] = splitUpRow[-1].strip()
+            return splitUpRow
+
+        process_record = log.compile_record()
+        self.assertEqual(map(uncompiled, lines), map(process_record, lines))
+
+        self.compare_rates(uncompiled, process_record, lines)
+
+    def test06IncrementalLoad(self):
+        """ Test that incremental loads only load new data """
+        table = "IncrementalTable"
+        LogFile.drop_table(self.test_case, table)
+        dbh = DB.DBO(self.test_case)
+
+        def load():
+            log = LogFile.load_preset(self.test_case, self.log_preset, [self.test_file])
+            for a in log.load(table, incremental=True):
+                pass
+
+            dbh.execute("select count(*) as c from `%s_log`", table)
+            return dbh.fetch()['c']
+
+        count = load()
+        self.assert_(count > 0)
+
+        ## Nothing has changed so nothing is loaded the second time:
+        self.assertEqual(load(), count)
+
+    def test07IncrementalRotation(self):
+        """ Test that rotated log files are loaded from the start """
+        table = "RotatedTable"
+        LogFile.drop_table(self.test_case, table)
+        dbh = DB.DBO(self.test_case)
+
+        lines = gzip.open(os.path.join(config.UPLOADDIR, self.test_file)).readlines()
+        filename = "incremental_rotation.log"
+        path = os.path.join(config.UPLOADDIR, filename)
+
+        def load(data):
+            ## Replace the file like logrotate does:
+            fd = open(path + ".new", "wb")
+            fd.write("".join(data))
+            fd.close()
+            os.rename(path + ".new", path)
+
+            log = LogFile.load_preset(self.test_case, self.log_preset, [filename])
+            for a in log.load(table, incremental=True):
+                pass
+
+            dbh.execute("select count(*) as c from `%s_log`", table)
+            return dbh.fetch()['c']
+
+        try:
+            count = load(lines[:100])
+            ## The pool may still have the old file open - we must
+            ## notice it was replaced:
+            self.assertEqual(load(lines[100:150]), count + 50)
+        finally:
+            os.unlink(path)
+
+    def test08Rollups(self):
+        """ Test that time rollups agree with the log table """
+        dbh = DB.DBO(self.test_case)
+        table = self.test_table + "_log"
+
+        ## Two hour bins are calculated from the hour rollup:
+        rollup = LogFile.get_rollup(dbh, table, "Time", 7200, ["Bytes"])
+        dbh.execute("select floor(unix_timestamp(`Time`)/7200)*7200 as `bin`, "
+                    "count(*) as c, sum(`Bytes`) as s from `%s` group by 1 order by 1",
+                    table)
+        expected = [ (row['bin'], row['c'], row['s']) for row in dbh ]
+
+        dbh.execute("select `bin`, `count`, `sum_Bytes` from `%s` order by `bin`", rollup)
+        self.assertEqual(expected, [ (row['bin'], row['count'], row['sum_Bytes']) for row in dbh ])
+
+    def test09IncrementalResume(self):
+        """ Test that an interrupted incremental load resumes without duplicating rows """
+        dbh = DB.DBO(self.test_case)
+
+        class Interrupted(Exception): pass
+
+        def load(table, interrupt=False):
+            log = LogFile.load_preset(self.test_case, self.log_preset, [self.test_file])
+            if interrupt:
+                ## Die right after the first batch was written:
+                save_progress = log.save_progress
+                def die(*args):
+                    save_progress(*args)
+                    raise Interrupted()
+
+                log.save_progress = die
+
+            try:
+                for a in log.load(table, incremental=True):
+                    pass
+            except Interrupted:
+                pass
+
+            dbh.execute("select count(*) as c from `%s_log`", table)
+            return dbh.fetch()['c']
+
+        for table in ("CompleteTable", "ResumedTable"):
+            LogFile.drop_table(self.test_case, table)
+
+        old = config.MASS_INSERT_THRESHOLD, config.MASS_INSERT_ENGINE
+        config.MASS_INSERT_THRESHOLD = 10
+        config.MASS_INSERT_ENGINE = 'insert'
+        try:
+            count = load("CompleteTable")
+            partial = load("ResumedTable", interrupt=True)
+            self.assert_(0 < partial < count)
+            self.assertEqual(load("ResumedTable"), count)
+        finally:
+            config.MASS_INSERT_THRESHOLD, config.MASS_INSERT_ENGINE = old
@@ -35,7 +35,8 @@ config=pyflag.conf.ConfObject()
 import re
 import pyflag.pyflaglog as pyflaglog
 import pyflag.Store as Store
-import os
+import os, socket, struct, bisect, mmap
+from array import array
 
 description = "Offline Whois"
 hidden = False
@@ -52,6 +53,14 @@ config.add_option("PRECACHE_WHOIS", default=False, action="store_true",
                   " slow (especially when loading large log "
                   " files). Select this to enable this option.")
 
+config.add_option("WHOIS_BATCH", default=5000, type='int',
+                  help="Number of distinct IP addresses whose whois/GeoIP data is "
+                  "cached at once while loading")
+
+config.add_option("WHOIS_INDEX_FILE", default=None,
+                  help="The file the whois routes index is saved in (defaults to "
+                  "whois_routes.idx in the RESULTDIR)")
+
 config.add_option("flush_geocache", default=False, action="store_true",
                   help="Flush the GeoIP/Whois Cache. You will not be able to search on "
                   " GeoIP/Whois data loaded previously until a new lookup is done")
@@ -72,7 +81,7 @@ if config.flush_geocache:
 
 ## A cache of whois addresses - This really does not need to be
 ## invalidated as the data should never change
-WHOIS_CACHE = Store.Store()
+WHOIS_CACHE = Store.Store(max_size=100000)
 
 ## Try for the GeoIP City Stuff....
 
@@ -168,6 +177,24 @@ def insert_whois_cache(sql_ip, id, ipinfo):
                )
 
 def lookup_whois_id(dbh, ip):
+    """ Returns the whois id of the most specific route for ip (an int
+    or a dotted quad).
+    """
+    try:
+        try:
+            ip/2
+            numeric = ip
+        except TypeError:
+            numeric = ip_to_int(ip.strip())
+
+        return get_whois_index().lookup(numeric)
+    except (DB.DBError, IOError, socket.error, AttributeError), e:
+        pyflaglog.log(pyflaglog.DEBUG, "Unable to use the whois index for %s: %s" % (ip, e))
+
+    ## Fall back to searching the routes table:
+    if not dbh:
+        dbh = DB.DBO()
+
     netmask = 0
     while 1:
         dbh.execute("select whois_id from whois_routes where ( inet_aton(%r) & inet_aton('255.255.255.255') & ~%r ) = network and (inet_aton('255.255.255.255') & ~%r) = netmask limit 1 " , (ip,netmask,netmask))
@@ -206,16 +233,26 @@ def lookup_whois(ip):
     try:
         return WHOIS_CACHE.get(ip)
     except KeyError:
-        dbh = DB.DBO()
+        pass
+
+    ## Addresses in dot notation are cached by precache_whois:
+    if sql_ip != ip:
+        precache_whois([ip])
+        try:
+            return WHOIS_CACHE.get(ip.strip())
+        except KeyError:
+            pass
+
+    dbh = DB.DBO()
         
-        dbh.check_index("whois_cache", "ip")
-        dbh.execute("select id from whois_cache where ip=%s limit 1" , sql_ip)
-        row = dbh.fetch()
-        if row:
-            id = row['id']
-            WHOIS_CACHE.put(id, key=ip)
-            
-            return id
+    dbh.check_index("whois_cache", "ip")
+    dbh.execute("select id from whois_cache where ip=%s limit 1" , sql_ip)
+    row = dbh.fetch()
+    if row:
+        id = row['id']
+        WHOIS_CACHE.put(id, key=ip)
+
+        return id
 
     if config.PRECACHE_WHOIS:
         id = lookup_whois_id(dbh, ip)
@@ -276,6 +313,310 @@ def lookup_whois(ip):
                           "caching: %s %s" % (e,ip))
     return id
 
+def ip_to_int(ip):
+    """ Converts a dotted quad to an int as mysql's inet_aton does """
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+class MappedArray:
+    """ A read only array of unsigned ints stored in a mmap """
+    def __init__(self, map, offset, length):
+        self.map = map
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0: i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError(i)
+
+        return struct.unpack_from("=I", self.map, self.offset + 4 * i)[0]
+
+class WhoisIndex:
+    """ An in memory index of the whois_routes table.
+
+    Routes are flattened into sorted, non overlapping intervals, each
+    mapped to the most specific route covering it. Finding the route
+    for an address is then a binary search.
+
+    The intervals are saved to a snapshot file (WHOIS_INDEX_FILE) which
+    other processes simply mmap. The snapshot records the state of the
+    whois_routes table it was made from, and is rebuilt when the table
+    changes.
+    """
+    magic = "PFWHOIS1"
+    
+    def __init__(self):
+        self.starts = array('I')
+        self.ids = array('I')
+
+    def signature(self):
+        """ Returns a string which changes whenever whois_routes does """
+        dbh = DB.DBO()
+        dbh.execute("show table status like 'whois_routes'")
+        row = dbh.fetch()
+        if not row:
+            raise IOError("No whois_routes table")
+
+        return "%s/%s" % (row['Rows'], row['Update_time'])
+
+    def load(self):
+        dbh = DB.DBO()
+        dbh.execute("select network, netmask, whois_id from whois_routes")
+        routes = []
+        for row in dbh:
+            start = row['network']
+            end = start + (~row['netmask'] & 0xffffffffL)
+            routes.append((start, -end, row['whois_id']))
+
+        ## Wider routes sort before the routes they contain:
+        routes.sort()
+
+        self.starts = array('I')
+        self.ids = array('I')
+        self.add(0, 0)
+
+        stack = []
+        for start, end, whois_id in routes:
+            end = -end
+
+            ## Routes ending before this one starts are done with, and
+            ## the route containing them applies again:
+            while stack and stack[-1][0] < start:
+                self.pop(stack)
+
+            self.add(start, whois_id)
+            stack.append((end, whois_id))
+
+        while stack:
+            self.pop(stack)
+
+        pyflaglog.log(pyflaglog.DEBUG, "Loaded %s whois routes into %s intervals" % (len(routes), len(self.starts)))
+
+    def pop(self, stack):
+        """ Ends the innermost route on the stack """
+        end = stack.pop()[0]
+        if end < 0xffffffffL:
+            if stack:
+                self.add(end + 1, stack[-1][1])
+            else:
+                self.add(end + 1, 0)
+
+    def add(self, start, whois_id):
+        """ Starts a new interval - intervals must be added in order """
+        if self.starts and self.starts[-1] == start:
+            self.ids[-1] = whois_id
+        elif not self.ids or self.ids[-1] != whois_id:
+            self.starts.append(start)
+            self.ids.append(whois_id)
+
+    def save(self, filename, signature):
+        """ Writes a snapshot of the index """
+        tmp = "%s.%s" % (filename, os.getpid())
+        fd = open(tmp, "wb")
+        try:
+            fd.write(self.magic)
+            fd.write(struct.pack("=II", len(signature), len(self.starts)))
+            fd.write(signature)
+            self.starts.tofile(fd)
+            self.ids.tofile(fd)
+        finally:
+            fd.close()
+
+        ## Readers must never see a partial snapshot:
+        os.rename(tmp, filename)
+
+    def open(self, filename, signature):
+        """ Maps the snapshot in filename if it was made from the
+        whois_routes table with the given signature.
+        """
+        fd = open(filename, "rb")
+        try:
+            map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+        if map[:len(self.magic)] != self.magic:
+            raise IOError("%s is not a whois snapshot" % filename)
+
+        offset = len(self.magic)
+        siglen, length = struct.unpack_from("=II", map, offset)
+        offset += 8
+        if map[offset:offset + siglen] != signature:
+            raise IOError("Whois snapshot %s is out of date" % filename)
+
+        offset += siglen
+        if len(map) < offset + 8 * length:
+            raise IOError("Whois snapshot %s is truncated" % filename)
+
+        self.starts = MappedArray(map, offset, length)
+        self.ids = MappedArray(map, offset + 4 * length, length)
+
+    def lookup(self, ip):
+        """ Returns the whois id of the most specific route for ip (an int) """
+        return self.ids[bisect.bisect_right(self.starts, ip) - 1]
+
+WHOIS_INDEX = None
+
+def get_whois_index():
+    """ Returns the WhoisIndex, mapping the snapshot if possible """
+    global WHOIS_INDEX
+
+    if WHOIS_INDEX is None:
+        index = WhoisIndex()
+        signature = index.signature()
+        filename = config.WHOIS_INDEX_FILE or \
+                   os.path.join(config.RESULTDIR, "whois_routes.idx")
+        try:
+            index.open(filename, signature)
+        except (IOError, EnvironmentError, ValueError, struct.error), e:
+            pyflaglog.log(pyflaglog.DEBUG, "Rebuilding whois index: %s" % e)
+            index.load()
+            try:
+                index.save(filename, signature)
+            except (IOError, OSError), e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to save whois index: %s" % e)
+
+        WHOIS_INDEX = index
+
+    return WHOIS_INDEX
+
+## Caches the ids of the names in the geoip tables
+GEOIP_IDS = {}
+
+def geoip_ids(dbh, table, column, values, **extra):
+    """ Returns a dict mapping values to their id in the geoip table,
+    inserting those which are not there yet.
+
+    extra are other columns to insert along with each value (as a dict
+    keyed by value).
+    """
+    cache = GEOIP_IDS.setdefault(table, {})
+    for attempt in range(2):
+        missing = [ v for v in values if v not in cache ]
+        if not missing: break
+
+        for i in range(0, len(missing), 1000):
+            dbh.execute("select id, `%s` as value from `%s` where `%s` in (%s)", (
+                column, table, column,
+                ','.join([ DB.expand("%r", (v,)) for v in missing[i:i+1000] ])))
+            for row in dbh:
+                cache[row['value']] = row['id']
+
+        if attempt: break
+
+        missing = [ v for v in missing if v not in cache ]
+        if not missing: break
+
+        dbh.mass_insert_start(table)
+        for v in missing:
+            args = {column: v}
+            for k, d in extra.items():
+                args[k] = d[v]
+
+            dbh.mass_insert(**args)
+        dbh.mass_insert_commit()
+
+    return cache
+
+def precache_whois(ips):
+    """ Makes sure all the ips (dotted quads) are in the whois_cache.
+
+    This resolves all the addresses at once - addresses we have not
+    seen before are looked up in the WhoisIndex and GeoIP, and
+    inserted into the whois_cache together.
+    """
+    todo = {}
+    for ip in ips:
+        if not ip: continue
+        ip = ip.strip()
+        if ip in todo: continue
+
+        try:
+            WHOIS_CACHE.get(ip)
+        except KeyError:
+            try:
+                todo[ip] = ip_to_int(ip)
+            except socket.error:
+                pass
+
+    if not todo: return
+
+    dbh = DB.DBO()
+    dbh.check_index("whois_cache", "ip")
+
+    ## Some may already be in the whois_cache:
+    addresses = todo.keys()
+    for i in range(0, len(addresses), 1000):
+        dbh.execute("select inet_ntoa(ip) as ip, id from whois_cache where ip in (%s)",
+                    ','.join([ "%s" % todo[ip] for ip in addresses[i:i+1000] ]))
+        for row in dbh:
+            WHOIS_CACHE.put(row['id'], key=row['ip'])
+            todo.pop(row['ip'], None)
+
+    if not todo: return
+
+    if config.PRECACHE_WHOIS:
+        index = get_whois_index()
+
+    rows = []
+    cities = {}
+    countries = {}
+    isps = {}
+    orgs = {}
+    for ip, numeric in todo.items():
+        if config.PRECACHE_WHOIS:
+            id = index.lookup(numeric)
+        else:
+            id = 0
+
+        ipinfo = get_all_geoip_data(ip)
+        city = ipinfo.get('city') or 'Unknown'
+        country = ipinfo.get('country_code3') or '---'
+        isp = ipinfo.get('isp') or 'Unknown'
+        org = ipinfo.get('org') or 'Unknown'
+
+        cities[city] = 1
+        countries[country] = ipinfo.get('country_code') or '00'
+        isps[isp] = 1
+        orgs[org] = 1
+        rows.append((ip, numeric, id, city, country, isp, org))
+
+    cities = geoip_ids(dbh, "geoip_city", "city", cities.keys())
+    isps = geoip_ids(dbh, "geoip_isp", "isp", isps.keys())
+    orgs = geoip_ids(dbh, "geoip_org", "org", orgs.keys())
+    countries = geoip_ids(dbh, "geoip_country", "country", countries.keys(),
+                          country2 = countries)
+
+    dbh.mass_insert_start("whois_cache")
+    for ip, numeric, id, city, country, isp, org in rows:
+        try:
+            dbh.mass_insert(ip = numeric, id = id,
+                            geoip_city = cities[city],
+                            geoip_country = countries[country],
+                            geoip_isp = isps[isp],
+                            geoip_org = orgs[org])
+        except KeyError, e:
+            pyflaglog.log(pyflaglog.WARNING, "Problem in GeoIP " \
+                          "caching: %s %s" % (e,ip))
+            continue
+
+        WHOIS_CACHE.put(id, key=ip)
+
+    dbh.mass_insert_commit()
+
+## Addresses seen by IPType.insert which are not cached yet:
+PENDING_IPS = {}
+
+def flush_pending_ips():
+    global PENDING_IPS
+
+    ips = PENDING_IPS.keys()
+    PENDING_IPS = {}
+    precache_whois(ips)
+
 def _geoip_cached_record(ip):
     dbh = DB.DBO()
     
@@ -350,11 +691,18 @@ class PrecacheWhois(Reports.report):
         ## Now find all IP addresses:
         dbh.execute("select count(*) as count, inet_ntoa(`%s`) as ip from `%s` group by `%s`",
                     (query['column'], query['table'], query['column']))
-        
+
+        ips = []
         for row in dbh:
-            lookup_whois(row['ip'])
+            ips.append(row['ip'])
+            if len(ips) >= config.WHOIS_BATCH:
+                precache_whois(ips)
+                ips = []
+
             self.processed += row['count']
 
+        precache_whois(ips)
+
     def progress(self, query, result):
         result.heading("Caching IP addresses from table %s" % query['table'])
         result.para("Processed %s out of %s rows" % (self.progress, self.count))
@@ -499,6 +847,13 @@ class WhoisInit(FlagFramework.EventHandler):
         except:
             pass
 
+        ## Make sure the whois snapshot is current before the workers
+        ## need it:
+        try:
+            get_whois_index()
+        except Exception, e:
+            pyflaglog.log(pyflaglog.WARNING, "Unable to build the whois index: %s" % e)
+
     def init_default_db(self, dbh, case):
         dbh.execute("""CREATE TABLE `whois` (
         `id` int(11) NOT NULL,
@@ -653,6 +1008,26 @@ def operator_whois_country(self, column, operator, country):
            % (self.column, config.FLAGDB, config.FLAGDB, config.FLAGDB,
               config.FLAGDB, config.FLAGDB, country)
 
+## Caches the country of whois ids
+WHOIS_COUNTRIES = {}
+
+def whois_country(whois_id):
+    try:
+        return WHOIS_COUNTRIES[whois_id]
+    except KeyError:
+        dbh = DB.DBO()
+        dbh.execute("select country from whois where id=%r limit 1", whois_id)
+        row = dbh.fetch()
+        country = WHOIS_COUNTRIES[whois_id] = row and row['country']
+        return country
+
+def code_whois_country(self, column, operator, country):
+    """ Matches the whois country of the address using the whois index """
+    def f(row):
+        return whois_country(lookup_whois_id(None, row[self.column])) == country
+
+    return f
+
 def code_maxmind_isp_like(self, column, operator, isp):
     """ Returns true if column has an ISP which contains the word isp in it """
     def f(row):
@@ -897,16 +1272,25 @@ def geoip_render_html(self, value, table_renderer):
 def insert(self, value):
     ### When inserted we need to convert them from string to ints
     if config.PRECACHE_IPMETADATA==True:
-        lookup_whois(value)
+        ## We cache the whois data of many addresses at once:
+        PENDING_IPS[value] = 1
+        if len(PENDING_IPS) >= config.WHOIS_BATCH:
+            flush_pending_ips()
 
     return "_"+self.column, "inet_aton(%r)" % value.strip()
+
+def flush(self):
+    if PENDING_IPS:
+        flush_pending_ips()
     
 from pyflag.ColumnTypes import IPType, add_display_hook, clear_display_hook
 add_display_hook(IPType, "geoip_display_hook", geoip_display_hook,1)
 
 IPType.insert = insert
+IPType.flush = flush
 IPType.extended_csv = extended_csv
 IPType.operator_whois_country = operator_whois_country
+IPType.code_whois_country = code_whois_country
 IPType.code_maxmind_isp_like = code_maxmind_isp_like
 IPType.code_maxmind_isp = code_maxmind_isp
 IPType.operator_maxmind_isp = operator_maxmind_isp
@@ -37,7 +37,8 @@ import pyflag.DB as DB
 import pyflag.Scanner as Scanner
 import pyflag.ScannerUtils as ScannerUtils
 import pyflag.Registry as Registry
-import os,sys,time
+import os,sys,time,marshal
+import pyflag.Farm as Farm
 import reassembler
 from NetworkScanner import *
 import pypcap
@@ -124,6 +125,98 @@ class ConnectionDetailsTable(FlagFramework.CaseTable):
         [ StateType, dict(name='Type', column='type', states={'tcp':'tcp', 'udp':'udp'})]
         ]
         
+config.add_option("PCAP_LOAD_WORKERS", default=0, type='int',
+                  help="Number of processes reassembling streams when loading a pcap file (0 reassembles in the loader)")
+
+config.add_option("PCAP_JOB_DELAY", default=5, type='int',
+                  help="Maximum number of seconds the pcap loader holds back scan jobs for new streams")
+
+class ConnectionWriter:
+    """ Write-behind for the tables the reassembler fills.
+
+    The connection and connection_details rows are mass inserted, and
+    full buffers are written by a background thread while the loader
+    carries on reassembling. Scan jobs for new streams are held back
+    until the rows of their streams were handed to the writer - the
+    writer writes batches in order, so a scanner never sees a stream
+    before its packets.
+    """
+    def __init__(self, case):
+        self.writer = DB.MassInsertWriter(DB.DBO)
+        self.details = self.start(case, 'connection_details')
+        self.connection = self.start(case, 'connection')
+        self.jobs = self.start(None, 'jobs')
+        self.pending_jobs = []
+        self.last_jobs = time.time()
+
+        ## Counters for progress reporting
+        self.rows = 0
+        self.start_time = time.time()
+
+    def start(self, case, table):
+        dbh = DB.DBO(case)
+        dbh.mass_insert_start(table, _fast=True)
+        dbh.mass_insert_writer = self.writer
+        return dbh
+
+    def insert_details(self, **args):
+        self.rows += 1
+        self.details.mass_insert(**args)
+
+    def insert_connection(self, **args):
+        self.rows += 1
+        self.connection.mass_insert(**args)
+
+    def add_job(self, **args):
+        self.pending_jobs.append(args)
+        if len(self.pending_jobs) >= config.MASS_INSERT_THRESHOLD:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        """ Flushes jobs held back for more than PCAP_JOB_DELAY. The
+        loader calls this for every packet, so jobs go out even if no
+        more streams are completed.
+        """
+        if self.pending_jobs and time.time() - self.last_jobs > config.PCAP_JOB_DELAY:
+            self.flush()
+
+    def flush(self):
+        """ Hands everything buffered to the writer """
+        self.details.mass_insert_flush()
+        self.connection.mass_insert_flush()
+
+        ## The streams must be in the cache index before they are
+        ## scanned:
+        if self.pending_jobs:
+            CacheManager.MANAGER.flush()
+
+        for args in self.pending_jobs:
+            self.jobs.mass_insert(**args)
+
+        self.jobs.mass_insert_flush()
+        self.pending_jobs = []
+        self.last_jobs = time.time()
+
+    def close(self):
+        """ Writes everything out and waits for the writer """
+        try:
+            self.flush()
+        finally:
+            for dbh in (self.details, self.connection, self.jobs):
+                dbh.mass_insert_writer = None
+
+            self.writer.close()
+
+            ## Make the last streams visible even if no jobs were
+            ## scheduled for them:
+            CacheManager.MANAGER.flush()
+
+    def rate(self):
+        """ Returns rows written per second """
+        return self.rows / max(time.time() - self.start_time, 0.001)
+
 class PCAPFS(DBFS):
     """ This implements a simple filesystem for PCAP files.
     """
@@ -143,11 +236,14 @@ class PCAPFS(DBFS):
         ## We manage a number of tables here with mass insert:
         packet_handlers = [ x(self.case) for x in Registry.PACKET_HANDLERS.classes ]
         dbh = DB.DBO(self.case)
-        ## We do not want to use mass insert here to ensure that
-        ## scanning can begin immediately - this is useful when the
+
+        ## Connection rows and scan jobs are written behind our back,
+        ## but jobs are never held back for more than PCAP_JOB_DELAY
+        ## so scanning can begin soon - this is useful when the
         ## incremental_loader is used because small files may be
         ## processed.
-        pdbh = DB.DBO()
+        writer = ConnectionWriter(self.case)
+        inode_ids = FileSystem.InodeIDAllocator(self.case)
         cookie = int(time.time())
 
         if scanners:
@@ -167,18 +263,10 @@ class PCAPFS(DBFS):
 
                 ## Connection id have not been set yet:
                 if not connection.has_key('inode_id'):
-                    ## We insert a null value so we can get a valid
-                    ## autoincrement id.
-                    dbh.insert('inode', _inode_id='NULL', _fast=True)
-                    forward_inode_id = dbh.autoincrement()
-                    dbh.delete('inode', where='inode_id = %s' % forward_inode_id)
-
-                    dbh.insert('inode', _inode_id='NULL', _fast=True)
-                    reverse_inode_id = dbh.autoincrement()
-                    dbh.delete('inode', where='inode_id = %s' % reverse_inode_id)
-
-                    connection['inode_id'] = forward_inode_id;
-                    connection['reverse']['inode_id'] = reverse_inode_id;
+                    ## The inodes are only created when the stream
+                    ## is complete:
+                    connection['inode_id'] = inode_ids.next()
+                    connection['reverse']['inode_id'] = inode_ids.next()
 
                     date_str=time.strftime("%Y-%m-%d", time.gmtime(packet.ts_sec))
                     
@@ -204,15 +292,14 @@ class PCAPFS(DBFS):
                     dest_ip=ip.dest,
                     dest_port=tcp.dest,
                     _ts_sec="from_unixtime('%s')" % connection['mtime'],
-                    _fast = True)
+                    )
 
                 try:
                     args['isn']=tcp.seq
                 except KeyError:
                     pass
 
-                dbh.insert('connection_details',
-                           **args)
+                writer.insert_details(**args)
 
                 ## This is where we write the data out
                 connection['data'] = CacheManager.MANAGER.create_cache_fd(
@@ -239,7 +326,6 @@ class PCAPFS(DBFS):
                     packet_id = packet.id,
                     cache_offset = fd.offset,
                     length = datalen,
-                    _fast=True
                     )
 
                 try:
@@ -247,7 +333,7 @@ class PCAPFS(DBFS):
                 except KeyError:
                     args['seq'] = 0
                 
-                dbh.insert("connection", **args)
+                writer.insert_connection(**args)
                 
                 if data: fd.write(data)
 
@@ -255,7 +341,7 @@ class PCAPFS(DBFS):
                 ## Find the mtime of the first packet in the stream:
                 try:
                     fd = connection['data']
-                    fd.write_to_file()
+                    fd.close()
 
                     if fd.offset > 0:
                         ## Create a new VFS node:
@@ -272,19 +358,20 @@ class PCAPFS(DBFS):
                             )
                         
                         if scanners:
-                            pdbh.insert("jobs",
+                            writer.add_job(
                                 command = 'Scan',
                                 arg1 = self.case,
                                 arg2 = new_inode,
                                 arg3= scanner_string,
                                 cookie=cookie,
+                                cost = fd.offset,
                                 )
 
                 except KeyError: pass
 
                 try:
                     fd = connection['reverse']['data']
-                    fd.write_to_file()
+                    fd.close()
 
                     if fd.offset > 0:
                         ## Create a new VFS node:
@@ -301,12 +388,13 @@ class PCAPFS(DBFS):
                             )
 
                         if scanners:
-                            pdbh.insert("jobs",
+                            writer.add_job(
                                 command = 'Scan',
                                 arg1 = self.case,
                                 arg2 = new_inode,
                                 arg3= scanner_string,
                                 cookie=cookie,
+                                cost = fd.offset,
                                 )
 
                 except KeyError: pass
@@ -323,6 +411,7 @@ class PCAPFS(DBFS):
                 
         ## Create a new reassembler with this callback
         processor = reassembler.Reassembler(packet_callback = Callback)
+        self.writer = writer
         return cookie, processor
 
     def load(self, mount_point, iosource_name,scanners = None):
@@ -341,47 +430,22 @@ class PCAPFS(DBFS):
 
         pcap_dbh.execute("select max(id) as m from pcap")
         max_id = pcap_dbh.fetch()['m'] or 0
-        cookie, processor = self.make_processor(iosource_name, scanners)
 
-        ## Process the file with it:
-        while 1:
+        if config.PCAP_LOAD_WORKERS > 1 and hasattr(os, 'fork'):
+            self.load_parallel(pcap_file, pcap_dbh, iosource_name, scanners, max_id)
+        else:
+            cookie, processor = self.make_processor(iosource_name, scanners)
             try:
-                packet = pcap_file.dissect()
-                max_id += 1
+                for packet in self.read_packets(pcap_file, pcap_dbh, iosource_name, max_id):
+                    processor.process(packet)
+                    self.writer.tick()
 
-                ## FIXME - this is a bottleneck. For now we use mass
-                ## insert but this will break when we have multiple
-                ## concurrent loaders.  Record the packet in the pcap
-                ## table:
-                args = dict(
-                    iosource = iosource_name,
-                    offset = packet.offset,
-                    length = packet.caplen,
-                    _ts_sec =  "from_unixtime('%s')" % packet.ts_sec,
-                    ts_usec = packet.ts_usec,
-                    )
-
-                ## Try to insert the ipid field
-                try:
-                    args['ipid']= packet.root.eth.payload.id
-                except: pass
-
-                pcap_dbh.mass_insert(**args)
-                #pcap_id = pcap_dbh.autoincrement()
-                pcap_id = max_id
-                pcap_file.set_id(pcap_id)
-
-                
-                ## Some progress reporting
-                if pcap_id % 10000 == 0:
-                    pyflaglog.log(pyflaglog.DEBUG, "processed %s packets (%s bytes)" % (pcap_id, packet.offset))
-
-                processor.process(packet)
-            except StopIteration:
-                break
-
-        processor.flush()
+                processor.flush()
+            finally:
+                ## Make sure all the connection rows and jobs are written:
+                self.writer.close()
 
+        pcap_dbh.mass_insert_commit()
         pcap_dbh.check_index("connection_details",'src_ip')
         pcap_dbh.check_index("connection_details",'src_port')
         pcap_dbh.check_index("connection_details",'dest_ip')
@@ -392,6 +456,215 @@ class PCAPFS(DBFS):
         ##pcap_dbh.delete("connection_details",
         ##                where = "inode is null")
 
+    def read_packets(self, pcap_file, pcap_dbh, iosource_name, max_id):
+        """ A generator over the dissected packets in pcap_file.
+
+        Each packet is recorded in the pcap table and given the id of
+        its row (ids follow on from max_id).
+        """
+        start_time = time.time()
+        start_id = max_id
+
+        while 1:
+            try:
+                packet = pcap_file.dissect()
+            except StopIteration:
+                break
+
+            max_id += 1
+
+            ## FIXME - this is a bottleneck. For now we use mass
+            ## insert but this will break when we have multiple
+            ## concurrent loaders.  Record the packet in the pcap
+            ## table:
+            args = dict(
+                iosource = iosource_name,
+                offset = packet.offset,
+                length = packet.caplen,
+                _ts_sec =  "from_unixtime('%s')" % packet.ts_sec,
+                ts_usec = packet.ts_usec,
+                )
+
+            ## Try to insert the ipid field
+            try:
+                args['ipid']= packet.root.eth.payload.id
+            except: pass
+
+            pcap_dbh.mass_insert(**args)
+            #pcap_id = pcap_dbh.autoincrement()
+            pcap_id = max_id
+            pcap_file.set_id(pcap_id)
+
+            ## Some progress reporting
+            if pcap_id % 10000 == 0:
+                elapsed = max(time.time() - start_time, 0.001)
+                message = "processed %s packets (%s bytes) - %d packets/s" % (
+                    pcap_id, packet.offset, (pcap_id - start_id) / elapsed)
+                if self.writer:
+                    message += ", %d connection rows/s" % self.writer.rate()
+
+                pyflaglog.log(pyflaglog.DEBUG, message)
+
+            yield packet
+
+    ## The ConnectionWriter of the reassembler in this process
+    writer = None
+
+    def load_parallel(self, pcap_file, pcap_dbh, iosource_name, scanners, max_id):
+        """ Reassembles the streams in PCAP_LOAD_WORKERS processes.
+
+        We read and dissect the capture and record the packets in the
+        pcap table as usual, so packet ids are allocated exactly as in
+        a serial load. Each packet is then handed to a worker chosen
+        by a symmetric hash of its flow, so both directions of a
+        connection end up in the same reassembler. Workers reserve
+        stream inode_ids from the shared allocator so they never
+        clash.
+
+        Workers read the capture themselves - we only send them the
+        indexes of their packets, and they skip the others without
+        dissecting them.
+
+        Note that only reassembly runs in parallel: this process still
+        dissects every packet to hash it and record it in the pcap
+        table, and every worker reads the whole capture. Loads which
+        are bound by dissection or IO do not get faster with more
+        workers.
+
+        If a worker fails its streams are incomplete, so the load
+        fails with a RuntimeError.
+        """
+        workers = config.PCAP_LOAD_WORKERS
+        pipes = [ os.pipe() for i in range(workers) ]
+        pids = []
+        for i in range(workers):
+            pid = os.fork()
+            if not pid:
+                ## The child only keeps the read end of its own pipe:
+                for j in range(workers):
+                    os.close(pipes[j][1])
+                    if j != i: os.close(pipes[j][0])
+
+                try:
+                    self.reassemble_shard(iosource_name, scanners, max_id + 1,
+                                          os.fdopen(pipes[i][0], 'rb'))
+
+                    ## os._exit() skips the atexit commit:
+                    CacheManager.MANAGER.flush()
+                except Exception, e:
+                    pyflaglog.log(pyflaglog.ERRORS, "PCAP worker %s failed: %s" % (i, e))
+                    os._exit(1)
+
+                os._exit(0)
+
+            pids.append(pid)
+
+        outputs = []
+        for r, w in pipes:
+            os.close(r)
+            outputs.append(os.fdopen(w, 'wb'))
+
+        batches = [ [] for i in range(workers) ]
+        try:
+            index = 0
+            for packet in self.read_packets(pcap_file, pcap_dbh, iosource_name, max_id):
+                shard = flow_hash(packet) % workers
+                batch = batches[shard]
+                batch.append(index)
+                index += 1
+
+                if len(batch) >= 1000:
+                    marshal.dump(batch, outputs[shard])
+                    outputs[shard].flush()
+                    batches[shard] = []
+        finally:
+            for i in range(workers):
+                try:
+                    if batches[i]:
+                        marshal.dump(batches[i], outputs[i])
+                    marshal.dump(None, outputs[i])
+                    outputs[i].close()
+                except IOError, e:
+                    pyflaglog.log(pyflaglog.ERRORS, "PCAP worker %s went away: %s" % (i, e))
+
+            failed = []
+            for pid in pids:
+                pid, status = os.waitpid(pid, 0)
+                if status:
+                    pyflaglog.log(pyflaglog.ERRORS, "PCAP worker %s exited with status %s" % (pid, status))
+                    failed.append(pid)
+
+        if failed:
+            raise RuntimeError("PCAP workers %s failed - the streams of %s are incomplete" % (
+                ",".join(map(str, failed)), iosource_name))
+
+        self.merge_shards()
+
+    def reassemble_shard(self, iosource_name, scanners, first_id, messages):
+        """ Runs in a worker process: reassembles the packets whose
+        indexes load_parallel() sends us.
+        """
+        Farm.forget_db_handles()
+        IO.IO_Cache.flush()
+
+        pcap_file = pypcap.PyPCAP(IO.open(self.case, iosource_name))
+        cookie, processor = self.make_processor(iosource_name, scanners)
+        index = 0
+        try:
+            while 1:
+                batch = marshal.load(messages)
+                if batch is None: break
+
+                for target in batch:
+                    ## Skip other workers' packets:
+                    while index < target:
+                        pcap_file.next()
+                        index += 1
+
+                    packet = pcap_file.dissect(target)
+                    pcap_file.set_id(first_id + target)
+                    index += 1
+                    processor.process(packet)
+                    self.writer.tick()
+
+            processor.flush()
+        finally:
+            self.writer.close()
+
+    def merge_shards(self):
+        """ Tidies up after the workers of load_parallel().
+
+        Workers create the directories of their streams concurrently,
+        so the same directory may have been created more than once.
+        """
+        dbh = DB.DBO(self.case)
+        dbh.execute("select path, name, count(*) as count from file where mode='d/d' and "
+                    "inode='' and path like %r group by path, name having count > 1",
+                    self.mount_point.rstrip("/") + "/%")
+        for row in [ row for row in dbh ]:
+            dbh.execute("delete from file where mode='d/d' and inode='' and path=%r and name=%r limit %s",
+                        (row['path'], row['name'], row['count'] - 1))
+
+def flow_hash(packet):
+    """ Returns a hash of the flow of the packet, which is the same
+    for both directions of the flow.
+
+    We only hash the addresses and the protocol. Ports are not used
+    because IP fragments after the first have none, and they must
+    go to the same worker as the first fragment.
+    """
+    try:
+        ip = packet.find_type("IP")
+        src, dest, protocol = ip.src, ip.dest, ip.protocol
+    except Exception:
+        ## Not IP - all of these go to the same worker
+        return 0
+
+    if src > dest:
+        src, dest = dest, src
+
+    return hash((src, dest, protocol)) & 0x7fffffff
+
 import pyflag.Magic as Magic
 
 class PCAPMagic(Magic.Magic):
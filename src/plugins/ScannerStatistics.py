@@ -0,0 +1,101 @@
+# ******************************************************
+# Michael Cohen <scudette@users.sourceforge.net>
+#
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Reports on the cost of each scanner.
+
+Scanner.scanfile() records the time spent by each scanner in its
+process, slack and finish methods, the bytes it was given and the
+database work it did. These are written to the scanner_stats table
+periodically by each worker (see Scanner.ScannerStatistics). The
+costs of a container scanner do not include scanning the files it
+finds - those are counted for their own scanners.
+"""
+import pyflag.Reports as Reports
+import pyflag.FlagFramework as FlagFramework
+import pyflag.DB as DB
+import pyflag.Scanner as Scanner
+import pyflag.pyflaglog as pyflaglog
+from pyflag.ColumnTypes import StringType, BigIntegerType
+
+class ScannerStatsTable(FlagFramework.CaseTable):
+    """ Scanner statistics - one row per worker flush """
+    name = 'scanner_stats'
+    columns = [ [ StringType, dict(name = 'Scanner', column = 'scanner', width=50) ],
+                [ StringType, dict(name = 'Type', column = 'type', width=100) ],
+                ] + [ [ BigIntegerType, dict(name = field, column = field) ]
+                      for field in Scanner.STATISTICS_FIELDS ]
+    index = [ 'scanner' ]
+    modes = {}
+
+def summarise(case, group_by = 'scanner'):
+    """ Returns the scanner statistics of case totalled by group_by
+    (a comma separated list of columns), most expensive first.
+    """
+    dbh = DB.DBO(case)
+    totals = ",".join([ "sum(`%s`) as `%s`" % (f,f) for f in Scanner.STATISTICS_FIELDS ])
+    try:
+        dbh.execute("select %s, %s from scanner_stats group by %s "
+                    "order by sum(process_ms + slack_ms + finish_ms) desc",
+                    (group_by, totals, group_by))
+    except DB.DBError, e:
+        pyflaglog.log(pyflaglog.DEBUG, "No scanner statistics in case %s: %s" % (case, e))
+        return []
+
+    result = []
+    for row in dbh:
+        ## Sums come back as decimal strings:
+        for f in Scanner.STATISTICS_FIELDS:
+            row[f] = int(row[f] or 0)
+        result.append(row)
+
+    return result
+
+class ScannerStatistics(Reports.report):
+    """ Show how much time and database work each scanner cost """
+    parameters = {}
+    family = "Case Management"
+    name = "Scanner Statistics"
+
+    def display(self, query, result):
+        result.heading("Scanner Statistics")
+        ## Write out whatever we have accumulated in this process:
+        Scanner.SCANNER_STATISTICS.flush()
+
+        def render(group_by, headings):
+            result.start_table()
+            result.row(*(headings + ["Files", "MB", "Process s", "Slack s", "Finish s",
+                                     "CPU s", "Statements", "Rows"]),
+                       **{'type':'heading'})
+            for row in summarise(query['case'], group_by):
+                cpu = row['process_cpu_ms'] + row['slack_cpu_ms'] + row['finish_cpu_ms']
+                result.row(*([ row[h] for h in group_by.split(",") ] +
+                             [ row['files'], "%0.1f" % (row['bytes'] / 1e6),
+                               "%0.1f" % (row['process_ms'] / 1e3),
+                               "%0.1f" % (row['slack_ms'] / 1e3),
+                               "%0.1f" % (row['finish_ms'] / 1e3),
+                               "%0.1f" % (cpu / 1e3),
+                               row['statements'], row['rows_inserted'] ]))
+            result.end_table()
+
+        result.para("Totals per scanner")
+        render("scanner", ["Scanner"])
+        result.para("Totals per scanner and file type")
+        render("scanner,type", ["Scanner", "Type"])
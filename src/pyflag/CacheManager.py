@@ -22,15 +22,36 @@ filesystem locks (unless the filesystem locks are shared across the
 network properly say over SMB). Database locks are probably the best
 method of synchronization.
 
+Small cache objects are consolidated into segment files (see
+CacheStore). Each process appends to its own segments, so appending
+needs no locks at all. The cachefile table records where each object
+lives. It is loaded into memory once per process, so opening a cached
+object needs no database query, and reads are served from mmaps of
+the segments without opening a file per object.
 """
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 import cStringIO, os, os.path
+import mmap, socket, threading, time, atexit, re
 import pyflag.DB as DB
+import pyflag.IO as IO
+import pyflag.pyflaglog as pyflaglog
 
 config.add_option("CACHE_FILENAME", default="__cache__.bin",
                   help = 'Name of consolidated cache file')
 
+config.add_option("CACHE_MERGE_LIMIT", default=10*1024*1024, type='int',
+                  help = 'Cache objects smaller than this are consolidated into the cache segments')
+
+config.add_option("CACHE_SEGMENT_SIZE", default=512*1024*1024, type='int',
+                  help = 'Size at which a process starts a new cache segment')
+
+config.add_option("CACHE_INDEX_BATCH", default=500, type='int',
+                  help = 'Number of new cache objects recorded in the cachefile table at once')
+
+config.add_option("CACHE_INDEX_DELAY", default=2, type='int',
+                  help = 'Maximum number of seconds new cache objects remain unrecorded in the cachefile table')
+
 def make_cache_filename(case, name):
     ## Sometimes we get given a filename in the cache folder already -
     ## this is probably a bug but we handle it anyway.
@@ -45,43 +66,270 @@ def make_cache_filename(case, name):
 def check_table(case):
     dbh = DB.DBO(case)
     dbh.execute("""create table if not exists cachefile (
+    id int not null auto_increment,
     inode_id int not null default 0,
     filename VARCHAR(2000),
+    segment VARCHAR(250) default NULL,
     offset bigint,
     length bigint,
+    primary key (`id`),
     key (`inode_id`))""")
 
-class CacheFile:
-    def __init__(self, case, filename=None, inode_id=None):
+    ## Tables created by older versions have all their objects in
+    ## CACHE_FILENAME:
+    DB.check_column_in_table(case, 'cachefile', 'segment', 'VARCHAR(250) default NULL')
+    DB.check_column_in_table(case, 'cachefile', 'id', 'int not null auto_increment primary key')
+    dbh.check_index('cachefile','filename',100)
+
+class CacheIndex:
+    """ The in memory copy of the cachefile table of a case """
+    def __init__(self):
+        ## filename/inode_id -> (segment, offset, length)
+        self.filenames = {}
+        self.inode_ids = {}
+        self.last_id = 0
+
+class CacheStore:
+    """ A compound store for small cache objects.
+
+    Objects are appended to segment files. Segments are only ever
+    appended to by the process that created them (their names include
+    the host and pid), and are rolled over once they reach
+    CACHE_SEGMENT_SIZE.
+
+    Where each object lives is kept in an in memory index, which is
+    loaded from the cachefile table the first time a case is used, and
+    brought up to date whenever we miss. New objects are added to the
+    index immediately, but written to the cachefile table in batches
+    of CACHE_INDEX_BATCH (or after CACHE_INDEX_DELAY seconds, or when
+    commit() is called). Processes which hand objects to other
+    processes (e.g. by scheduling a scan job) must commit() first.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indexes = {}
+        ## case -> [pid, segment, fd, offset]
+        self.writers = {}
+        ## case -> [ rows for the cachefile table ]
+        self.pending = {}
+        self.first_pending = None
+        ## path -> mmap
+        self.maps = {}
+        self.count = 0
+        self.pid = os.getpid()
+
+    def check_fork(self):
+        """ A forked child must not record the objects its parent stored """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = {}
+            self.first_pending = None
+
+    def index(self, case):
+        try:
+            return self.indexes[case]
+        except KeyError:
+            pass
+
+        check_table(case)
+        index = self.indexes[case] = CacheIndex()
+        self.refresh(case)
+        return index
+
+    def refresh(self, case):
+        """ Adds objects recorded since we last looked to our index """
+        index = self.index(case)
         dbh = DB.DBO(case)
+        dbh.execute("select id, inode_id, filename, segment, offset, length "
+                    "from cachefile where id > %r order by id", index.last_id)
+        for row in dbh:
+            entry = (row['segment'] or config.CACHE_FILENAME, row['offset'], row['length'])
+            ## The first object recorded under a name wins:
+            index.filenames.setdefault(row['filename'], entry)
+            if row['inode_id']:
+                index.inode_ids.setdefault(row['inode_id'], entry)
+
+            index.last_id = row['id']
+
+    def lookup(self, case, filename=None, inode_id=None, refresh=True):
+        """ Returns (segment, offset, length) of the object or None.
+
+        If refresh is set and we do not know about the object, we check
+        if another process stored it since we last looked.
+        """
+        self.lock.acquire()
+        try:
+            index = self.index(case)
+            for i in range(2):
+                if inode_id:
+                    entry = index.inode_ids.get(inode_id)
+                else:
+                    entry = index.filenames.get(filename)
+
+                if entry or not refresh: return entry
+
+                if i==0: self.refresh(case)
+        finally:
+            self.lock.release()
+
+    def writer(self, case):
+        """ Returns our current segment for case """
+        try:
+            writer = self.writers[case]
+            ## Segments belong to a single process - we may have
+            ## been forked:
+            if writer[0] == os.getpid() and writer[3] < config.CACHE_SEGMENT_SIZE:
+                return writer
+
+            if writer[0] == os.getpid():
+                writer[2].close()
+        except KeyError:
+            pass
+
+        self.count += 1
+        segment = "%s.%s.%s.%s" % (config.CACHE_FILENAME, socket.gethostname(),
+                                   os.getpid(), self.count)
+        fd = open(make_cache_filename(case, segment), "ab")
+        fd.seek(0,2)
+        writer = self.writers[case] = [os.getpid(), segment, fd, fd.tell()]
+        return writer
+
+    def append(self, case, filename, infd, inode_id=None):
+        """ Stores the data read from infd as the object filename.
+
+        Returns the length of the object.
+        """
+        self.lock.acquire()
         try:
+            self.check_fork()
+            index = self.index(case)
+            writer = self.writer(case)
+            offset = writer[3]
+            length = 0
+            while 1:
+                data = infd.read(1024*1024)
+                if not data: break
+
+                writer[2].write(data)
+                length += len(data)
+
+            ## The data must be visible to readers before the object is:
+            writer[2].flush()
+            writer[3] += length
+
+            entry = (writer[1], offset, length)
+            index.filenames[filename] = entry
             if inode_id:
-                dbh.execute("select * from cachefile where inode_id=%r", inode_id)
-            else:
-                dbh.check_index('cachefile','filename',100)
-                dbh.execute("select * from cachefile where filename=%r", filename)
-
-            row = dbh.fetch()
-        except DB.DBError:
-            check_table(case)
-            row = None
-            
-        self.offset = 0
-        if row:
-            self.cache_offset = row['offset']
-            self.size = row['length']
-            cache_path = make_cache_filename(case, config.CACHE_FILENAME)
+                index.inode_ids[inode_id] = entry
+
+            row = dict(filename = filename, segment = writer[1],
+                       offset = offset, length = length)
+            if inode_id:
+                row['inode_id'] = inode_id
+
+            self.pending.setdefault(case, []).append(row)
+            if not self.first_pending:
+                self.first_pending = time.time()
+
+            if len(self.pending[case]) >= config.CACHE_INDEX_BATCH or \
+                   time.time() - self.first_pending > config.CACHE_INDEX_DELAY:
+                self.commit()
+
+            return length
+        finally:
+            self.lock.release()
+
+    def commit(self):
+        """ Records all new objects in the cachefile tables """
+        self.lock.acquire()
+        try:
+            self.check_fork()
+            pending = self.pending
+            self.pending = {}
+            self.first_pending = None
+
+            for case, rows in pending.items():
+                try:
+                    dbh = DB.DBO(case)
+                    dbh.mass_insert_start('cachefile')
+                    for row in rows:
+                        dbh.mass_insert(**row)
+                    dbh.mass_insert_commit()
+                except DB.DBError, e:
+                    pyflaglog.log(pyflaglog.ERRORS, "Unable to record cache objects in case %s: %s" % (case, e))
+        finally:
+            self.lock.release()
+
+    def read(self, case, segment, offset, length):
+        """ Reads from a segment """
+        if length <= 0: return ''
+
+        path = make_cache_filename(case, segment)
+        self.lock.acquire()
+        try:
+            m = self.maps.get(path)
+            if m is None or len(m) < offset + length:
+                if m is not None: m.close()
+
+                fd = open(path, "rb")
+                try:
+                    try:
+                        m = self.maps[path] = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (EnvironmentError, ValueError, OverflowError), e:
+                        ## We can not map this file (e.g. its too large
+                        ## for our address space):
+                        self.maps.pop(path, None)
+                        return IO.FD_POOL.read(path, offset, length)
+                finally:
+                    fd.close()
+
+            return m[offset:offset+length]
+        finally:
+            self.lock.release()
+
+    def reset(self, case):
+        """ Forgets everything about case """
+        self.lock.acquire()
+        try:
+            self.indexes.pop(case, None)
+            self.pending.pop(case, None)
+            writer = self.writers.pop(case, None)
+            if writer and writer[0] == os.getpid():
+                writer[2].close()
+
+            prefix = make_cache_filename(case, '')
+            for path in self.maps.keys():
+                if path.startswith(prefix):
+                    self.maps.pop(path).close()
+
+            IO.FD_POOL.expire("^" + re.escape(prefix))
+        finally:
+            self.lock.release()
+
+STORE = CacheStore()
+
+## Make sure the objects we stored are recorded when we exit:
+atexit.register(STORE.commit)
+
+class CacheFile:
+    def __init__(self, case, filename=None, inode_id=None):
+        ## Objects which are too large for the store have their own
+        ## file, so we only go to the database if there is none:
+        entry = STORE.lookup(case, filename, inode_id, refresh=False)
+        if not entry and not (filename and os.access(make_cache_filename(case, filename), os.F_OK)):
+            entry = STORE.lookup(case, filename, inode_id)
 
-            self.fd = open(cache_path,"rb")
-            self.fd.seek(self.cache_offset)
+        self.case = case
+        self.offset = 0
+        if entry:
+            self.segment, self.cache_offset, self.size = entry
+            self.fd = None
         else:
             self.cache_offset = 0
             cache_path = make_cache_filename(case, filename)
 
-            self.fd = open(cache_path,'rb')
-            self.fd.seek(0,2)
-            self.size = self.fd.tell()
-            self.fd.seek(0,0)
+            self.fd = IO.FD_POOL.open(cache_path)
+            self.size = self.fd.size
             self.name = cache_path
 
     def tell(self):
@@ -91,8 +339,12 @@ class CacheFile:
         if length==None:
             length = 1e9
             
-        to_read = min(self.size - self.offset, length)
-        data = self.fd.read(to_read)
+        to_read = int(min(self.size - self.offset, length))
+        if self.fd:
+            data = self.fd.read(to_read)
+        else:
+            data = STORE.read(self.case, self.segment, self.cache_offset + self.offset, to_read)
+
         self.offset += len(data)
         return data
 
@@ -110,10 +362,12 @@ class CacheFile:
         if self.offset<0:
             self.offset=0
 
-        self.fd.seek(self.offset + self.cache_offset)
+        if self.fd:
+            self.fd.seek(self.offset + self.cache_offset)
 
     def close(self):
-        self.fd.close()
+        if self.fd:
+            self.fd.close()
 
 class TemporaryCacheFile:
     def __init__(self, case, filename, inode_id=None, mode='wb'):
@@ -142,64 +396,35 @@ class TemporaryCacheFile:
             self.close()
 
     def close(self):
-        """ When we close the file we copy it into the big cache file """
+        """ When we close the file we copy it into the cache store """
         ## Do not merge large files into the cache (its not efficient anyway)
-        if self.fd.tell() > 10e6:
+        if self.fd.tell() > config.CACHE_MERGE_LIMIT:
             self.fd.close()
             self.closed=True
             return
         
-        dbh = DB.DBO(self.case)
-        try:
-            dbh.execute("lock table cachefile write")
-        except DB.DBError:
-            check_table(self.case)
-            dbh.execute("lock table cachefile write")
+        name = self.fd.name
+        self.fd.close()
+        self.closed = True
 
+        ## The file sometimes disappears because another thread
+        ## has merged it already
         try:
-            name = self.fd.name
-            self.fd.close()
-            ## The file sometimes disappears because another thread
-            ## has merged it already
-            try:
-                fd = open(name, "rb")
-            except: return
-
-            cache_path = make_cache_filename(self.case, config.CACHE_FILENAME)
-
-            outfd = open(cache_path,"ab")
-            outfd.seek(0,2)
-
-            ## Get the offset at the end
-            offset = outfd.tell()
-            length = 0
+            fd = open(name, "rb")
+        except: return
 
-            while 1:
-                data = fd.read(1024*1024)
-                if len(data)==0:
-                    break
-
-                outfd.write(data)
-                length += len(data)
-
-            outfd.close()
-            args = dict(offset = offset, length = length,
-                        filename = os.path.basename(self.filename),)
-
-            if self.inode_id:
-                args['inode_id'] = self.inode_id
-
-            dbh.insert('cachefile',**args)
-
-            ## Remove the file (This might fail on windows because
-            ## someone has it open)
-            try:
-                os.unlink(name)
-            except: pass
-            
-            self.closed = True
+        try:
+            STORE.append(self.case, os.path.basename(self.filename), fd,
+                         inode_id = self.inode_id)
         finally:
-            dbh.execute("unlock tables")
+            fd.close()
+
+        ## Remove the file (This might fail on windows because
+        ## someone has it open)
+        IO.FD_POOL.forget(name)
+        try:
+            os.unlink(name)
+        except: pass
             
 class CachedWriter:
     """ A class which caches data in memory and then flushes to disk
@@ -216,6 +441,8 @@ class CachedWriter:
         self.offset = 0
         self.case = case
         self.inode_id = inode_id
+        self.on_disk = False
+        self.closed = False
 
     def write_to_file(self):
         ## Only write if we have data - so 0 length files will never
@@ -226,6 +453,7 @@ class CachedWriter:
             fd.write(data)
             fd.close()
             self.fd.truncate(0)
+            self.on_disk = True
         
     def write(self, data):
         self.fd.write(data)
@@ -235,6 +463,17 @@ class CachedWriter:
             self.write_to_file()
             
     def close(self):
+        if self.closed: return
+        self.closed = True
+
+        ## Small objects go straight from memory into the store:
+        if not self.on_disk:
+            if self.offset > 0:
+                self.fd.seek(0)
+                STORE.append(self.case, os.path.basename(self.barename), self.fd,
+                             inode_id = self.inode_id)
+            return
+
         self.write_to_file()
 
         ## Make sure that we copy the file to the main cache file:
@@ -249,6 +488,13 @@ class CachedWriter:
 class DirectoryCacheManager:
     """ This is a basic cache manager.
     """
+    def flush(self):
+        """ Makes the objects we created visible to other processes """
+        STORE.commit()
+
+    def reset(self, case):
+        STORE.reset(case)
+
     def get_temp_path(self, case, inode):
         for c in "/|:":
             inode = inode.replace(c,'_')
@@ -337,6 +583,7 @@ class DirectoryCacheManager:
             case,
             self.get_temp_path(case, inode))
 
+        IO.FD_POOL.forget(filename)
         outfd = open(filename,"wb")
         import pyflag.FileSystem as FileSystem
 
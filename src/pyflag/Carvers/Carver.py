@@ -20,7 +20,8 @@
 # * along with this program; if not, write to the Free Software
 # * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 # ******************************************************
-import sys, re, os, pickle
+import sys, re, os, pickle, struct, mmap, array, marshal
+import index
 
 """ This class abstracts the reassembled file 
 
@@ -178,6 +179,7 @@ given to those mapping functions with less discontinuities.
 This file implements classes which make this simpler.
 """
 import bisect
+from format import RunMap
 
 class Reassembler:
     """ This class presents a file like object for interpolating
@@ -202,19 +204,22 @@ class Reassembler:
         ## This is a comment attached to each file_pos identified.        
         self.comments = {}
 
+        ## The mapping function as runs - built when needed
+        self.run_map = None
+
     def del_point(self, file_pos):
         """ Remove the point at file_pos if it exists """
-        idx = self.points.index(file_pos)
+        idx = bisect.bisect_left(self.points, file_pos)
         try:
             del self.mapping[file_pos]
             self.points.pop(idx)
+            self.run_map = None
         except: pass
 
     def add_point(self, file_pos, image_pos, comment=None):
         """ Adds a new point to the mapping function. Points may be
         added in any order.
         """
-        bisect.insort_left(self.points, file_pos)
         ## We already have this position in here - we need to decide
         ## if this is a better value. Its not a hard and fast rule,
         ## but generally if the current position is not too far away
@@ -225,9 +230,12 @@ class Reassembler:
             expected, left = self.interpolate(file_pos-1)
             if abs(image_pos - expected) > abs(self.mapping[file_pos] - expected):
                 return
+        else:
+            bisect.insort_left(self.points, file_pos)
             
         self.mapping[file_pos] = image_pos
         self.comments[file_pos] = comment
+        self.run_map = None
         
     def seek(self, offset, whence=0):
         if whence==0:
@@ -255,13 +263,15 @@ class Reassembler:
         elif file_offset > self.points[-1]:
             direction_forward = True
 
+        r = bisect.bisect_right(self.points, file_offset)
+
         ## If we are asked to interpolate an identified point its
         ## always the same as itself.
-        if file_offset in self.points:
+        if r and self.points[r-1] == file_offset:
             return self.mapping[file_offset], 1
 
         elif direction_forward:
-            l = bisect.bisect_right(self.points, file_offset)-1
+            l = r-1
             try:
                 left = self.points[l+1] - file_offset
             except:
@@ -270,35 +280,65 @@ class Reassembler:
             #print "Forward interpolation %s %s %s" % (self.points[l],file_offset,self.points[l+1])
             return self.mapping[self.points[l]]+file_offset - self.points[l], left
         else:
-            r = bisect.bisect_right(self.points, file_offset)
             #print "Reverse interpolation %s %s %s" % (self.points[r],file_offset, r)
             return self.mapping[self.points[r]] - (self.points[r] - file_offset), self.points[r] - file_offset
 
     def tell(self):
         return self.readptr
 
-    def read(self, length):
-        result = ''
-        while length>0:
-            try:
-                m, left = self.interpolate(self.readptr)
-                self.fd.seek(m,0)
-            except:
-                left = 1000
+    def runs(self, end=None):
+        """ Returns the mapping function up to the file offset end as a
+        RunMap over our fd.
 
-            want_to_read = min(left, length)
+        By default the last run carries on past the last point, like
+        the forward interpolation. Parts of the file which would come
+        from before the start of the image are left as gaps.
+        """
+        if end is None and self.run_map:
+            return self.run_map
 
-            assert(want_to_read > 0)
-            data = self.fd.read(want_to_read)
-            if not data: break
+        run_map = RunMap(self.fd)
+        if not self.points: return run_map
 
-            self.readptr += min(left, length)
-            result += data
-            length -= len(data)
+        offset = 0
+        limit = end or self.points[-1] + 1
+        while offset < limit:
+            image_offset, left = self.interpolate(offset)
+            left = min(left, limit - offset)
+            if image_offset < 0:
+                skip = min(-image_offset, left)
+                offset += skip
+                image_offset += skip
+                left -= skip
+
+            if left > 0:
+                run_map.add_run(offset, image_offset, left)
+                offset += left
+
+        if end is None:
+            ## Keep reading past the last point:
+            image_offset, left = self.interpolate(limit, True)
+            run_map.add_run(limit, image_offset, sys.maxint)
+            self.run_map = run_map
+
+        return run_map
+
+    def image_runs(self):
+        """ Returns the (image offset, length) of the runs making up
+        the file.
+        """
+        run_map = self.runs(self.size())
+        return zip(run_map.offsets, run_map.lengths)
+
+    def read(self, length):
+        run_map = self.runs()
+        run_map.seek(self.readptr)
+        result = run_map.read(length)
+        self.readptr += len(result)
 
         return result
 
-    def save_map(self, fd):
+    def save_map(self, fd, binary=False):
         """ Saves the map onto the fd 
         The format of the map file is as follows:
 
@@ -310,20 +350,47 @@ class Reassembler:
         
         The idea is that different map files may be coalesced together by
         simply using 'cat'.
+
+        Binary maps hold the runs of the file (see format.RunMap)
+        instead. They are smaller and faster to load but can not be
+        coalesced or commented.
         """
         try:
             ## Does it have a write method?
             fd.write
         except AttributeError:
             ## It might be a string
-            fd = open(fd, 'w')
+            fd = open(fd, 'wb')
+
+        if binary:
+            self.runs(self.size()).save(fd)
+            return
         
         for x in self.points:
             fd.write("%s %s %s\n" % (x, self.mapping[x], self.comments[x]))
 
     def load_map(self, mapfile):
         """ Opens the mapfile and loads the points from it """
-        fd = open(mapfile)
+        fd = open(mapfile, 'rb')
+        if fd.read(len(RunMap.magic)) == RunMap.magic:
+            fd.seek(0)
+            run_map = RunMap(None)
+            run_map.load(fd)
+            end = 0
+            for file_offset, image_offset, length in run_map.runs():
+                ## Gaps come from before the start of the image:
+                if file_offset > end:
+                    self.add_point(end, end - file_offset, comment="Gap")
+
+                self.add_point(file_offset, image_offset, comment="Run")
+                end = file_offset + length
+
+            if run_map.starts:
+                self.add_point(run_map.size(), run_map.offsets[-1] + run_map.lengths[-1],
+                               comment="EOF")
+            return
+
+        fd.seek(0)
         for line in fd:
             line = line.strip()
             if line.startswith("#"): continue
@@ -402,8 +469,280 @@ class Reassembler:
         for p in c.points:
             self.add_point(p, c.mapping[p], c.comments[p])
 
+class CandidateScheduler:
+    """ Tests hypotheses about the mapping function in parallel.
+
+    Each candidate is a tuple of arguments to a test function, which
+    returns a score (usually an error count - lower is better) or
+    raises if the candidate is impossible. Candidates are tested in
+    batches by forked worker processes. Workers inherit the state of
+    the reassembler and discriminator at the time of the batch (so any
+    decoding done in advance is not repeated by each worker) and
+    changes made by the test function are discarded.
+    """
+    def __init__(self, workers=1, batch_size=4):
+        self.workers = max(1, workers)
+        ## How many candidates each worker tests in each batch:
+        self.batch_size = batch_size
+
+    def run_test(self, test, candidate):
+        try:
+            return test(*candidate)
+        except Exception,e:
+            print "Candidate %s failed (%s)" % (candidate, e)
+            return None
+
+    def scores(self, candidates, test):
+        """ Returns the score of each candidate (None for candidates
+        which failed).
+        """
+        if self.workers == 1 or len(candidates) < 2:
+            return [ self.run_test(test, x) for x in candidates ]
+
+        step = len(candidates) / self.workers + 1
+        children = []
+        for i in range(0, len(candidates), step):
+            r, w = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(r)
+                try:
+                    result = [ self.run_test(test, x) for x in candidates[i:i+step] ]
+                    outfd = os.fdopen(w, 'wb')
+                    marshal.dump(result, outfd)
+                    outfd.close()
+                except Exception, e:
+                    print "Scheduler worker failed: %s" % e
+                    os._exit(1)
+
+                os._exit(0)
+
+            os.close(w)
+            children.append((pid, os.fdopen(r, 'rb'), i))
+
+        result = [ None ] * len(candidates)
+        for pid, infd, i in children:
+            try:
+                scores = marshal.load(infd)
+                result[i:i+len(scores)] = scores
+            except EOFError:
+                print "Scheduler worker %s died" % pid
+
+            infd.close()
+            os.waitpid(pid, 0)
+
+        return result
+
+    def first_match(self, candidates, test, max_score=0, prepare=None):
+        """ Returns the first candidate scoring at most max_score and
+        its score, or None if no candidates are good enough.
+
+        Candidates with higher scores are pruned. We only test as
+        many batches as we need to find the first match. If given,
+        prepare is called with the first candidate of each batch
+        before it is tested - this is a chance to do work common to
+        the whole batch.
+
+        Tests run in this process (one worker or a single candidate)
+        leave their state behind, so no candidates after the match
+        are tested.
+        """
+        batch = self.workers * self.batch_size
+        for i in range(0, len(candidates), batch):
+            todo = candidates[i:i+batch]
+            if prepare:
+                prepare(*todo[0])
+
+            if self.workers == 1 or len(todo) < 2:
+                for candidate in todo:
+                    score = self.run_test(test, candidate)
+                    if score is not None and score <= max_score:
+                        return candidate, score
+
+                continue
+
+            for candidate, score in zip(todo, self.scores(todo, test)):
+                if score is not None and score <= max_score:
+                    return candidate, score
+
+    def best(self, candidates, test, max_score=None):
+        """ Returns a list of (score, candidate) sorted from the best
+        score, pruning those which failed or score above max_score.
+        """
+        result = []
+        for candidate, score in zip(candidates, self.scores(candidates, test)):
+            if score is None: continue
+            if max_score is not None and score > max_score: continue
+
+            result.append((score, candidate))
+
+        result.sort()
+        return result
+
+
 from optparse import OptionParser
 
+## Escapes understood by re but not by the index trie:
+TRIE_ESCAPES = { 'r':'\r', 'n':'\n', 't':'\t', 'f':'\f', 'v':'\v' }
+
+def trie_token(regex, i):
+    """ Returns the trie syntax for the regex element at i and its
+    length in the regex.
+    """
+    c = regex[i]
+    if c == '\\':
+        escaped = regex[i+1]
+        if escaped in TRIE_ESCAPES:
+            return "\\x%02x" % ord(TRIE_ESCAPES[escaped]), 2
+        elif escaped == 'x':
+            return regex[i:i+4], 4
+        elif escaped in 'dws':
+            return regex[i:i+2], 2
+
+        return "\\x%02x" % ord(escaped), 2
+
+    elif c == '[':
+        end = regex.index(']', i+2)
+        result = '['
+        j = i+1
+        if regex[j] == '^':
+            result += '^'
+            j += 1
+
+        members = []
+        while j < end:
+            members.append(class_member(regex, j))
+            j += members[-1][2]
+
+        ## The trie takes the bytes either side of a - as the ends of
+        ## a range, so these must be plain bytes:
+        k = 0
+        while k < len(members):
+            byte, token, length = members[k]
+            if k + 2 < len(members) and members[k+1][1] == '-':
+                low, high = byte, members[k+2][0]
+                for x in (low, high):
+                    if x is None or x in CLASS_SPECIALS or ord(x) > 0x7f:
+                        raise ValueError("The index does not support the range %s-%s in %r" % (
+                            token, members[k+2][1], regex))
+
+                result += low + '-' + high
+                k += 3
+                continue
+
+            if byte is None:
+                result += token
+            elif byte in CLASS_SPECIALS:
+                result += "\\x%02x" % ord(byte)
+            else:
+                result += byte
+
+            k += 1
+
+        return result + ']', end + 1 - i
+
+    elif c in '.?*+' or c.isalnum() or c == ' ':
+        return c, 1
+
+    elif c == '{':
+        end = regex.index('}', i)
+        return regex[i:end+1], end + 1 - i
+
+    ## Other bytes are literals:
+    return "\\x%02x" % ord(c), 1
+
+## Bytes the trie treats specially inside character classes:
+CLASS_SPECIALS = '\\]-^'
+
+def class_member(regex, j):
+    """ Returns the byte the character class member at j stands for
+    (None for \\d, \\w and \\s), its trie syntax and its length in the
+    regex.
+    """
+    if regex[j] != '\\':
+        return regex[j], regex[j], 1
+
+    token, length = trie_token(regex, j)
+    if token.startswith("\\x"):
+        return chr(int(token[2:4], 16)), token, length
+
+    return None, token, length
+
+def trie_words(regex):
+    """ Converts regex into a list of words for the index trie.
+
+    The trie understands character classes, escapes (\\d, \\w, \\s,
+    \\xff), . and repeats but not groups. Groups are removed and
+    alternations within them (e.g. (JFIF|EXIF)) are expanded into
+    separate words. Nested or repeated groups are not supported, nor
+    are ranges in character classes whose ends are not plain ASCII
+    bytes. These raise ValueError.
+    """
+    words = ['']
+    i = 0
+    while i < len(regex):
+        if regex[i] == '(':
+            end = regex.index(')', i)
+            alternatives = []
+            for x in regex[i+1:end].split('|'):
+                alternatives.extend(trie_words(x))
+
+            words = [ w + a for w in words for a in alternatives ]
+            i = end + 1
+            if i < len(regex) and regex[i] in '?*+{':
+                raise ValueError("The index does not support repeated groups in %r" % regex)
+
+            continue
+
+        token, length = trie_token(regex, i)
+        words = [ w + token for w in words ]
+        i += length
+
+    return words
+
+## Index files start with this, followed by the length of the
+## directory, the directory (name count offset lines) and then the
+## hits for each name as sorted arrays of little endian 64 bit
+## offsets.
+INDEX_MAGIC = "PFCIDX01"
+
+class IndexHits:
+    """ A read only view of the sorted hits for one name in an index
+    file. This behaves like a sorted list of offsets but the offsets
+    stay on disk.
+    """
+    def __init__(self, mm, offset, count):
+        self.mm = mm
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[x] for x in range(*i.indices(self.count)) ]
+
+        if i < 0: i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+
+        return struct.unpack_from("<q", self.mm, self.offset + 8 * i)[0]
+
+    def __iter__(self):
+        ## Unpack a chunk at a time:
+        for i in range(0, self.count, 4096):
+            n = min(4096, self.count - i)
+            for x in struct.unpack_from("<%sq" % n, self.mm, self.offset + 8 * i):
+                yield x
+
+    def between(self, start, end):
+        """ Returns the hits from start up to (not including) end """
+        return self[bisect.bisect_left(self, start):bisect.bisect_left(self, end)]
+
+    def __repr__(self):
+        return repr(list(self))
+
 class CarverFramework:
     """ This base class is the framework for building advanced
     carvers. This is basically just a way to provide the same kind of
@@ -421,6 +760,9 @@ class CarverFramework:
         parser.add_option('-c', '--create', default=False, action="store_true",
                           help = 'Create a new index file')
 
+        parser.add_option('-j', '--workers', default=1, type='int',
+                          help = 'Number of processes to use when creating the index or testing maps')
+
         parser.add_option('-m', '--maps', default=False,  action="store_true",
                           help = 'Carve the index file by creating initial map files')
 
@@ -439,6 +781,9 @@ class CarverFramework:
         parser.add_option('-F', '--forced_map', default=None,
                           help = "Saved forced map into this filename")
 
+        parser.add_option('-B', '--binary', default=False, action="store_true",
+                          help = "Save the forced map in the binary run format")
+
         parser.add_option('-p', '--plot', default=False, action="store_true",
                           help = "Plot the mapping function specified using --map")
 
@@ -452,37 +797,195 @@ class CarverFramework:
 
     cregexs = {}
     regexs = {}
-    
-    def build_index(self, index_file):
+
+    ## Hits are found by scanning the image in blocks this big. Each
+    ## read overlaps the next block by this much so matches across
+    ## block boundaries are found too:
+    block_size = 16 * 1024 * 1024
+    overlap = 4096
+
+    def build_indexer(self):
+        """ Loads all our regexs into a single index trie so the image
+        is only scanned once.
+        """
+        self.indexer = index.Index()
+        self.word_names = {}
+        for name in sorted(self.regexs.keys()):
+            ## The trie's . matches any byte:
+            self.cregexs[name] = re.compile(self.regexs[name], re.DOTALL)
+            for word in trie_words(self.regexs[name]):
+                self.indexer.add_word(word, len(self.word_names), index.WORD_EXTENDED)
+                self.word_names[len(self.word_names)] = name
+
+    def index_range(self, fd, start, end, hits):
+        """ Appends the offsets of hits between start and end to the
+        arrays in hits.
+
+        The trie only gives us candidates - each one is confirmed by
+        the real regex. Like finditer, hits for the same name do not
+        overlap.
+        """
+        last_end = {}
+        ## Start a little early so we know about any match running
+        ## into our range:
+        offset = max(0, start - self.overlap)
+        while offset < end:
+            fd.seek(offset)
+            data = fd.read(self.block_size + self.overlap)
+            if not data: break
+
+            block_end = min(offset + self.block_size, end)
+            for match_offset, matches in sorted(self.indexer.index_buffer(data, unique=0)):
+                image_offset = offset + match_offset
+                if image_offset >= block_end: break
+
+                for match in matches:
+                    name = self.word_names[match[0]]
+                    if image_offset < last_end.get(name, 0): continue
+
+                    m = self.cregexs[name].match(data, match_offset)
+                    if not m: continue
+
+                    last_end[name] = offset + max(m.end(), match_offset + 1)
+                    if image_offset >= start:
+                        hits[name].append(image_offset)
+
+            offset += self.block_size
+
+    def index_worker(self, start, end, output):
+        """ Indexes the image between start and end into the file
+        output.
+        """
         hits = {}
-        ## Compile the res
-        for k,v in self.regexs.items():
-            self.cregexs[k] = re.compile(v)
+        for name in self.regexs.keys():
+            hits[name] = array.array('l')
 
-        BLOCK_SIZE = 4096
+        self.index_range(open(self.args[0], 'rb'), start, end, hits)
 
-        p = pickle.Pickler(open(index_file,'w'))
+        outfd = open(output, 'wb')
+        for name in sorted(hits.keys()):
+            outfd.write(struct.pack("<q", len(hits[name])))
+            hits[name].tofile(outfd)
 
-        offset = 0
-        fd = open(self.args[0],'r')
-        while 1:
-            data = fd.read(BLOCK_SIZE)
-            if len(data)==0: break
+        outfd.close()
+
+    def build_index(self, index_file, workers=None):
+        """ Builds an index of all regexs in the image.
+
+        The image is split into a range per worker process. Since each
+        range is scanned in order the hits from each worker are already
+        sorted and we simply concatenate them in the index file.
+        """
+        self.build_indexer()
+        if workers is None:
+            workers = self.options.workers
+
+        workers = max(1, workers)
+        size = os.path.getsize(self.args[0])
+        step = max(size / workers + 1, self.overlap)
+
+        parts = []
+        pids = []
+        for start in range(0, size or 1, step):
+            output = "%s.%s" % (index_file, len(parts))
+            parts.append(output)
+            if workers == 1:
+                self.index_worker(start, start + step, output)
+                continue
+
+            pid = os.fork()
+            if not pid:
+                try:
+                    self.index_worker(start, start + step, output)
+                except Exception, e:
+                    print "Indexing worker failed: %s" % e
+                    os._exit(1)
 
-            for k,v in self.cregexs.items():
-                for m in v.finditer(data):
-                    print "Found %s in %s" % (k, offset + m.start())
-                    try:
-                        hits[k].append(offset + m.start())
-                    except KeyError:
-                        hits[k] = [ offset + m.start(), ]
+                os._exit(0)
 
-            offset += len(data)
+            pids.append(pid)
+
+        failed = [ pid for pid in pids if os.waitpid(pid, 0)[1] ]
+        try:
+            if failed:
+                raise RuntimeError("Indexing workers %s failed" % failed)
+
+            self.write_index(index_file, parts)
+        finally:
+            for output in parts:
+                try:
+                    os.unlink(output)
+                except OSError:
+                    pass
+
+        hits = self.load_index(index_file)
+        for name in sorted(hits.keys()):
+            print "Found %s %s" % (len(hits[name]), name)
 
-        ## Serialise the hits into a file:
-        p.dump(hits)
         return hits
 
+    def write_index(self, index_file, parts):
+        """ Merges the worker outputs in parts into index_file """
+        names = sorted(self.regexs.keys())
+
+        ## Find out how many hits each part has for each name:
+        counts = {}
+        fds = [ open(x, 'rb') for x in parts ]
+        for fd in fds:
+            for name in names:
+                count = struct.unpack("<q", fd.read(8))[0]
+                counts.setdefault(name, []).append((fd.tell(), count))
+                fd.seek(count * array.array('l').itemsize, 1)
+
+        directory = ''
+        offset = 0
+        for name in names:
+            total = sum([ x[1] for x in counts[name] ])
+            directory += "%s %s %s\n" % (name, total, offset)
+            offset += total * 8
+
+        outfd = open(index_file, 'wb')
+        outfd.write(INDEX_MAGIC + struct.pack("<q", len(directory)) + directory)
+        ## Align the arrays:
+        data_start = len(INDEX_MAGIC) + 8 + len(directory)
+        padding = (8 - data_start % 8) % 8
+        outfd.write("\x00" * padding)
+
+        for name in names:
+            for fd, (position, count) in zip(fds, counts[name]):
+                fd.seek(position)
+                while count > 0:
+                    hits = array.array('l')
+                    hits.fromfile(fd, min(count, 65536))
+                    outfd.write(struct.pack("<%sq" % len(hits), *hits))
+                    count -= len(hits)
+
+        outfd.close()
+
+    def ambiguous_points(self, c, start=0, sector_size=512):
+        """ Returns the next run of ambiguous points in c from start.
+
+        These are the possible positions of the discontinuity between
+        two identified points which do not lie on the same line. We
+        return a list of (file offset, reverse interpolated image
+        offset, length to the next identified point).
+        """
+        result = []
+        for x in range(start, c.size(), sector_size):
+            y_forward, left = c.interpolate(x, True)
+            y_reverse, left = c.interpolate(x, False)
+
+            ## Its not possible to interpolate before the start of the
+            ## image:
+            if y_reverse < 0: continue
+
+            if y_forward != y_reverse:
+                result.append((x, y_reverse, left))
+            elif result:
+                break
+
+        return result
+
     def generate_function(self, c):
         """ Generates test functions and uses a discriminator to
         evolve the carver object c into the best suitable one.
@@ -495,13 +998,35 @@ class CarverFramework:
         """
 
     def load_index(self, index_file):
-        p = pickle.Unpickler(open(index_file,'r'))
-        hits = p.load()
+        """ Returns a dict of IndexHits keyed by name """
+        fd = open(index_file, 'rb')
+        if fd.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            ## An old pickled index:
+            fd.seek(0)
+            return pickle.Unpickler(fd).load()
+
+        length = struct.unpack("<q", fd.read(8))[0]
+        directory = fd.read(length)
+        data_start = len(INDEX_MAGIC) + 8 + length
+        data_start += (8 - data_start % 8) % 8
+
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            ## Empty index
+            mm = ''
+
+        hits = {}
+        for line in directory.splitlines():
+            name, count, offset = line.split()
+            hits[name] = IndexHits(mm, data_start + int(offset), int(count))
 
         return hits
 
     def print_index(self, index_file):
-        print self.load_index(index_file)
+        hits = self.load_index(index_file)
+        for name in sorted(hits.keys()):
+            print "%s: %s" % (name, list(hits[name]))
 
     def parse(self):
         (self.options, self.args) = self.parser.parse_args()
@@ -530,7 +1055,7 @@ class CarverFramework:
                 
                 if self.options.forced_map:
                     print "Saving map in %s" % self.options.forced_map
-                    c.save_map(open(self.options.forced_map,'w'))
+                    c.save_map(open(self.options.forced_map,'wb'), self.options.binary)
 
             elif self.options.extract:
                 if not arg: raise RuntimeError("Image name not specified")
@@ -588,5 +1113,89 @@ class CarverTest(unittest.TestCase):
         print c.interpolate(50, True)
         print c.interpolate(520, True)
 
+    def test_Runs(self):
+        """ Test reading through the run table and binary maps """
+        fd = open(self.filename)
+        data = fd.read()
+        c = Reassembler(fd)
+        c.add_point(0,512)
+        c.add_point(512,0)
+        c.add_point(1024,1024, "EOF")
+
+        self.assertEqual(c.image_runs(), [ (512, 512), (0, 512) ])
+        c.seek(500)
+        self.assertEqual(c.read(100), data[1012:1024] + data[0:88])
+
+        c.save_map(self.filename + ".map", binary=True)
+        r = Reassembler(fd)
+        r.load_map(self.filename + ".map")
+        self.assertEqual(r.image_runs(), c.image_runs())
+        os.unlink(self.filename + ".map")
+
+    def test_Scheduler(self):
+        """ Test that the scheduler finds the first good candidate """
+        def test(x):
+            if x == 3: raise IOError("Bad candidate")
+            return abs(x - 7) % 5
+
+        s = CandidateScheduler(workers = 3, batch_size = 2)
+        candidates = [ (x,) for x in range(20) ]
+        self.assertEqual(s.first_match(candidates, test), ((2,), 0))
+        self.assertEqual(s.first_match(candidates[3:], test), ((7,), 0))
+        self.assertEqual(s.first_match(candidates, test, max_score = -1), None)
+        self.assertEqual(s.best(candidates[:8], test, max_score = 2)[:3],
+                         [ (0, (2,)), (0, (7,)), (1, (1,)) ])
+
+        ## Serially no candidates are tested after the match:
+        tested = []
+        def serial_test(x):
+            tested.append(x)
+            return test(x)
+
+        s = CandidateScheduler(workers = 1)
+        self.assertEqual(s.first_match(candidates, serial_test), ((2,), 0))
+        self.assertEqual(tested, [0, 1, 2])
+
+    def test_Index(self):
+        """ Test that the index finds the same hits as the regexs """
+        class TestCarver(CarverFramework):
+            regexs = { 'A': r'\x05\x06\x07', 'B': r'(\d+) obj',
+                       'C': r'\x10..(\x14|\x15)' }
+
+        ## Seed records for B and C which straddle the block boundaries:
+        data = open(self.filename).read()
+        for offset, record in ((997, "12 obj"), (1998, "\x10ab\x14"),
+                               (2999, "\x10ab\x15")):
+            data = data[:offset] + record + data[offset + len(record):]
+
+        fd = open(self.filename, 'w')
+        fd.write(data)
+        fd.close()
+
+        c = TestCarver()
+        c.args = [ self.filename ]
+        ## Make sure there are matches across the block boundaries:
+        c.block_size = 1000
+        c.overlap = 100
+
+        hits = c.build_index(self.filename + ".idx", workers = 3)
+        for name, regex in TestCarver.regexs.items():
+            expected = [ m.start() for m in re.finditer(regex, data, re.DOTALL) ]
+            self.assert_(expected)
+            self.assertEqual(list(hits[name]), expected)
+
+        self.assert_(997 in hits['B'])
+        self.assertEqual([ x for x in hits['C'] if x > 1000 ], [ 1998, 2999 ])
+        os.unlink(self.filename + ".idx")
+
+    def test_TrieWords(self):
+        """ Test the translation of regexs for the index trie """
+        self.assertEqual(trie_words(r'(a|b)\x05'), [ 'a\\x05', 'b\\x05' ])
+        ## Ranges in classes are given as plain bytes:
+        self.assertEqual(trie_words(r'[\x00-\x1f\-]'), [ '[\x00-\x1f\\x2d]' ])
+        self.assertEqual(trie_words(r'[\r\n ]'), [ '[\r\n ]' ])
+        self.assertRaises(ValueError, trie_words, r'[\x10-\xff]')
+        self.assertRaises(ValueError, trie_words, r'(ab)+c')
+
 if __name__=='__main__':    
     unittest.main()
@@ -178,20 +178,38 @@ class JPEGCarver(Carver.CarverFramework):
         image_offset, left = c.interpolate(s_old * 512)
 
         ## Try to fuzz the discontiuity
+        candidates = []
         for image_offset_to in range(image_offset, image_offset + 10 * 512, 512):
             for s_from in range(s_old, s_old + 2):
                 ## Enforce the projection rule
                 if s_from * 512 > image_offset_to: continue
 
-                c.add_point(s_from * 512, image_offset_to , "Test_point")
+                candidates.append((s_from, image_offset_to))
+
+        def test(s_from, image_offset_to):
+            c.add_point(s_from * 512, image_offset_to , "Test_point")
+            try:
                 d = jpeg.decoder(c)
                 print "Will decode up to %s" % ((s_from + 5) * 512)
                 d.decode(s_from + 10)
                 e = self.estimate(x_old, y_old, d)
                 print "Estimate %s-%s %s" % (s_from, image_offset_to / 512, e)
                 d.save(open("estimate_%s-%s.ppm" % (s_from, image_offset_to / 512),'w'))
+            finally:
                 c.del_point(s_from * 512)
 
+            return e
+
+        ## Keep the best candidate which is not too far off:
+        scheduler = Carver.CandidateScheduler(self.options.workers)
+        results = scheduler.best(candidates, test, self.options.max_estimate)
+        for e, (s_from, image_offset_to) in results:
+            print "Estimate %s-%s %s" % (s_from, image_offset_to / 512, e)
+
+        if results:
+            e, (s_from, image_offset_to) = results[0]
+            c.add_point(s_from * 512, image_offset_to, "Discontinuity")
+
 if __name__=="__main__":
     c = JPEGCarver()
     c.parse()
@@ -235,37 +235,46 @@ class PDFCarver(Carver.CarverFramework):
         d = PDFDiscriminator(c, self.options.verbose)
         d.slow = self.options.slow
 
-        for x in range(0, c.size(), SECTOR_SIZE):
-            y_forward, left = c.interpolate(x, True)
-            y_reverse, left = c.interpolate(x, False)
+        scheduler = Carver.CandidateScheduler(self.options.workers)
+
+        def test(x, y, left):
+            c.add_point(x, y, comment = "Forced")
+
+            ## Check a reasonable way after the next identified point
+            ## (This might need some work)
+            until_offset = left + x + SECTOR_SIZE
+
+            print "Checking until %s" % (until_offset)
+            try:
+                return d.parse(until_offset)
+            finally:
+                c.del_point(x)
+
+        def prepare(x, y, left):
+            ## Bring the parser's saved state up to the ambiguous
+            ## point so the tests start from there:
+            try:
+                d.parse(x)
+            except Exception,e:
+                print "Exception occured %s" % e
+
+        x = 0
+        while 1:
+            ## This is an ambiguous point:
+            candidates = self.ambiguous_points(c, x, SECTOR_SIZE)
+            if not candidates: break
 
-            if y_reverse < 0: continue
+            print "Ambiguous points found at offsets %s-%s" % (candidates[0][0], candidates[-1][0])
 
-            ## This is an ambiguous point:
-            if y_forward != y_reverse:
-                print "Ambiguous point found at offset %s: forward=%s vs reverse=%s..." % (x, y_forward, y_reverse)
-
-                c.add_point(x, y_reverse, comment = "Forced")
-
-                ## Check a reasonable way after the next identified point
-                ## (This might need some work)
-                until_offset = left + x + SECTOR_SIZE
-
-                print "Checking until %s" % (until_offset)
-
-                ## Check the errors:
-                try:
-                    error_count = d.parse(until_offset)
-                except Exception,e:
-                    print "Exception occured %s" % e
-                    error_count = 10
-                    
-                if error_count == 0:
-                    sys.stderr.write("Found a hit at %s\n" % x)
-                else:
-                    ## No thats not the right point.
-                    c.del_point(x)
-                    print "Total errors were %s" % error_count
+            match = scheduler.first_match(candidates, test, prepare = prepare)
+            if match:
+                x, y, left = match[0]
+                sys.stderr.write("Found a hit at %s\n" % x)
+                c.add_point(x, y, comment = "Forced")
+            else:
+                x = candidates[-1][0]
+
+            x += SECTOR_SIZE
 
         ## Perform a complete start to finish verification to find the
         ## end of file:
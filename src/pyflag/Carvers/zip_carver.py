@@ -75,6 +75,9 @@ zip_header_re = re.compile("PK[\x01\x03\x05][\x02\x04\x06]")
 
 SECTOR_SIZE = 512
 
+## How often we save the state of the decompressor:
+CHECKPOINT_SIZE = 64 * 1024
+
 class ZipDiscriminator:
     """ We test the provided carved zip file for errors by reading it
     sequentially
@@ -82,6 +85,17 @@ class ZipDiscriminator:
     def __init__(self, reassembler):
         self.r = reassembler
 
+        ## Data before this file offset will not change while we test
+        ## hypotheses, so work done on it can be kept:
+        self.stable = 0
+
+        ## The length of verified files keyed by their file offset
+        self.verified = {}
+
+        ## Decompressor state (offset, decompressobj, crc, total)
+        ## keyed by file header offset
+        self.checkpoints = {}
+
         ## Try to load the central directory if possible: This may
         ## fail if the cd is fragmented. FIXME: be able to handle
         ## fragmentation at the CD.
@@ -134,15 +148,22 @@ class ZipDiscriminator:
 
         ## Deflate:
         if compression_method==8:
-            dc = zlib.decompressobj(-15)
-            crc = 0
-
-            self.offset = b.offset + fh.size()
-            self.r.seek(self.offset)
+            data_start = b.offset + fh.size()
 
-            total = 0
+            ## Resume from where we got to last time if we can:
+            try:
+                self.offset, dc, crc, total = self.checkpoints[b.offset]
+                if self.offset > self.stable: raise KeyError()
+                dc = dc.copy()
+            except KeyError:
+                dc = zlib.decompressobj(-15)
+                crc = 0
+                total = 0
+                self.offset = data_start
 
-            to_read = compressed_size
+            self.r.seek(self.offset)
+            to_read = compressed_size - (self.offset - data_start)
+            checkpoint = self.offset
 
             while to_read > 0:
                 cdata = self.r.read(min(SECTOR_SIZE,to_read))
@@ -153,6 +174,10 @@ class ZipDiscriminator:
                 self.offset += len(cdata)
                 crc = binascii.crc32(data, crc)
 
+                if self.offset <= self.stable and self.offset >= checkpoint + CHECKPOINT_SIZE:
+                    checkpoint = self.offset
+                    self.checkpoints[b.offset] = (self.offset, dc.copy(), crc, total)
+
                 ## Only test as much as was asked
                 if self.offset > length_to_test: return length_to_test
 
@@ -185,6 +210,9 @@ class ZipDiscriminator:
         if m:
             total_size += m.start()
 
+        if b.offset + fh.size() + compressed_size + SECTOR_SIZE <= self.stable:
+            self.verified[b.offset] = total_size
+
         #print fh
         return total_size
 
@@ -200,14 +228,18 @@ class ZipDiscriminator:
         print "Found ECD %s" % ecd
         return ecd.size()
     
-    def parse(self, length_to_test):
+    def parse(self, length_to_test, stable=0):
         """
         Reads the reassembled zip file from the start and detect errors.
 
+        Data before stable is assumed not to have changed since the
+        last call so files verified before it are skipped.
+
         Returns the offset where the last error occurs
         """
         b = Buffer(fd = self.r)
         self.offset = 0
+        self.stable = stable
 
         ## Try to find the next ZipFileHeader. We allow some padding
         ## between archived files:
@@ -215,6 +247,11 @@ class ZipDiscriminator:
         while 1:
             if b.offset >= length_to_test:
                 return
+
+            length = self.verified.get(b.offset)
+            if length and b.offset + length <= stable:
+                b = b[length:]
+                continue
             
             try:
                 length = self.decode_file(b, length_to_test)
@@ -233,7 +270,7 @@ class ZipDiscriminator:
                 raise
 
 class ZipCarver(Carver.CarverFramework):
-    ## For now use regex - later convert to pyflag indexs:
+    ## These are loaded into the index trie:
     regexs = {
         'ZipFileHeader': 'PK\x03\x04',
         'EndCentralDirectory': 'PK\x05\x06',
@@ -357,33 +394,47 @@ class ZipCarver(Carver.CarverFramework):
         We alter the carver object as we process it. We return the total
         final error count.
         """
-        ## We check each sector in turn until we find ambiguous sectors,
-        ## then brute force them using the discriminator:
+        ## We find runs of ambiguous sectors, then brute force them
+        ## using the discriminator:
         d = ZipDiscriminator(c)
-        for x in range(0,c.size(), SECTOR_SIZE):
-            y_forward, length = c.interpolate(x, True)
-            y_reverse, length = c.interpolate(x, False)
+        scheduler = Carver.CandidateScheduler(self.options.workers)
 
-            ## Its not possible to interpolate before the start of the
-            ## image:
-            if y_reverse<0: continue
+        def test(x, y, length):
+            ## Disambiguate the function by adding a new point:
+            c.add_point(x, y, comment = "Forced")
 
-            ## Is this an ambigous point?
-            if y_forward != y_reverse:
-                print "Ambiguous point found at offset %s: forward=%s vs reverse=%s..." % (x, y_forward, y_reverse)
-                ## Disambiguate the function by adding a new point:
-                c.add_point(x, y_reverse, comment = "Forced")
+            ## Test the file up to the last point:
+            try:
+                d.parse(x + length, stable = x)
+            finally:
+                c.del_point(x)
 
-                ## Test the file up to the last point:
-                try:
-                    d.parse(x + length)
-                except Exception,e:
-                    print "Errors detected, point removed.(%s)" % e
-                    ## Error occured, move the point over by one:
-                    c.del_point(x)
-                    continue
+            return 0
 
+        def prepare(x, y, length):
+            ## Decode up to the ambiguous point once, so the tests can
+            ## resume from there:
+            try:
+                d.parse(x, stable = x)
+            except Exception,e:
+                print "Errors detected before %s (%s)" % (x, e)
+
+        x = 0
+        while 1:
+            candidates = self.ambiguous_points(c, x, SECTOR_SIZE)
+            if not candidates: break
+
+            print "Ambiguous points found at offsets %s-%s" % (candidates[0][0], candidates[-1][0])
+
+            match = scheduler.first_match(candidates, test, prepare = prepare)
+            if match:
+                x, y, length = match[0]
                 print "Match found at offset %s" % x
+                c.add_point(x, y, comment = "Forced")
+            else:
+                x = candidates[-1][0]
+
+            x += SECTOR_SIZE
 
 if __name__=='__main__':
     carver = ZipCarver()
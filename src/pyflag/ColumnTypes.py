@@ -400,6 +400,12 @@ class ColumnType:
         """
         return self.column, value
 
+    def flush(self):
+        """ This is called by loaders after they inserted a batch of
+        rows, and when they are done. Column types which defer work in
+        insert() should complete it here.
+        """
+
     def select(self):
         """ Returns the SQL required for selecting from the table. """
         return self.escape_column_name(self.column)
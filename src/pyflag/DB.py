@@ -35,7 +35,7 @@ import pyflag.conf
 config = pyflag.conf.ConfObject()
 
 import pyflag.pyflaglog as pyflaglog
-import time,types
+import time,types,os,tempfile
 from Queue import Queue, Full, Empty
 from MySQLdb.constants import FIELD_TYPE, FLAG
 import threading
@@ -79,6 +79,18 @@ config.add_option("DBCACHE_LENGTH", default=1024, type='int',
 config.add_option("MASS_INSERT_THRESHOLD", default=300, type='int',
                   help="Number of rows where the mass insert buffer will be flushed.")
 
+config.add_option("MASS_INSERT_ENGINE", default="insert",
+                  help="How mass inserts are written: 'insert' sends multi-row insert "
+                  "statements, 'load' streams the rows with LOAD DATA LOCAL INFILE")
+
+config.add_option("MASS_INSERT_BYTES", default=8*1024*1024, type='int',
+                  help="Size of the mass insert buffer when using the load engine "
+                  "(0 = flush every MASS_INSERT_THRESHOLD rows)")
+
+config.add_option("MASS_INSERT_BACKGROUND", default=False, action='store_true',
+                  help="Write full mass insert buffers on a background thread while "
+                  "the caller carries on")
+
 config.add_option("TABLE_QUERY_TIMEOUT", default=10, type='int',
                   help="The table widget will timeout queries after this many seconds")
 
@@ -119,6 +131,16 @@ class DBError(Exception):
     """ Generic Database Exception """
     pass
 
+class DBStatistics(threading.local):
+    """ Counts the statements issued and rows inserted by the current
+    thread. Scanner statistics use these to work out what each
+    scanner costs the database.
+    """
+    statements = 0
+    rows = 0
+
+STATS = DBStatistics()
+
 def force_unicode(string):
     """ Make sure the string is unicode where its supposed to be """
     if isinstance(string, str):
@@ -383,6 +405,9 @@ def mysql_connect(case):
     if config.STRICTSQL:
         mysql_connection_args['sql_mode'] = "STRICT_ALL_TABLES"
 
+    if config.MASS_INSERT_ENGINE == 'load':
+        mysql_connection_args['local_infile'] = 1
+
     if config.DB_SS_CURSOR:
         mysql_connection_args['cursorclass'] = PyFlagCursor
     else:
@@ -472,6 +497,74 @@ class Pool(Queue):
             mysql_connection_args = None            
             raise DBError("Unable to connect - does the DB Exist?: %s" % e)
 
+## Marks a column missing from a mass inserted row
+MISSING = object()
+
+## Set when LOAD DATA LOCAL INFILE turns out not to work
+LOAD_DATA_FAILED = False
+
+def sql_value(kind, value):
+    """ Escapes a mass inserted value for an insert statement """
+    if value is MISSING: return 'NULL'
+    elif kind == 's': return force_string(value)
+    elif kind == 'b': return db_expand("%b", (value,))
+
+    return db_expand("%r", (value,))
+
+def tsv_value(value):
+    """ Escapes a mass inserted value for LOAD DATA INFILE """
+    if value is MISSING: return "\\N"
+
+    return escape(force_string(value), quote='')
+
+class MassInsertWriter(threading.Thread):
+    """ Writes mass insert batches on separate connections.
+
+    Batches are written in the order they are put, even when they are
+    for different tables or cases. At most one batch waits in the
+    queue, so a producer which is faster than the database blocks
+    rather than buffering without bound.
+    """
+    def __init__(self, dbo_class):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.dbo_class = dbo_class
+        self.queue = Queue(1)
+        self.error = None
+        self.start()
+
+    def put(self, batch, case):
+        self.check()
+        self.queue.put((case, batch))
+
+    def check(self):
+        if self.error:
+            raise DBError("Background mass insert failed: %s" % self.error)
+
+    def close(self):
+        """ Waits for all batches to be written """
+        self.queue.put(None)
+        self.join()
+        self.check()
+
+    def run(self):
+        dbhs = {}
+        while 1:
+            item = self.queue.get()
+            if item is None: return
+
+            case, batch = item
+            try:
+                try:
+                    dbh = dbhs[case]
+                except KeyError:
+                    dbh = dbhs[case] = self.dbo_class(case)
+
+                dbh.mass_insert_write(batch)
+            except Exception, e:
+                pyflaglog.log(pyflaglog.ERRORS, "Background mass insert failed: %s" % e)
+                self.error = e
+
 class PooledDBO:
     """ Class controlling access to DB handles
 
@@ -483,6 +576,11 @@ class PooledDBO:
     """
     temp_tables = []
     transaction = False
+    mass_insert_writer = None
+    ## If set this is called after each batch of mass inserted rows
+    ## was written to the table. Batches are then always written in
+    ## the foreground:
+    mass_insert_callback = None
     ## This stores references to the pools
     DBH = Store.Store(max_size=10)
 
@@ -550,8 +648,12 @@ class PooledDBO:
         if params:
             string = db_expand(query_str, params)
         else: string = query_str
+
+        STATS.statements += 1
         try:
             self.cursor.execute(string)
+            if string[:6].lower() in ('insert', 'replac', 'load d'):
+                STATS.rows += max(self.cursor.rowcount, 0)
         #If anything went wrong we raise it as a DBError
         except Exception,e:
             str = "%s" % e
@@ -796,67 +898,149 @@ class PooledDBO:
         self.execute(sql, [table,]+args)
                     
     def mass_insert_start(self, table, _fast=False):
-        self.mass_insert_cache = {}
+        ## Rows are buffered in column arrays: column name -> [kind,
+        ## values] where kind is the escaping (r, s or b as in
+        ## db_expand) and values has one entry per row.
+        self.mass_insert_columns = {}
         self.mass_insert_table = table
         self.mass_insert_row_count = 0
+        self.mass_insert_bytes = 0
         self.mass_insert_fast = _fast
     
     def mass_insert(self, args=None, **columns):
         """ Starts a mass insert operation. When done adding rows, call commit_mass_insert to finalise the insert.
         """
         if args: columns = args
-        
+
+        row = self.mass_insert_row_count
         for k,v in columns.items():
             ## _field means to pass the field
             if k.startswith("__"):
-                v=db_expand("%b", (v,))
+                kind = 'b'
                 k=k[2:]
             elif k.startswith('_'):
+                kind = 's'
                 k=k[1:]
             else:
-                v=db_expand("%r", (v,))
-                
+                kind = 'r'
+
             try:
-                self.mass_insert_cache[k][self.mass_insert_row_count]=v
-            except:
-                self.mass_insert_cache[k]={ self.mass_insert_row_count: v}
+                column = self.mass_insert_columns[k]
+            except KeyError:
+                column = self.mass_insert_columns[k] = [kind, [MISSING] * row]
+
+            if column[0] != kind:
+                ## The column is escaped differently in different
+                ## rows - keep it as SQL:
+                column[1] = [ sql_value(column[0], x) for x in column[1] ]
+                column[0] = 's'
+                v = sql_value(kind, v)
+
+            column[1].append(v)
+            try:
+                self.mass_insert_bytes += len(v)
+            except TypeError:
+                self.mass_insert_bytes += 8
 
         self.mass_insert_row_count+=1
-        if self.mass_insert_row_count > config.MASS_INSERT_THRESHOLD:
-            self.mass_insert_commit()
-            self.mass_insert_start(self.mass_insert_table, _fast=self.mass_insert_fast)
+
+        ## Columns missing from this row:
+        if len(columns) < len(self.mass_insert_columns):
+            for column in self.mass_insert_columns.values():
+                if len(column[1]) < self.mass_insert_row_count:
+                    column[1].append(MISSING)
+
+        if config.MASS_INSERT_ENGINE == 'load' and config.MASS_INSERT_BYTES:
+            full = self.mass_insert_bytes > config.MASS_INSERT_BYTES
+        else:
+            full = self.mass_insert_row_count > config.MASS_INSERT_THRESHOLD
+
+        if full:
+            self.mass_insert_flush(background = config.MASS_INSERT_BACKGROUND)
+
+    def mass_insert_flush(self, background=False):
+        """ Writes out the buffered rows, possibly on a background
+        thread. Unlike mass_insert_commit() this does not wait for
+        the rows to be written.
+        """
+        if not self.mass_insert_row_count: return
+
+        batch = (self.mass_insert_table, self.mass_insert_columns,
+                 self.mass_insert_row_count)
+
+        if not self.mass_insert_fast:
+            self.invalidate(self.mass_insert_table)
+
+        ## Start a new buffer
+        self.mass_insert_start(self.mass_insert_table,
+                               _fast=self.mass_insert_fast)
+
+        if self.mass_insert_callback:
+            self.mass_insert_write(batch)
+            self.mass_insert_callback()
+            return
+
+        if background and not self.mass_insert_writer:
+            self.mass_insert_writer = MassInsertWriter(self.__class__)
+
+        if self.mass_insert_writer:
+            self.mass_insert_writer.put(batch, self.case)
+        else:
+            self.mass_insert_write(batch)
 
     def mass_insert_commit(self):
         try:
-            keys = self.mass_insert_cache.keys()
+            self.mass_insert_columns
         except AttributeError:
             ## We called commit without start
             return
 
-        if len(keys)==0: return
-        
-        args = []
-        values = []
-        for i in range(self.mass_insert_row_count):
-            for k in keys:
-                try:
-                    args.append(self.mass_insert_cache[k][i])
-                except KeyError:
-                    args.append('NULL')
+        self.mass_insert_flush()
 
-            values.append(",".join(["%s"] * len(keys)))
+        ## Wait for the background writer to finish:
+        if self.mass_insert_writer:
+            writer = self.mass_insert_writer
+            self.mass_insert_writer = None
+            writer.close()
 
-        sql = "insert ignore into `%s` (%s) values (%s)" % (self.mass_insert_table,
-                                                   ','.join(["`%s`" % c for c in keys]),
-                                                   "),(".join(values))
-        if not self.mass_insert_fast:
-            self.invalidate(self.mass_insert_table)
-            
-        self.execute(sql,*args)
+    def mass_insert_write(self, batch):
+        """ Writes a batch of rows buffered by mass_insert() """
+        global LOAD_DATA_FAILED
 
-        ## Ensure the cache is now empty:
-        self.mass_insert_start(self.mass_insert_table,
-                               _fast=self.mass_insert_fast)
+        table, columns, count = batch
+        keys = columns.keys()
+        names = ','.join(["`%s`" % c for c in keys])
+
+        ## Raw SQL values can not be loaded from a file:
+        if config.MASS_INSERT_ENGINE == 'load' and not LOAD_DATA_FAILED and \
+               's' not in [ c[0] for c in columns.values() ]:
+            fd, filename = tempfile.mkstemp(prefix="pyflag_load_")
+            try:
+                outfd = os.fdopen(fd, "wb")
+                for i in range(count):
+                    outfd.write("\t".join([ tsv_value(columns[k][1][i]) for k in keys ]))
+                    outfd.write("\n")
+                outfd.close()
+
+                try:
+                    self.execute("load data local infile %r ignore into table `%s` "
+                                 "character set utf8 (%s)", (filename, table, names))
+                    return
+                except DBError, e:
+                    ## The server or client may not allow local infiles:
+                    LOAD_DATA_FAILED = True
+                    pyflaglog.log(pyflaglog.WARNING, "Unable to load data into %s (%s) - "
+                                  "using insert statements from now on" % (table, e))
+            finally:
+                os.unlink(filename)
+
+        values = []
+        for i in range(count):
+            values.append(",".join([ sql_value(columns[k][0], columns[k][1][i])
+                                     for k in keys ]))
+
+        self.execute("insert ignore into `%s` (%s) values (%s)",
+                     (table, names, "),(".join(values)))
 
     def autoincrement(self):
         """ Returns the value of the last autoincremented key """
@@ -47,6 +47,8 @@ process it is difficult to distribute the work, while gains would be
 limited (for example loading a HDD image takes about 20-30 seconds,
 while reassembling a 2G capture file might only take on the order of 5
 minutes - while scanning a large filesystem can take several hours).
+Capture files may however be reassembled by several processes on the
+loading machine (see PCAP_LOAD_WORKERS).
 
 In the current implementation, the second step - i.e. the scanning of
 the VFS is most time consuming and most attractive for
@@ -112,6 +114,25 @@ jobs are available. When jobs are scheduled, they are inserted into
 that table by the scheduling thread. All other threads will pick up
 jobs from that table, deleting them as they are completed.
 
+When config.JOB_DISPATCHER is 'claim', workers do not lock the job
+tables at all. Instead each worker claims a batch of pending jobs with
+a single update which stamps them with a unique claim token, and then
+reads back the rows carrying its token. Claimed jobs are queued
+locally so the next batch is already available when the current one
+finishes. Batches are balanced by the estimated cost of each job (the
+inode size for Scan jobs) rather than by a fixed count, and an idle
+worker may steal claimed jobs which a busy worker has not started
+yet. Idle claiming workers wait on a unix domain socket in
+config.WAKEUP_DIR, so wake_workers() gets them going immediately.
+
+Workers lease the jobs they hold. A background thread in each worker
+renews the leases every config.JOB_LEASE/3 seconds. When a worker dies
+its nanny requeues its jobs straight away, and the periodic
+housekeeping task requeues any job whose lease ran out (e.g. because
+the whole machine died). Each start of a job counts as an attempt - a
+job which was started config.JOB_MAX_ATTEMPTS times and still killed
+its worker is moved to the quarantined_jobs table.
+
 == Scanners ==
 
 This is a brief recap of the scanner architecture and how this fits
@@ -169,7 +190,7 @@ required to manage working threads (other than ensuring the UPLOAD and
 RESULTDIR are synctonised).
 
 """ 
-import sys,os,select
+import sys,os,select,socket,errno
 
 sys.path.append(os.path.join(os.path.dirname(__file__),"pyflag"))
 sys.path.append(os.path.join(os.path.dirname(__file__),".."))
@@ -177,7 +198,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__),".."))
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 import pyflag.pyflaglog as pyflaglog
-import atexit,os,signal,time
+import atexit,os,signal,time,threading
 import pyflag.DB as DB
 import pyflag.Registry as Registry
 import pyflag.Store as Store
@@ -227,6 +248,46 @@ def check_mem(cb, *args, **kwargs):
 
 class Task:
     """ All distributed tasks need to extend this subclass """
+    def prefetch(self, rows):
+        """ Called with all the rows of this task's jobs a worker just
+        took on, before any of them are run. Tasks may use this to
+        fetch whatever they need for the whole batch at once.
+        """
+
+    def flush(self):
+        """ Called when the worker runs out of jobs and before it
+        exits. Tasks which buffer their results must write them out.
+        """
+
+def prefetch_tasks(rows):
+    """ Lets the tasks prepare for the batch of jobs in rows """
+    by_command = {}
+    for row in rows:
+        if row['state'] != 'broadcast':
+            by_command.setdefault(row['command'], []).append(row)
+
+    for command, rows in by_command.items():
+        try:
+            Registry.TASKS.dispatch(command)().prefetch(rows)
+        except Exception, e:
+            pyflaglog.log(pyflaglog.DEBUG, "Unable to prefetch %s jobs: %s" % (command, e))
+
+def flush_tasks():
+    """ Makes all tasks write out anything they buffered """
+    for cls in Registry.TASKS.classes:
+        try:
+            cls().flush()
+        except Exception, e:
+            pyflaglog.log(pyflaglog.ERRORS, "Unable to flush %s: %s" % (cls.__name__, e))
+
+def flush_and_exit(code=0):
+    try:
+        if CLAIM_STATS.claims:
+            CLAIM_STATS.log()
+
+        flush_tasks()
+    finally:
+        os._exit(code)
 
 ## There are two types of messages we listen for, the pending messages
 ## and broadcast messages. Pending jobs are those which we take
@@ -307,6 +368,12 @@ def nanny(cb, keepalive=None, *args, **kwargs):
                         ## zombie:
                         os.waitpid(pid,0)
                         children.pop(children.index(pid))
+
+                        ## Give back any jobs the child was holding:
+                        try:
+                            requeue_jobs(DB.expand("claim like %r", owner_token(pid) + ":%"))
+                        except Exception, e:
+                            pyflaglog.log(pyflaglog.WARNING, "Unable to requeue jobs of %s: %s" % (pid, e))
                         break
                 except OSError:
                     pass
@@ -317,48 +384,156 @@ def nanny(cb, keepalive=None, *args, **kwargs):
             cb(keepalive=w, *args, **kwargs)
             os._exit(0)
 
+config.add_option("JOB_LEASE", default=300, type='int',
+                  help="Seconds a worker holds a job without renewing its lease before the job is requeued")
+
+config.add_option("JOB_MAX_ATTEMPTS", default=3, type='int',
+                  help="Number of times a job may kill its worker before it is quarantined")
+
+def owner_token(pid=None):
+    """ Identifies the jobs owned by a worker. All claim tokens of the
+    worker start with this.
+    """
+    return "%s:%s" % (socket.gethostname(), pid or os.getpid())
+
+def requeue_jobs(condition):
+    """ Returns processing jobs matching condition to the queue.
+
+    This is used for jobs whose worker died. Jobs which were started
+    (i.e. have our run token) and already killed
+    config.JOB_MAX_ATTEMPTS workers are moved to the quarantined_jobs
+    table instead so they do not take down the pool over and over.
+    """
+    dbh = DB.DBO()
+    where = "state='processing' and claim like '%%:run' and attempts >= %s and (%s)" % (
+        config.JOB_MAX_ATTEMPTS, condition)
+
+    for table in ("jobs", "high_priority_jobs"):
+        dbh.execute("select * from `%s` where %s", (table, where))
+        poisoned = [ row for row in dbh ]
+        for row in poisoned:
+            pyflaglog.log(pyflaglog.WARNING, DB.expand("Quarantining job %s(%s,%s) after %s attempts",
+                                                       (row['command'], row['arg1'], row['arg2'],
+                                                        row['attempts'])))
+            dbh.insert("quarantined_jobs", _fast=True,
+                       command = row['command'], arg1 = row['arg1'],
+                       arg2 = row['arg2'], arg3 = row['arg3'],
+                       cookie = row['cookie'], attempts = row['attempts'])
+            dbh.delete(table, DB.expand("id=%r", row['id']), _fast=True)
+
+        dbh.execute("update `%s` set state='pending', pid=0, claim=NULL, lease=0 "
+                    "where state='processing' and (%s)", (table, condition))
+        if dbh.cursor.rowcount:
+            pyflaglog.log(pyflaglog.INFO, "Requeued %s jobs in %s" % (dbh.cursor.rowcount, table))
+
+def requeue_expired_jobs():
+    """ Requeues jobs whose lease expired - their worker (or its
+    whole machine) must have died.
+    """
+    requeue_jobs("lease > 0 and lease < unix_timestamp()")
+
+class LeaseKeeper(threading.Thread):
+    """ Renews the leases of all jobs held by this worker.
+
+    Runs in the background for as long as the worker lives - if the
+    worker dies the leases run out and the jobs are requeued.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.owner = owner_token()
+
+    def run(self):
+        while 1:
+            time.sleep(max(1, config.JOB_LEASE / 3))
+            try:
+                dbh = DB.DBO()
+                for table in ("jobs", "high_priority_jobs"):
+                    dbh.execute("update `%s` set lease=unix_timestamp()+%s "
+                                "where state='processing' and claim like %r",
+                                (table, config.JOB_LEASE, self.owner + ":%"))
+            except Exception, e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to renew job leases: %s" % e)
+
+def forget_db_handles():
+    """ Makes a freshly forked child get its own db connections """
+    ## It is an error to fork with db connections
+    ## established... they can not be shared:
+    if DB.db_connections > 0:
+        ## We try to fix it by making the child get new
+        ## handlers. Note that the child still needs to hold the
+        ## handles or they will get closed on the parent as well
+        ## - this seems like a hack
+        DB.DBO.DBH_old = DB.DBO.DBH
+        DB.DBO.DBH = Store.Store(max_size=10)
+        DB.db_connections = 0
+
+def prepare_worker():
+    """ Prepares a freshly forked worker and returns the id of the
+    last broadcast message it should ignore.
+    """
+    forget_db_handles()
+
+    ## This is the last broadcast message we handled. We will
+    ## only handle broadcasts newer than this.
+    broadcast_id = 0
+    try:
+        dbh=DB.DBO()
+        dbh.execute("select max(id) as max from jobs")
+        row = dbh.fetch()
+        broadcast_id = row['max'] or 0
+    except: pass
+
+    LeaseKeeper().start()
+
+    return broadcast_id
+
+def ping_nanny(keepalive, message="Checking"):
+    """ Lets our nanny know we are still alive """
+    try:
+        if keepalive:
+            os.write(keepalive, message)
+    except Exception, e:
+        pyflaglog.log(pyflaglog.WARNING,"Our nanny died - quitting")
+        os._exit(1)
+
+def run_task(row):
+    """ Dispatches the job in row to its Task """
+    try:
+        task = Registry.TASKS.dispatch(row['command'])
+    except:
+        pyflaglog.log(pyflaglog.DEBUG, "Dont know how to process job %s" % row['command'])
+        return
+
+    try:
+        task = task()
+        task.run(row['arg1'], row['arg2'], row['arg3'])
+    except Exception,e:
+        pyflaglog.log(pyflaglog.ERRORS, "Error %s(%s,%s,%s) %s" % (task.__class__.__name__,row['arg1'], row['arg2'],row['arg3'],e))
+
 def worker_run(keepalive=None):
      """ The main loop of the worker """
-     ## It is an error to fork with db connections
-     ## established... they can not be shared:
-     if DB.db_connections > 0:
-         ## We try to fix it by making the child get new
-         ## handlers. Note that the child still needs to hold the
-         ## handles or they will get closed on the parent as well
-         ## - this seems like a hack
-         DB.DBO.DBH_old = DB.DBO.DBH
-         DB.DBO.DBH = Store.Store(max_size=10)
-         DB.db_connections = 0
+     if config.JOB_DISPATCHER == 'claim':
+         return claim_worker_run(keepalive)
 
      ## These are all the methods we support
      jobs = []
 
      my_pid = os.getpid()
+     claim_token = owner_token() + ":queued"
+     run_token = owner_token() + ":run"
 
-     ## This is the last broadcast message we handled. We will
-     ## only handle broadcasts newer than this.
-     broadcast_id = 0
-     try:
-         dbh=DB.DBO()
-         dbh.execute("select max(id) as max from jobs")
-         row = dbh.fetch()
-         broadcast_id = row['max'] or 0
-     except: pass
+     broadcast_id = prepare_worker()
 
      while 1:
          ## Ping the parent
-         try:
-             if keepalive:
-                 os.write(keepalive,"Checking")
-         except Exception, e:
-             print e
-             pyflaglog.log(pyflaglog.WARNING,"Our nanny died - quitting")
-             os._exit(1)
+         ping_nanny(keepalive)
 
          ## Check for memory usage
-         check_mem(os._exit,0)
+         check_mem(flush_and_exit,0)
          ## Check for new tasks:
          if not jobs:
+             flush_tasks()
              try:
                  r = win32event.WaitForMultipleObjects([SyncEvent, TerminateEvent], False, 10000)
                  if r==1:
@@ -381,9 +556,11 @@ def worker_run(keepalive=None):
                  ## Ensure the jobs are marked as processing so other jobs dont touch them:
                  if jobs:
                      for row in jobs:
+                         row['table'] = 'high_priority_jobs'
                          if row['state'] == 'pending':
-                             dbh.execute("update high_priority_jobs set state='processing', pid=%r where id=%r",
-                                         my_pid,
+                             dbh.execute("update high_priority_jobs set state='processing', pid=%r, "
+                                         "claim=%r, lease=unix_timestamp()+%s where id=%r",
+                                         my_pid, claim_token, config.JOB_LEASE,
                                          row['id'])                             
                  else:
                      dbh.execute("unlock tables")
@@ -403,9 +580,11 @@ def worker_run(keepalive=None):
 
                      ## Ensure the jobs are marked as processing so other jobs dont touch them:
                      for row in jobs:
+                         row['table'] = 'jobs'
                          if row['state'] == 'pending':
-                             dbh.execute("update jobs set state='processing', pid=%r where id=%r",
-                                         my_pid,
+                             dbh.execute("update jobs set state='processing', pid=%r, "
+                                         "claim=%r, lease=unix_timestamp()+%s where id=%r",
+                                         my_pid, claim_token, config.JOB_LEASE,
                                          row['id'])
                          elif row['state'] == 'broadcast':
                              broadcast_id = row['id']
@@ -416,30 +595,397 @@ def worker_run(keepalive=None):
              print e
              continue
 
+         prefetch_tasks(jobs)
+
          ## Now do the jobs
          for row in jobs:
-             try:
-                 try:
-                     task = Registry.TASKS.dispatch(row['command'])
-                 except:
-                     pyflaglog.log(pyflaglog.DEBUG, "Dont know how to process job %s" % row['command'])
+             ## Only the job we are about to run counts an attempt -
+             ## if we die the rest of the batch is requeued without
+             ## one (see requeue_jobs()):
+             if row['state'] != 'broadcast':
+                 dbh.execute("update `%s` set claim=%r, attempts=attempts+1 where id=%r and claim=%r",
+                             (row['table'], run_token, row['id'], claim_token))
+                 if not dbh.cursor.rowcount:
                      continue
 
-                 try:
-                     task = task()
-                     task.run(row['arg1'], row['arg2'], row['arg3'])
-                 except Exception,e:
-                     pyflaglog.log(pyflaglog.ERRORS, "Error %s(%s,%s,%s) %s" % (task.__class__.__name__,row['arg1'], row['arg2'],row['arg3'],e))
-
+             try:
+                 run_task(row)
              finally:
-                 try:
-                     if keepalive:
-                         os.write(keepalive, " ".join(row))
-                 except:
-                     pyflaglog.log(pyflaglog.WARNING,"Our nanny died - quitting")
-                     os._exit(1)
+                 ping_nanny(keepalive, " ".join(row))
                  if row['state'] != 'broadcast':
-                     dbh.execute("delete from jobs where id=%r", row['id'])
+                     dbh.execute("delete from `%s` where id=%r", (row['table'], row['id']))
+
+config.add_option("JOB_DISPATCHER", default="lock",
+                  help="How workers take jobs from the queue: 'lock' locks the "
+                  "job tables, 'claim' claims batches atomically without locks")
+
+config.add_option("JOB_PREFETCH", default=1, type='int',
+                  help="Number of batches a claiming worker keeps queued "
+                  "locally in addition to the batch it is running")
+
+config.add_option("WAKEUP_DIR", default="/tmp/",
+                  help="Directory for the sockets used to wake claiming workers")
+
+config.add_option("JOB_BATCH_BYTES", default=50*1024*1024, type='int',
+                  help="Initial number of bytes of Scan jobs a claiming worker takes in one batch")
+
+config.add_option("JOB_BATCH_SECONDS", default=10, type='int',
+                  help="Claiming workers size their batches to take about this many seconds (0 disables adaptive batches)")
+
+config.add_option("JOB_BATCH_MAX", default=200, type='int',
+                  help="Maximum number of jobs a claiming worker takes in one batch")
+
+config.add_option("DISABLE_JOB_STEALING", default=False, action='store_true',
+                  help="Stop idle claiming workers from taking unstarted jobs from busy workers")
+
+def wakeup_socket_path(pid):
+    return os.path.join(config.WAKEUP_DIR, "pyflag_worker_%s.sock" % pid)
+
+config.add_option("CLAIM_STATS_PERIOD", default=60, type='int',
+                  help="Workers log how long they wait to claim jobs every this many seconds")
+
+class ClaimStats:
+    """ Keeps track of how long this worker waits for the database
+    when claiming jobs.
+
+    The counters belong to this process, so each worker logs its own
+    every config.CLAIM_STATS_PERIOD seconds.
+    """
+    def __init__(self):
+        self.claims = 0
+        self.total = 0
+        self.max = 0
+        self.last_log = time.time()
+
+    def record(self, elapsed):
+        self.claims += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+        if time.time() - self.last_log >= config.CLAIM_STATS_PERIOD:
+            self.log()
+
+    def log(self):
+        self.last_log = time.time()
+        stats = self.stats()
+        stats['pid'] = os.getpid()
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Job claims on worker %(pid)s: %(claims)s claims, %(average)s ms average, %(max)s ms max" % stats)
+
+    def stats(self):
+        return dict(claims = self.claims,
+                    average = int(self.total * 1000 / max(self.claims, 1)),
+                    max = int(self.max * 1000))
+
+CLAIM_STATS = ClaimStats()
+
+def queue_depth():
+    """ Returns the number of pending jobs in each job table """
+    dbh = DB.DBO()
+    result = {}
+    for table in ("jobs", "high_priority_jobs"):
+        dbh.execute("select count(*) as count from `%s` where state='pending'", table)
+        result[table] = dbh.fetch()['count']
+
+    return result
+
+class ClaimDispatcher:
+    """ Hands out jobs to a worker without locking the job tables.
+
+    A batch is claimed with a single update which stamps the pending
+    rows with a claim token unique to this worker, the rows carrying
+    the token are then read back. Since the update is atomic no two
+    workers can claim the same row, and no table lock is needed.
+
+    Batches are balanced by the cost column of the jobs (the size of
+    the inode for Scan jobs), so a worker takes either a few large
+    files or many small ones. The byte budget adapts to the rate this
+    worker actually achieves so a batch takes about
+    config.JOB_BATCH_SECONDS. Jobs without a cost count as
+    1/JOB_QUEUE of the budget.
+
+    Claimed jobs are kept in a local queue which is topped up before
+    it runs dry (config.JOB_PREFETCH batches ahead). Before a job is
+    started its claim is changed to our run token. Jobs which are
+    still claimed but not started may be stolen by idle workers -
+    this stops a worker which drew a few huge files from holding up
+    the tail of the scan.
+
+    When there is nothing to do the worker blocks on a unix domain
+    socket which wake_workers() writes to, instead of sleeping for
+    the full poll period.
+
+    The time each claim takes is recorded in CLAIM_STATS, which each
+    worker logs for itself.
+    """
+    def __init__(self, broadcast_id=0):
+        self.pid = os.getpid()
+        self.broadcast_id = broadcast_id
+        self.queue = []
+        self.count = 0
+        self.exhausted = False
+        self.run_token = owner_token() + ":run"
+        self.budget = config.JOB_BATCH_BYTES
+
+        ## Bytes of Scan jobs done and the time it took
+        self.done_cost = 0
+        self.done_time = 0
+        self.started = None
+
+        self.dbh = DB.DBO()
+        self.sock = None
+        self.path = wakeup_socket_path(self.pid)
+        try:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.path)
+            self.sock.setblocking(0)
+        except (AttributeError, socket.error), e:
+            ## No unix domain sockets (e.g. windows) - we just poll
+            pyflaglog.log(pyflaglog.WARNING, "Unable to create wakeup socket %s: %s" % (self.path, e))
+            self.sock = None
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def wait(self, timeout):
+        """ Waits up to timeout seconds for someone to wake us """
+        if not self.sock:
+            time.sleep(timeout)
+            return
+
+        try:
+            fds = select.select([self.sock],[],[], timeout)
+        except select.error:
+            ## Interrupted by a signal
+            return
+
+        ## Drain all outstanding wakeups
+        while fds[0]:
+            try:
+                self.sock.recv(1024)
+            except socket.error:
+                break
+
+        ## There may be new jobs now
+        self.exhausted = False
+
+    def new_token(self):
+        self.count += 1
+        return "%s:%s" % (owner_token(), self.count)
+
+    def fetch_claimed(self, table, token):
+        self.dbh.execute("select * from `%s` where claim=%r order by id", (table, token))
+        result = []
+        for row in self.dbh:
+            row['table'] = table
+            result.append(row)
+
+        return result
+
+    def claim(self, table, limit, condition=''):
+        """ Atomically claims up to limit pending jobs from table """
+        start = time.time()
+        token = self.new_token()
+        try:
+            self.dbh.execute("update `%s` set state='processing', pid=%r, claim=%r, "
+                             "lease=unix_timestamp()+%s where state='pending' %s order by id limit %s",
+                             (table, self.pid, token, config.JOB_LEASE, condition, limit))
+            if not self.dbh.cursor.rowcount:
+                return []
+
+            return self.fetch_claimed(table, token)
+        finally:
+            CLAIM_STATS.record(time.time() - start)
+
+    def claim_batch(self):
+        """ Claims a batch of jobs whose total cost is within our budget.
+
+        Returns the claimed jobs and the number of candidates we saw.
+        """
+        start = time.time()
+        try:
+            return self._claim_batch()
+        finally:
+            CLAIM_STATS.record(time.time() - start)
+
+    def _claim_batch(self):
+        self.dbh.execute("select id, cost from jobs where state='pending' "
+                         "order by id limit %s", config.JOB_BATCH_MAX)
+        default_cost = self.budget / max(config.JOB_QUEUE, 1)
+        ids = []
+        total = 0
+        candidates = 0
+        for row in self.dbh:
+            candidates += 1
+            if ids and total >= self.budget: continue
+
+            ids.append(str(row['id']))
+            total += row['cost'] or default_cost
+
+        if not ids:
+            return [], 0
+
+        token = self.new_token()
+        self.dbh.execute("update jobs set state='processing', pid=%r, claim=%r, "
+                         "lease=unix_timestamp()+%s where state='pending' and id in (%s)",
+                         (self.pid, token, config.JOB_LEASE, ",".join(ids)))
+        if not self.dbh.cursor.rowcount:
+            ## Someone beat us to all of them - try again later
+            return [], candidates
+
+        return self.fetch_claimed("jobs", token), candidates
+
+    def steal(self):
+        """ Takes half of the unstarted jobs of the busiest worker """
+        self.dbh.execute("select claim, count(*) as count from jobs "
+                         "where state='processing' and pid!=%r and claim not like '%:run' "
+                         "group by claim order by sum(cost) desc, count desc limit 1",
+                         self.pid)
+        row = self.dbh.fetch()
+        if not row:
+            return []
+
+        token = self.new_token()
+        self.dbh.execute("update jobs set pid=%r, claim=%r, lease=unix_timestamp()+%s "
+                         "where claim=%r order by id desc limit %s",
+                         (self.pid, token, config.JOB_LEASE, row['claim'],
+                          max(1, row['count'] / 2)))
+        if not self.dbh.cursor.rowcount:
+            return []
+
+        jobs = self.fetch_claimed("jobs", token)
+        pyflaglog.log(pyflaglog.DEBUG, "Stole %s jobs from %s" % (len(jobs), row['claim']))
+        return jobs
+
+    def refill(self):
+        ## Broadcasts are never claimed - every worker handles them:
+        self.dbh.execute("select * from jobs where state='broadcast' and id>%r order by id",
+                         self.broadcast_id)
+        broadcasts = []
+        for row in self.dbh:
+            row['table'] = 'jobs'
+            broadcasts.append(row)
+            self.broadcast_id = row['id']
+
+        ## Higher priority jobs go ahead of anything already queued:
+        high = self.claim("high_priority_jobs", config.JOB_QUEUE, "and when_valid <= now()")
+        self.queue = broadcasts + high + self.queue
+
+        jobs, candidates = self.claim_batch()
+        self.queue.extend(jobs)
+
+        prefetch_tasks(high + jobs)
+
+        ## If the queue is drained we dont bother asking again until
+        ## our local queue runs out (or someone wakes us):
+        self.exhausted = candidates < config.JOB_BATCH_MAX and \
+                         candidates == len(jobs)
+
+        if not self.queue and not config.DISABLE_JOB_STEALING:
+            jobs = self.steal()
+            prefetch_tasks(jobs)
+            self.queue.extend(jobs)
+
+    def start(self, row):
+        """ Marks the job as started. Returns False if it was stolen
+        from us in the mean time.
+        """
+        if row['state'] == 'broadcast':
+            return True
+
+        ## Attempts count the workers this job was started on - see
+        ## requeue_jobs():
+        self.dbh.execute("update `%s` set claim=%r, attempts=attempts+1 where id=%r and claim=%r",
+                         (row['table'], self.run_token, row['id'], row['claim']))
+
+        return self.dbh.cursor.rowcount > 0
+
+    def next(self):
+        """ Returns the next job to run or None if there is nothing to do """
+        while 1:
+            if not self.queue or (not self.exhausted and
+                                  len(self.queue) <= config.JOB_QUEUE * config.JOB_PREFETCH):
+                self.refill()
+
+            if not self.queue:
+                return None
+
+            row = self.queue.pop(0)
+            if self.start(row):
+                self.started = time.time()
+                return row
+
+    def done(self, row):
+        if row['state'] != 'broadcast':
+            self.dbh.execute("delete from `%s` where id=%r", (row['table'], row['id']))
+
+        ## Adjust our budget to the rate we are actually scanning at:
+        if row['command'] == 'Scan' and row.get('cost') and self.started:
+            self.done_cost += row['cost']
+            self.done_time += time.time() - self.started
+
+            if config.JOB_BATCH_SECONDS and self.done_time > 1:
+                rate = self.done_cost / self.done_time
+                self.budget = max(1024 * 1024, int(rate * config.JOB_BATCH_SECONDS))
+
+                ## Forget old measurements gradually:
+                if self.done_time > 10 * config.JOB_BATCH_SECONDS:
+                    self.done_cost /= 2
+                    self.done_time /= 2
+
+    def release(self):
+        """ Returns the jobs we claimed but have not started to the queue """
+        for row in self.queue:
+            if row['state'] != 'broadcast':
+                self.dbh.execute("update `%s` set state='pending', pid=0, claim=NULL, lease=0 "
+                                 "where id=%r and pid=%r", (row['table'], row['id'], self.pid))
+        self.queue = []
+
+    def exit(self, code=0):
+        try:
+            self.release()
+            self.close()
+            flush_tasks()
+        finally:
+            os._exit(code)
+
+def claim_worker_run(keepalive=None):
+    """ The main loop of a worker using the ClaimDispatcher """
+    dispatcher = ClaimDispatcher(prepare_worker())
+
+    while 1:
+        ping_nanny(keepalive)
+
+        ## Check for memory usage - we give back our queued jobs
+        ## before exiting:
+        check_mem(dispatcher.exit, 0)
+
+        try:
+            row = dispatcher.next()
+        except Exception, e:
+            pyflaglog.log(pyflaglog.ERRORS, "Unable to claim jobs: %s" % e)
+            row = None
+
+        if not row:
+            flush_tasks()
+            dispatcher.wait(config.JOB_QUEUE_POLL)
+            continue
+
+        try:
+            run_task(row)
+        finally:
+            ping_nanny(keepalive, " ".join(row))
+            dispatcher.done(row)
 
 
 def start_workers():
@@ -530,6 +1076,10 @@ def wake_workers():
     the worker polls next, so its not a big deal.
     """
     print "Waking workers %s" % (children,)
+    if config.JOB_DISPATCHER == 'claim':
+        wake_claiming_workers()
+        return
+
     try:
         for i in range(config.WORKERS):
             win32event.PulseEvent(SyncEvent)
@@ -544,11 +1094,131 @@ def wake_workers():
             os.kill(pid, signal.SIGUSR1)
         except AttributeError: pass
 
+def wake_claiming_workers():
+    """ Wakes all claiming workers on this machine through their
+    wakeup sockets. Stale sockets left by dead workers are removed.
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    except (AttributeError, socket.error):
+        return
+
+    try:
+        for name in os.listdir(config.WAKEUP_DIR):
+            if not name.startswith("pyflag_worker_"): continue
+
+            path = os.path.join(config.WAKEUP_DIR, name)
+            try:
+                sock.sendto("W", path)
+            except socket.error, e:
+                if e.args[0] == errno.ECONNREFUSED:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+    finally:
+        sock.close()
+
 config.add_option("FLUSH", default=False, action='store_true',
                   help='There are no workers currently processing, flush job queue.')
 
 atexit.register(terminate_children)
 
+## Unit Tests
+import unittest
+
+class JobQueueTests(unittest.TestCase):
+    """ Test job leases, requeueing and quarantine """
+    command = "JobQueueTest"
+
+    def setUp(self):
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        dbh = DB.DBO()
+        for table in ("jobs", "high_priority_jobs", "quarantined_jobs"):
+            dbh.delete(table, DB.expand("command=%r", self.command), _fast=True)
+
+    def insert(self, table, arg1, **kwargs):
+        dbh = DB.DBO()
+        dbh.insert(table, _fast=True, command=self.command, arg1=arg1,
+                   arg2='', arg3='', cookie=0, **kwargs)
+
+    def state(self, table, arg1):
+        dbh = DB.DBO()
+        dbh.execute("select * from `%s` where command=%r and arg1=%r",
+                    (table, self.command, arg1))
+        return dbh.fetch()
+
+    def test01Requeue(self):
+        """ Expired jobs are requeued, poisoned jobs quarantined """
+        run = "otherhost:1:run"
+        for table in ("jobs", "high_priority_jobs"):
+            ## Started once and its worker died:
+            self.insert(table, "expired", state='processing', claim=run,
+                        lease=1, attempts=1)
+            ## Claimed but never started:
+            self.insert(table, "queued", state='processing', claim="otherhost:1:queued",
+                        lease=1, attempts=config.JOB_MAX_ATTEMPTS)
+            ## Killed too many workers:
+            self.insert(table, "poisoned", state='processing', claim=run,
+                        lease=1, attempts=config.JOB_MAX_ATTEMPTS)
+            ## Its worker is still alive:
+            self.insert(table, "alive", state='processing', claim=run,
+                        _lease="unix_timestamp()+1000", attempts=1)
+
+        requeue_expired_jobs()
+
+        for table in ("jobs", "high_priority_jobs"):
+            for arg1 in ("expired", "queued"):
+                row = self.state(table, arg1)
+                self.assertEqual(row['state'], 'pending')
+                self.assertEqual(row['claim'], None)
+                self.assertEqual(row['lease'], 0)
+
+            self.assertEqual(self.state(table, "poisoned"), None)
+            self.assertEqual(self.state(table, "alive")['state'], 'processing')
+
+        dbh = DB.DBO()
+        dbh.execute("select count(*) as count from quarantined_jobs where command=%r and arg1='poisoned'",
+                    self.command)
+        self.assertEqual(dbh.fetch()['count'], 2)
+
+    def test02Claim(self):
+        """ Claiming leases jobs, starting them counts an attempt """
+        for i in range(3):
+            self.insert("jobs", str(i), state='pending')
+
+        dispatcher = ClaimDispatcher()
+        claims = CLAIM_STATS.claims
+        try:
+            jobs = dispatcher.claim("jobs", 10, DB.expand("and command=%r", self.command))
+            self.assertEqual(len(jobs), 3)
+            self.assertEqual(CLAIM_STATS.claims, claims + 1)
+
+            for row in jobs:
+                self.assertEqual(row['state'], 'processing')
+                self.assert_(row['claim'].startswith(owner_token() + ":"))
+                self.assert_(row['lease'] > time.time())
+                self.assertEqual(row['attempts'], 0)
+
+            ## Only the started job counts an attempt:
+            self.assert_(dispatcher.start(jobs[0]))
+            row = self.state("jobs", jobs[0]['arg1'])
+            self.assertEqual(row['claim'], dispatcher.run_token)
+            self.assertEqual(row['attempts'], 1)
+            self.assertEqual(self.state("jobs", jobs[1]['arg1'])['attempts'], 0)
+
+            ## A job claimed by someone else can not be started:
+            dbh = DB.DBO()
+            dbh.execute("update jobs set claim='otherhost:1:2' where id=%r", jobs[1]['id'])
+            self.assert_(not dispatcher.start(jobs[1]))
+        finally:
+            dispatcher.close()
+
 if __name__ == "__main__":
     import pyflag.Registry as Registry
     import pyflag.conf
@@ -156,6 +156,12 @@ class FileSystem:
                     retfd.seek(0)
 ##                    print "Got %s from cache (%s)" % (inode_so_far, FSCache.size())
                 except KeyError:
+                    ## Drivers layered on other VFS files read them
+                    ## through the block cache (IO sources do their
+                    ## own caching):
+                    if len(sofar) > 2 and config.VFS_BLOCK_CACHE > 0:
+                        retfd = BlockCachedFile(retfd)
+
                     retfd = Registry.VFS_FILES.vfslist[part[0]](self.case, retfd, '|'.join(sofar))
 
             except IndexError:
@@ -231,6 +237,53 @@ class FileSystem:
     def form(self, query, result):
         """ We are able to ask for more optional variables here """
     
+config.add_option("INODE_ID_RESERVATION", default=1000, type='int',
+                  help="Number of inode_ids loaders reserve at once for inodes they create later")
+
+class InodeIDAllocator:
+    """ Hands out inode_ids for inodes which will only be created later.
+
+    Loaders sometimes need to know the inode_id of a VFS inode before
+    they are ready to create it (e.g. the reassembler stores packets
+    against a stream long before the stream is complete). Rather than
+    inserting and deleting a dummy inode for each, we reserve a range
+    of ids from the inode table's auto increment counter at a time.
+    """
+    def __init__(self, case, size=None):
+        self.case = case
+        self.size = size or config.INODE_ID_RESERVATION
+        self.next_id = 0
+        self.end = 0
+
+    def reserve(self):
+        dbh = DB.DBO(self.case)
+        ## Nobody else may take ids from the middle of our range:
+        dbh.execute("lock tables inode write")
+        try:
+            dbh.insert('inode', _inode_id='NULL', _fast=True)
+            first = dbh.autoincrement()
+            last = first + self.size - 1
+
+            ## Inserting the last id explicitly moves the counter past
+            ## the range:
+            if last > first:
+                dbh.insert('inode', inode_id=last, _fast=True)
+
+            dbh.delete('inode', where = 'inode_id in (%s, %s)' % (first, last), _fast=True)
+        finally:
+            dbh.execute("unlock tables")
+
+        self.next_id = first
+        self.end = last + 1
+
+    def next(self):
+        if self.next_id >= self.end:
+            self.reserve()
+
+        result = self.next_id
+        self.next_id += 1
+        return result
+
 class DBFS(FileSystem):
     """ Class for accessing filesystems using data in the database """
     def __init__(self, case, query=None):
@@ -606,6 +659,158 @@ def goto_page_cb(query,result,variable):
     result.end_table()
     result.end_form()
 
+config.add_option("VFS_BLOCK_SIZE", default=64*1024, type='int',
+                  help="Size of the blocks cached between layered VFS drivers")
+
+config.add_option("VFS_BLOCK_CACHE", default=32*1024*1024, type='int',
+                  help="Memory used to cache blocks read between layered VFS drivers (0 to disable)")
+
+import thread
+
+class BlockCache:
+    """ A process wide LRU cache of aligned blocks of VFS files.
+
+    Blocks are keyed by (case, inode, block number), and the least
+    recently used blocks are dropped once the cache holds more than
+    VFS_BLOCK_CACHE bytes.
+    """
+    def __init__(self):
+        self.mutex = thread.allocate_lock()
+        self.blocks = {}
+        ## keys in least recently used first order
+        self.lru = []
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self.mutex.acquire()
+        try:
+            data = self.blocks[key]
+            self.hits += 1
+            if self.lru[-1] != key:
+                self.lru.remove(key)
+                self.lru.append(key)
+
+            return data
+        finally:
+            self.mutex.release()
+
+    def put(self, key, data):
+        self.mutex.acquire()
+        try:
+            if key in self.blocks: return
+
+            self.misses += 1
+            self.blocks[key] = data
+            self.lru.append(key)
+            self.bytes += len(data)
+            while self.bytes > config.VFS_BLOCK_CACHE and self.lru:
+                self.bytes -= len(self.blocks.pop(self.lru.pop(0)))
+        finally:
+            self.mutex.release()
+
+    def expire(self, case):
+        """ Drops all blocks of case """
+        self.mutex.acquire()
+        try:
+            for key in self.lru[:]:
+                if key[0] == case:
+                    self.lru.remove(key)
+                    self.bytes -= len(self.blocks.pop(key))
+        finally:
+            self.mutex.release()
+
+BLOCK_CACHE = BlockCache()
+
+class BlockCachedFile:
+    """ Presents a VFS File to the driver layered on top of it.
+
+    Drivers typically read their parent in small, often repeated
+    pieces (headers, chunk markers, lines). We read the parent in
+    aligned VFS_BLOCK_SIZE blocks through the BLOCK_CACHE instead, so
+    those reads do not go through the whole driver stack below us.
+
+    All other attributes are those of the parent file. Slack and
+    overread reads, and files of unknown size, are passed straight
+    through.
+    """
+    def __init__(self, fd):
+        self.__dict__['fd'] = fd
+        self.__dict__['readptr'] = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.fd, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.fd, attr, value)
+
+    def read_block(self, block):
+        key = (self.fd.case, self.fd.inode, block)
+        try:
+            return BLOCK_CACHE.get(key)
+        except KeyError:
+            pass
+
+        block_size = config.VFS_BLOCK_SIZE
+        self.fd.seek(block * block_size)
+        data = ''
+        while len(data) < block_size:
+            tmp = self.fd.read(block_size - len(data))
+            if not tmp: break
+            data += tmp
+
+        BLOCK_CACHE.put(key, data)
+        return data
+
+    def read(self, length=None):
+        fd = self.fd
+        readptr = self.readptr
+        if getattr(fd, 'slack', False) or fd.overread or getattr(fd, 'size', 0) <= 0:
+            fd.seek(readptr)
+            if length is None:
+                data = fd.read()
+            else:
+                data = fd.read(length)
+
+            self.__dict__['readptr'] = readptr + len(data)
+            return data
+
+        available = fd.size - readptr
+        if length is None or length > available:
+            length = available
+
+        block_size = config.VFS_BLOCK_SIZE
+        result = []
+        while length > 0:
+            block, offset = divmod(readptr, block_size)
+            data = self.read_block(block)[offset:offset + length]
+            if not data: break
+
+            result.append(data)
+            readptr += len(data)
+            length -= len(data)
+
+        self.__dict__['readptr'] = readptr
+        return ''.join(result)
+
+    def seek(self, offset, whence=0):
+        if whence==1:
+            offset += self.readptr
+        elif whence==2:
+            offset += self.fd.size
+
+        if offset < 0:
+            raise IOError("Invalid Arguement")
+
+        self.__dict__['readptr'] = offset
+        return offset
+
+    def tell(self):
+        return self.readptr
+
+    def close(self):
+        self.fd.close()
 
 class File:
     """ This abstract base class documents the file like object used to read specific files in PyFlag.
@@ -830,19 +1035,56 @@ class File:
         
         return stat_names, stat_cbs
 
-    def readline(self,delimiter='\n'):
-        """ Emulates a readline by reading upto the \n """
-        buffer = ''
+    ## Data read ahead by readline() and the offset it starts at:
+    line_buffer = ''
+    line_buffer_offset = -1
+    readline_size = 4096
+
+    def readuntil(self, delimiter, limit=None):
+        """ Reads up to and including delimiter (or the end of file).
+
+        If limit is given we return no more than limit bytes. Data read
+        past the delimiter is kept for the next call, so parsing a file
+        line by line does not need a read per line.
+        """
         start = self.tell()
+        if start == self.line_buffer_offset:
+            buffer = self.line_buffer
+        else:
+            buffer = ''
+
+        search_from = 0
         while 1:
-            try:
-                o = buffer.index(delimiter)+1
-                self.seek(start+o)
-                return buffer[:o]
-            except ValueError:
-                data=self.read(256)
-                if len(data)==0: return buffer
-                buffer += data
+            o = buffer.find(delimiter, search_from)
+            if o >= 0:
+                o += len(delimiter)
+                break
+
+            if limit and len(buffer) >= limit:
+                o = limit
+                break
+
+            ## The delimiter may straddle two reads:
+            search_from = max(0, len(buffer) - len(delimiter) + 1)
+            self.seek(start + len(buffer))
+            data = self.read(self.readline_size)
+            if not data:
+                o = len(buffer)
+                break
+
+            buffer += data
+
+        if limit:
+            o = min(o, limit)
+
+        self.seek(start + o)
+        self.line_buffer = buffer[o:]
+        self.line_buffer_offset = start + o
+        return buffer[:o]
+
+    def readline(self,delimiter='\n'):
+        """ Emulates a readline by reading upto the \n """
+        return self.readuntil(delimiter)
 
 
     def explain(self, query, result):
@@ -80,6 +80,152 @@ import pyflag.DB as DB
 ## This caches the io subsys
 IO_Cache = Store.Store()
 
+import thread
+
+config.add_option("MAX_OPEN_FILES", default=64, type='int',
+                  help="Maximum number of files kept open by the file descriptor pool")
+
+class FDPool:
+    """ A process wide pool of open files.
+
+    Image drivers and the cache manager may need to read from a very
+    large number of files (e.g. each segment of a split image, or each
+    object in the cache), and scanning nested files opens many of
+    them repeatedly. Rather than each reader holding an open file, we
+    keep the most recently used MAX_OPEN_FILES open here and readers
+    issue positioned reads against the pool by path. Files which fall
+    off the end are closed and simply reopened when needed again.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.mutex = thread.allocate_lock()
+        ## path -> file object
+        self.fds = {}
+        ## paths in least recently used first order
+        self.lru = []
+        self.pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_fd(self, path):
+        """ Returns an open file for path - must be called with the mutex held """
+        ## Open files share their file pointer with our parent after a
+        ## fork so we can not use them:
+        if self.pid != os.getpid():
+            self.fds = {}
+            self.lru = []
+            self.pid = os.getpid()
+
+        try:
+            fd = self.fds[path]
+            self.hits += 1
+            if self.lru[-1] != path:
+                self.lru.remove(path)
+                self.lru.append(path)
+
+            return fd
+        except KeyError:
+            pass
+
+        self.misses += 1
+        max_size = self.max_size or config.MAX_OPEN_FILES
+        while self.lru and len(self.lru) >= max_size:
+            self.fds.pop(self.lru.pop(0)).close()
+            self.evictions += 1
+
+        ## Note that open() is shadowed in this module:
+        fd = self.fds[path] = file(path, 'rb')
+        self.lru.append(path)
+        return fd
+
+    def read(self, path, offset, length):
+        """ Reads length bytes from path starting at offset """
+        self.mutex.acquire()
+        try:
+            fd = self.get_fd(path)
+            fd.seek(offset)
+            return fd.read(length)
+        finally:
+            self.mutex.release()
+
+    def size(self, path):
+        self.mutex.acquire()
+        try:
+            return os.fstat(self.get_fd(path).fileno()).st_size
+        finally:
+            self.mutex.release()
+
+    def open(self, path):
+        """ Returns a file like object for path which does not hold a
+        file descriptor.
+        """
+        return PooledFile(self, path)
+
+    def expire(self, regex):
+        """ Closes all files with paths matching the regex """
+        self.mutex.acquire()
+        try:
+            for path in self.lru[:]:
+                if re.search(regex, path):
+                    self.lru.remove(path)
+                    self.fds.pop(path).close()
+        finally:
+            self.mutex.release()
+
+    def forget(self, path):
+        """ Closes path - this must be called when files are replaced """
+        self.mutex.acquire()
+        try:
+            if path in self.fds:
+                self.lru.remove(path)
+                self.fds.pop(path).close()
+        finally:
+            self.mutex.release()
+
+    def flush(self):
+        self.expire('.')
+
+    def stats(self):
+        return dict(open = len(self.lru), hits = self.hits,
+                    misses = self.misses, evictions = self.evictions)
+
+class PooledFile:
+    """ A read only file like object reading through an FDPool """
+    def __init__(self, pool, path):
+        self.pool = pool
+        self.name = path
+        self.offset = 0
+        ## This raises IOError if the file can not be opened
+        self.size = pool.size(path)
+
+    def read(self, length=None):
+        if length is None or length < 0:
+            length = self.size - self.offset
+
+        data = self.pool.read(self.name, self.offset, int(length))
+        self.offset += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence==0:
+            self.offset = offset
+        elif whence==1:
+            self.offset += offset
+        elif whence==2:
+            self.offset = self.size + offset
+
+        if self.offset < 0:
+            self.offset = 0
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        pass
+
+FD_POOL = FDPool()
+
 
 class FileHandler:
     """ This is a base class for handling files.
@@ -37,12 +37,131 @@ config=pyflag.conf.ConfObject()
 import pyflag.pyflaglog as pyflaglog
 import pickle,gzip
 import plugins.LogAnalysis.Whois as Whois
-from pyflag.ColumnTypes import IPType
+from pyflag.ColumnTypes import IPType, IntegerType, TimestampType
 import re
 import pyflag.Registry as Registry
 import pyflag.IO as IO
 import cStringIO
 import pyflag.code_parser as code_parser
+import pyflag.Farm as Farm
+import os, time, marshal, select
+from hashlib import md5
+
+config.add_option("LOG_LOAD_WORKERS", default=0, type='int',
+                  help="Number of processes parsing log files in parallel (0 parses in the loader)")
+
+config.add_option("LOG_CHUNK_SIZE", default=16*1024*1024, type='int',
+                  help="Size of the pieces log files are split into for parallel loading")
+
+config.add_option("LOG_ROLLUPS", default=False, action='store_true',
+                  help="Build the time rollups of timestamp columns when loading log files "
+                  "(otherwise they are built when first needed)")
+
+def read_lines(fd, start=0, end=None, size=1024*1024, partial=True):
+    """ Generates the lines of fd which start in the byte range
+    [start, end).
+
+    Ranges do not need to fall on line boundaries - a line belongs to
+    the range its first byte is in, so adjacent ranges together
+    produce every line exactly once. The line terminators are
+    stripped. If partial is False, a final line without a terminator
+    is not returned (it may still be being written).
+    """
+    if start > 0:
+        ## We need to know if start is the beginning of a line:
+        fd.seek(start - 1)
+        buffer = fd.read(size + 1)
+        offset = start - 1
+        if not buffer: return
+
+        if buffer[0] == '\n':
+            buffer = buffer[1:]
+            offset = start
+        else:
+            ## Skip the line which started in the previous range:
+            i = buffer.find('\n')
+            while i < 0:
+                offset += len(buffer)
+                buffer = fd.read(size)
+                if not buffer: return
+                i = buffer.find('\n')
+
+            offset += i + 1
+            buffer = buffer[i+1:]
+    else:
+        offset = 0
+        buffer = ''
+
+    while 1:
+        lines = buffer.split('\n')
+        buffer = lines.pop(-1)
+        for line in lines:
+            if end is not None and offset >= end:
+                return
+
+            offset += len(line) + 1
+            yield line
+
+        if end is not None and offset >= end:
+            return
+
+        data = fd.read(size)
+        if not data: break
+        buffer += data
+
+    ## The last line may not be terminated:
+    if buffer and partial and (end is None or offset < end):
+        yield buffer
+
+def check_progress_table(dbh):
+    """ Makes sure the case has a log_progress table (older cases do
+    not have one).
+    """
+    dbh.execute("""create table if not exists `log_progress` (
+    `table_name` varchar(250) NOT NULL,
+    `datafile` varchar(250) NOT NULL,
+    `fingerprint` varchar(250) NOT NULL,
+    `offset` bigint NOT NULL default 0,
+    `size` bigint default NULL,
+    primary key (`table_name`, `datafile`)
+    ) engine=MyISAM""")
+
+def fingerprint(fd, length):
+    """ Returns a string identifying the file fd by its inode and the
+    md5 of its first length bytes.
+    """
+    try:
+        inode = os.stat(fd.name).st_ino
+    except (AttributeError, TypeError, OSError):
+        inode = 0
+
+    fd.seek(0)
+    data = fd.read(length)
+    return "%s:%s:%s" % (inode, len(data), md5(data).hexdigest())
+
+def open_fresh(file):
+    """ Opens file, making sure we do not read a replaced (e.g.
+    rotated) file through a descriptor FD_POOL held on to.
+    """
+    fd = IO.open_URL(file)
+    if isinstance(fd, IO.PooledFile):
+        fd.pool.forget(fd.name)
+        fd = IO.open_URL(file)
+
+    return fd
+
+def file_size(fd):
+    """ Returns the size of fd or None if we can not tell (e.g. it is
+    compressed).
+    """
+    if isinstance(fd, IO.PooledFile):
+        return fd.size
+
+def same_file(old, new):
+    """ Compares two fingerprints. Files are the same if their
+    beginnings are the same - they may have been moved.
+    """
+    return old.split(":",1)[1] == new.split(":",1)[1]
 
 def get_file(query,result):
     result.row("Select a sample log file for the previewer",stretch=False)
@@ -100,6 +219,7 @@ class Log:
         """
         tablename = name + "_log"
         dbh = DB.DBO(self.case)
+        drop_rollups(dbh, tablename)
         dbh.drop(tablename)
         
     def form(self,query,result):
@@ -145,6 +265,23 @@ class Log:
             except RuntimeError:
                 pass
             
+    ## A list of (datafile, start, end) byte ranges to read - if this
+    ## is None we read all the datafiles.
+    ranges = None
+
+    ## Drivers which do not read their datafiles through read_record
+    ## must set this to False. Such drivers can not be loaded in
+    ## parallel or incrementally.
+    parallel_load = True
+
+    ## During incremental loads this is the offset we have read each
+    ## datafile up to.
+    positions = None
+
+    ## How much of the start of the datafiles we use to recognise them:
+    fingerprint_size = 4096
+    bytes_read = 0
+
     def read_record(self, ignore_comment = True):
         """ Generates records.
 
@@ -155,30 +292,19 @@ class Log:
 
         if self.datafile==None:
             raise IOError("Datafile is not set!!!")
-        
-        for file in self.datafile:
+
+        positions = self.positions
+        ranges = self.ranges or [ (file, 0, None) for file in self.datafile ]
+        for file, start, end in ranges:
             ## open the file as a url:
             fd = IO.open_URL(file)
-            buffer = ''
-            while 1:
-                if len(buffer) < 1024:
-                    data = fd.read(1024)
-                    buffer = buffer + data
+            offset = start
+            for line in read_lines(fd, start, end, partial = positions is None):
+                self.bytes_read += len(line) + 1
+                if positions is not None:
+                    offset += len(line) + 1
+                    positions[file] = offset
 
-                tmp = buffer.split("\n",1)
-                if len(tmp) == 0: break
-
-                line = tmp[0]
-               
-                try:
-                    buffer = tmp[1]
-                except:
-                    data = fd.read(1024)
-                    if len(data) == 0:
-                        break
-                    buffer = line + data
-                    continue
-                
                 if blank.match(line) or not line:
                     continue
                 if line.startswith('#') and ignore_comment:
@@ -198,7 +324,8 @@ class Log:
         ## By default we dont split the row
         return [self.read_record(),]
     
-    def load(self,name, rows = None, deleteExisting=None, filter=None):
+    def load(self,name, rows = None, deleteExisting=None, filter=None,
+             incremental=False):
         """ Loads the specified number of rows into the database.
 
         __NOTE__ We assume this generator will run to
@@ -208,6 +335,8 @@ class Log:
         @arg table_name: A table name to use
         @arg rows: number of rows to upload - if None , we upload them all
         @arg deleteExisting: If this is anything but none, tablename will first be dropped
+        @arg incremental: If set we only load the data which has not
+        been loaded into the table before - see load_incremental().
         @return: A generator that represents the current progress indication.
         """
         ## We append _log to tablename to prevent name clashes in the
@@ -255,6 +384,61 @@ class Log:
             filter_parser = None
 
         ## Now insert into the table:
+        start_time = time.time()
+        self.bytes_read = 0
+        if rows is None and not incremental and config.LOG_LOAD_WORKERS > 1 \
+               and hasattr(os, 'fork'):
+            ranges = self.split_ranges()
+        else:
+            ranges = None
+
+        if incremental:
+            if not self.reads_records():
+                raise RuntimeError("Log driver %s can not load incrementally" % self.__class__.__name__)
+
+            for message in self.load_incremental(dbh, name, filter_parser):
+                yield message
+        elif ranges and len(ranges) > 1:
+            for message in self.load_parallel(tablename, ranges, filter_parser):
+                yield message
+        else:
+            for count in self.insert_rows(dbh, filter_parser, rows):
+                yield self.progress(count, self.bytes_read, start_time)
+
+        dbh.mass_insert_commit()
+        ## Now create indexes on the required fields
+        for i in self.fields:
+            try:
+                ## Allow the column type to create an index on the
+                ## column
+                if i.index:
+                    i.make_index(dbh, tablename)
+            except AttributeError:
+                pass
+
+        if config.LOG_ROLLUPS:
+            fields = [ x for x in self.fields if x]
+            numbers = [ f.column for f in fields if isinstance(f, IntegerType) and \
+                        not isinstance(f, TimestampType) ]
+            for f in fields:
+                if isinstance(f, TimestampType):
+                    yield "Building time rollups for %s" % f.column
+                    get_rollup(dbh, tablename, f.column, ROLLUP_BINS[-1], numbers)
+
+        return
+
+    def progress(self, count, bytes, start_time):
+        elapsed = max(time.time() - start_time, 0.001)
+        return "Loaded %s rows (%d rows/s, %d bytes/s)" % (
+            count, count / elapsed, bytes / elapsed)
+
+    def insert_rows(self, dbh, filter_parser, rows=None):
+        """ Inserts the rows from get_fields() using dbh's mass insert.
+
+        This is a generator which yields the number of rows read every
+        1000 rows. The total is left in self.rows_read.
+        """
+        columns_list = [ x for x in self.fields if x]
         count = 0
         for fields in self.get_fields():
             count += 1
@@ -284,7 +468,7 @@ class Log:
                 
             ## If the filter does not match, we ignore this row:
             if filter_parser:
-                if not filter_parser(columns): continue
+                if not filter_parser(columns): args = None
 
             if args:
                 dbh.mass_insert(args)
@@ -293,20 +477,258 @@ class Log:
                 break
 
             if not count % 1000:
-                yield "Loaded %s rows" % count
+                for c in columns_list:
+                    c.flush()
+                    
+                yield count
+
+        for c in columns_list:
+            c.flush()
+
+        self.rows_read = count
+
+    def load_incremental(self, dbh, name, filter_parser):
+        """ Loads only the data which was not loaded into table name
+        before.
+
+        For each datafile we remember how far we have read in the
+        log_progress table, together with a fingerprint of the file.
+        The progress is saved whenever a batch of rows is written to
+        the table, so the saved offsets always match the rows in the
+        table. If a load dies we resume after the last written batch,
+        and when more data is appended to a log file only the new
+        data is loaded. Files which were replaced (e.g. rotated) are loaded
+        from the start.
+        """
+        check_progress_table(dbh)
+        start_time = time.time()
+
+        self.positions = {}
+        self.ranges = []
+        for file in self.datafile:
+            start = self.resume_offset(dbh, name, file)
+            self.positions[file] = start
+            self.ranges.append((file, start, None))
 
+        ## Rows still in a background writer can not be matched to
+        ## the offsets:
         dbh.mass_insert_commit()
-        ## Now create indexes on the required fields
-        for i in self.fields:
+
+        def checkpoint():
+            self.save_progress(dbh, name)
+
+        dbh.mass_insert_callback = checkpoint
+        try:
+            for count in self.insert_rows(dbh, filter_parser):
+                yield self.progress(count, self.bytes_read, start_time)
+
+            dbh.mass_insert_commit()
+            ## Also covers the rows at the end of the files which
+            ## were not loaded (e.g. comments):
+            self.save_progress(dbh, name)
+        finally:
+            dbh.mass_insert_callback = None
+            self.positions = None
+            self.ranges = None
+
+    def resume_offset(self, dbh, name, file):
+        """ Returns the offset in file we need to load table name from """
+        dbh.execute("select `fingerprint`, `offset` from log_progress where "
+                    "table_name=%r and datafile=%r", (name, file))
+        row = dbh.fetch()
+        if not row: return 0
+
+        fd = open_fresh(file)
+        length = int(row['fingerprint'].split(":")[1])
+        size = file_size(fd)
+        if not same_file(row['fingerprint'], fingerprint(fd, length)) or \
+               (size is not None and size < row['offset']):
+            pyflaglog.log(pyflaglog.INFO, "Log file %s has changed since it was "
+                          "loaded into %s - loading it from the start" % (file, name))
+            return 0
+
+        pyflaglog.log(pyflaglog.DEBUG, "Loading %s into %s from offset %s" % (
+            file, name, row['offset']))
+        return row['offset']
+
+    def save_progress(self, dbh, name):
+        """ Records how far into each datafile we have loaded. The
+        rows up to there must have been committed already.
+        """
+        for file, offset in self.positions.items():
+            fd = IO.open_URL(file)
+            size = file_size(fd)
+            if size is None: size = "NULL"
+
+            dbh.delete("log_progress", _fast=True,
+                       where=DB.expand("table_name=%r and datafile=%r", (name, file)))
+            dbh.insert("log_progress", _fast=True,
+                       table_name = name,
+                       datafile = file,
+                       fingerprint = fingerprint(fd, min(offset, self.fingerprint_size)),
+                       offset = offset,
+                       _size = size)
+
+    def reads_records(self):
+        """ Returns True if this driver reads its datafiles through
+        Log.read_record, which honours ranges and keeps positions.
+        """
+        return self.parallel_load and \
+               self.read_record.im_func is Log.read_record.im_func
+
+    def split_ranges(self):
+        """ Splits our datafiles into newline aligned ranges for
+        parallel loading.
+
+        Returns None if this driver can not be loaded in parallel
+        (i.e. it reads its files in some other way than through
+        read_record). Compressed files can not be seeked efficiently
+        so they are a single range each.
+        """
+        if self.datafile == None or not self.reads_records():
+            return None
+
+        chunk = max(config.LOG_CHUNK_SIZE, 1024)
+        ranges = []
+        for file in self.datafile:
+            fd = IO.open_URL(file)
+            if not isinstance(fd, IO.PooledFile):
+                ranges.append((file, 0, None))
+                continue
+
+            for start in range(0, fd.size, chunk):
+                ranges.append((file, start, start + chunk))
+
+        return ranges
+
+    def load_parallel(self, tablename, ranges, filter_parser):
+        """ Loads ranges into tablename using LOG_LOAD_WORKERS processes.
+
+        Each worker parses the ranges it is given with this driver and
+        streams the rows into the table through its own mass insert
+        buffer. We hand out the ranges as workers become free and
+        report progress as they finish them. Note that rows are not
+        inserted in file order.
+        """
+        workers = min(config.LOG_LOAD_WORKERS, len(ranges))
+        start_time = time.time()
+        count = 0
+        bytes = 0
+
+        ## Each worker has a pipe for ranges and one for results:
+        children = {}
+        for i in range(workers):
+            tasks = os.pipe()
+            results = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(tasks[1])
+                os.close(results[0])
+                ## Dont hold the other workers' pipes open:
+                for other, infd, outfd in children.values():
+                    infd.close()
+                    outfd.close()
+
+                try:
+                    self.load_worker(tablename, filter_parser,
+                                     os.fdopen(tasks[0], 'rb'),
+                                     os.fdopen(results[1], 'wb'))
+                except Exception, e:
+                    pyflaglog.log(pyflaglog.ERRORS, "Log loading worker failed: %s" % e)
+                    os._exit(1)
+
+                os._exit(0)
+
+            os.close(tasks[0])
+            os.close(results[1])
+            infd = os.fdopen(results[0], 'rb')
+            children[infd.fileno()] = (pid, infd, os.fdopen(tasks[1], 'wb'))
+
+        def send(outfd, task):
+            marshal.dump(task, outfd)
+            outfd.flush()
+
+        error = None
+        try:
+            ranges = ranges[:]
+            busy = []
+            for pid, infd, outfd in children.values():
+                send(outfd, ranges.pop(0))
+                busy.append(infd.fileno())
+
+            while busy:
+                ready = select.select(busy, [], [])[0]
+                for fileno in ready:
+                    pid, infd, outfd = children[fileno]
+                    try:
+                        result = marshal.load(infd)
+                    except EOFError:
+                        result = "Worker %s died" % pid
+
+                    if isinstance(result, str):
+                        error = error or result
+                        busy.remove(fileno)
+                        ## Don't hand out any more work:
+                        ranges = []
+                        continue
+
+                    count += result[0]
+                    bytes += result[1]
+                    if ranges:
+                        send(outfd, ranges.pop(0))
+                    else:
+                        busy.remove(fileno)
+
+                yield self.progress(count, bytes, start_time)
+        finally:
+            for pid, infd, outfd in children.values():
+                try:
+                    send(outfd, None)
+                    outfd.close()
+                except IOError:
+                    pass
+
+                infd.close()
+                pid, status = os.waitpid(pid, 0)
+                if status:
+                    pyflaglog.log(pyflaglog.ERRORS, "Log loading worker %s exited with status %s" % (pid, status))
+
+        if error:
+            raise RuntimeError("Unable to load log file: %s" % error)
+
+        self.rows_read = count
+        self.bytes_read = bytes
+
+    def load_worker(self, tablename, filter_parser, tasks, results):
+        """ Runs in a forked worker - loads each range sent on tasks
+        and returns (rows, bytes) or an error message on results.
+        """
+        Farm.forget_db_handles()
+        dbh = DB.DBO(self.case)
+        dbh.cursor.ignore_warnings = True
+        dbh.mass_insert_start(tablename, _fast=True)
+        while 1:
             try:
-                ## Allow the column type to create an index on the
-                ## column
-                if i.index:
-                    i.make_index(dbh, tablename)
-            except AttributeError:
-                pass
+                task = marshal.load(tasks)
+            except EOFError:
+                break
 
-        return
+            if task is None: break
+
+            try:
+                self.ranges = [ task ]
+                self.bytes_read = 0
+                for x in self.insert_rows(dbh, filter_parser):
+                    pass
+
+                dbh.mass_insert_commit()
+                result = (self.rows_read, self.bytes_read)
+            except Exception, e:
+                pyflaglog.log(pyflaglog.ERRORS, "Error loading %s: %s" % (task, e))
+                result = "%s: %s" % (task, e)
+
+            marshal.dump(result, results)
+            results.flush()
 
     def restore(self, name):
         """ Restores the table from the log tables (This is the
@@ -351,6 +773,95 @@ class Log:
 
         return result
 
+## Time rollups: Reports often want the number of rows (or the total
+## of some column) in a log table per time bin. Rather than grouping
+## the entire log table each time, we keep rollup tables with the
+## rows per minute, hour and day (and any other bin size asked
+## for). Coarser bins are calculated from the finer rollups so only
+## the first rollup needs to scan the log table. A rollup table has
+## the columns bin (the start of the bin as a unix time), time (the
+## same as a datetime), count and sum_<column> for each column summed.
+ROLLUP_BINS = [60, 3600, 86400]
+
+def rollup_name(logtable, timestamp, bin_size):
+    return "%s_%s_rollup%s" % (logtable, timestamp, bin_size)
+
+def rollup_columns(dbh, name, total):
+    """ Returns the columns summed by the rollup table name, or None
+    if it does not exist or is out of date (it does not account for
+    total rows).
+    """
+    dbh.execute("show tables like %r", name)
+    if not dbh.fetch(): return None
+
+    dbh.execute("select sum(`count`) as c from `%s`", name)
+    row = dbh.fetch()
+    if int(row['c'] or 0) != total: return None
+
+    dbh.execute("select * from `%s` limit 1", name)
+    return [ d[0][len("sum_"):] for d in dbh.cursor.description \
+             if d[0].startswith("sum_") ]
+
+def get_rollup(dbh, logtable, timestamp, bin_size, columns=()):
+    """ Returns the name of a rollup table of logtable in bins of
+    bin_size seconds of the timestamp column, including the sums of
+    columns. The table is (re)built if needed.
+    """
+    dbh.execute("select count(*) as c from `%s`", logtable)
+    total = int(dbh.fetch()['c'])
+    return build_rollup(dbh, logtable, timestamp, int(bin_size), list(columns), total)
+
+def build_rollup(dbh, logtable, timestamp, bin_size, columns, total):
+    name = rollup_name(logtable, timestamp, bin_size)
+    existing = rollup_columns(dbh, name, total)
+    if existing is not None:
+        missing = [ c for c in columns if c not in existing ]
+        if not missing: return name
+
+        columns = existing + missing
+    
+    ## Find the coarsest rollup we can calculate this one from:
+    source_bin = None
+    for b in ROLLUP_BINS:
+        if b < bin_size and bin_size % b == 0:
+            source_bin = b
+
+    if source_bin:
+        source = build_rollup(dbh, logtable, timestamp, source_bin, columns, total)
+        bin = "floor(`bin`/%s)*%s" % (bin_size, bin_size)
+        selects = [ "sum(`count`)" ] + [ "sum(`sum_%s`)" % c for c in columns ]
+    else:
+        source = logtable
+        bin = "floor(unix_timestamp(`%s`)/%s)*%s" % (timestamp, bin_size, bin_size)
+        selects = [ "count(*)" ] + [ "sum(`%s`)" % c for c in columns ]
+
+    pyflaglog.log(pyflaglog.DEBUG, "Building rollup %s from %s" % (name, source))
+    dbh.drop(name)
+    dbh.execute("create table `%s` (`bin` bigint, `time` datetime, `count` bigint, %s"
+                "key(`bin`)) engine=MyISAM", (name,
+                ''.join([ "`sum_%s` bigint, " % c for c in columns ])))
+
+    dbh.execute("insert into `%s` select %s, from_unixtime(%s), %s from `%s` group by 1",
+                (name, bin, bin, ','.join(selects), source))
+
+    return name
+
+def drop_rollups(dbh, logtable):
+    """ Drops all the rollups of logtable """
+    try:
+        dbh.execute("show columns from `%s`", logtable)
+    except DB.DBError:
+        return
+
+    columns = [ row['Field'] for row in dbh ]
+    dbh.execute("show tables like %r", logtable + "%rollup%")
+    names = [ row.values()[0] for row in dbh ]
+    for name in names:
+        for c in columns:
+            if re.match("%s_rollup\\d+$" % re.escape("%s_%s" % (logtable, c)), name):
+                dbh.drop(name)
+                break
+
 ## The following methods unify manipulation and access of log presets.
 ## The presets are stored in FLAGDB.log_presets and the table names
 ## are stored in casedb.log_tables. The names specified in the
@@ -403,6 +914,11 @@ def drop_table(case, name):
     dbh.delete("log_tables",
                where= DB.expand("table_name = %r ", name));
 
+    ## Forget how much of the datafiles were loaded into it:
+    check_progress_table(dbh)
+    dbh.delete("log_progress",
+               where= DB.expand("table_name = %r ", name));
+
     ## Make sure that the reports get all reset
     FlagFramework.reset_all(family='Load Data', report="Load Preset Log File",
                                        table = name, case=case)
@@ -477,6 +993,21 @@ class LogDriverTester(unittest.TestCase):
         drop_table(self.test_case, self.test_table)
         drop_table(self.test_case, self.test_table_two)
 
+    def compare_rates(self, before, after, lines):
+        """ Reports how many lines/s the before and after record
+        processing functions manage on lines.
+        """
+        rates = []
+        for function in (before, after):
+            t = time.time()
+            for line in lines:
+                function(line)
+
+            rates.append(len(lines) / max(time.time() - t, 0.001))
+
+        print "%s lines: %d lines/s before, %d lines/s after (%.1fx)" % (
+            len(lines), rates[0], rates[1], rates[1] / max(rates[0], 1))
+
     ## FIXME:
     ## This is disabled so as to leave the test table behind - this is
     ## required for development so we can examine the table afterwards
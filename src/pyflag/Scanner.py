@@ -39,13 +39,14 @@ import pyflag.conf
 config=pyflag.conf.ConfObject()
 import pyflag.pyflaglog as pyflaglog
 import os,imp, StringIO
-import re
+import re, sys, time, threading, gc, resource
 import pyflag.Registry as Registry
 import pyflag.DB as DB
 import pyflag.FlagFramework as FlagFramework
 import fnmatch
 import ScannerUtils
 import pyflag.CacheManager as CacheManager
+import pyflag.format as format
 
 class BaseScanner:
     """ This is the actual scanner class that will be instanitated once for each file in the filesystem.
@@ -108,6 +109,28 @@ class BaseScanner:
         """
         pass
 
+    ## Scanners which are able to continue an interrupted scan of a
+    ## large file part way through (see scan_large_file) set this and
+    ## implement checkpoint() and resume():
+    resumable = False
+
+    def checkpoint(self):
+        """ Called periodically while scanning large files.
+
+        Resumable scanners must make sure that everything they found
+        so far is stored, since the scan may later be resumed from the
+        current position.
+        """
+
+    def resume(self, offset):
+        """ Called before scanning an interrupted large file.
+
+        The scan was checkpointed at offset. Returns the offset from
+        which the scanner wants to be given data - this may be before
+        offset (e.g. to re-establish a window).
+        """
+        return offset
+
     def finish(self):
         """ all data has been provided to process, finish up.
 
@@ -209,6 +232,13 @@ class MemoryScan(BaseScanner):
         self.window = buf[-self.windowsize:]
         self.offset -= len(self.window)
 
+    def resume(self, offset):
+        ## Start a window before the checkpoint so we find matches
+        ## which cross it:
+        self.offset = max(0, offset - self.windowsize)
+        self.window = ''
+        return self.offset
+
     def process_buffer(self,buf):
         """ This abstract method should implement the actual scanner.
 
@@ -379,83 +409,557 @@ class ScanIfType(StoreAndScanType):
         print "Scanned type %s" % self.fd.inode
         pass
 
+class StreamScanType(StoreAndScanType):
+    """ Just like StoreAndScanType but without storing a copy of the
+    file.
+
+    external_process() is given the file itself and should parse it
+    as a stream, keeping only a bounded window of it in memory. Files
+    found within it should be handed to scan_child() as they are
+    discovered.
+    """
+    def __init__(self, inode,ddfs,outer,factories=None,fd=None):
+        BaseScanner.__init__(self, inode,ddfs,outer,factories,fd=fd)
+        self.boring_status = True
+
+    def process(self, data,metadata=None):
+        if self.boring_status:
+            self.boring_status = self.boring(metadata, data=data)
+
+    def finish(self):
+        if not self.boring_status:
+            self.fd.seek(0)
+            self.external_process(self.fd)
+
+config.add_option("SCAN_MEMORY_BUDGET", default=0, type='int',
+                  help="Memory (in MB) a worker may use while expanding container files. "
+                  "Files found while over budget are queued to be scanned by a separate job (0 for no limit)")
+
+class MemoryBudget:
+    """ Keeps track of the memory used by this process while scanning
+    the contents of container files.
+    """
+    ## How many of the skipped inodes we remember for stats():
+    max_skipped = 20
+
+    def __init__(self):
+        self.peak = 0
+        self.skipped = 0
+        self.skipped_inodes = []
+
+    def usage(self):
+        """ Returns our resident size in bytes (or 0 if unknown) """
+        try:
+            fd = open("/proc/self/statm")
+            try:
+                return int(fd.read().split()[1]) * resource.getpagesize()
+            finally:
+                fd.close()
+        except (IOError, IndexError, ValueError):
+            return 0
+
+    def check(self):
+        """ Returns True if we are within the budget """
+        usage = self.usage()
+        self.peak = max(self.peak, usage)
+
+        budget = config.SCAN_MEMORY_BUDGET * 1024 * 1024
+        if not budget or usage <= budget:
+            return True
+
+        ## Maybe there is garbage we can release:
+        gc.collect()
+        return self.usage() <= budget
+
+    def skip(self, ddfs, fd, factories):
+        """ Queues a Scan job for a file we could not scan now """
+        self.skipped += 1
+        self.skipped_inodes.append(fd.inode)
+        del self.skipped_inodes[:-self.max_skipped]
+
+        pdbh = DB.DBO()
+        pdbh.insert('jobs',
+                    command = 'Scan',
+                    arg1 = ddfs.case,
+                    arg2 = fd.inode,
+                    arg3 = ",".join([ f.__class__.__name__ for f in factories ]),
+                    cookie = int(time.time()),
+                    cost = getattr(fd, 'size', 0) or 0,
+                    _fast = True,
+                    )
+
+    def stats(self):
+        return dict(usage = self.usage() / 1024 / 1024, peak = self.peak / 1024 / 1024,
+                    budget = config.SCAN_MEMORY_BUDGET, skipped = self.skipped,
+                    skipped_inodes = ",".join(self.skipped_inodes))
+
+MEMORY_BUDGET = MemoryBudget()
+
+def scan_child(ddfs, fd, factories):
+    """ Scans a file found inside another file. If we are over our
+    memory budget a Scan job is queued for it instead, so it is
+    scanned by its own job once the container is done.
+    """
+    if not MEMORY_BUDGET.check():
+        pyflaglog.log(pyflaglog.WARNING, "Using %(usage)s MB which is more than "
+                      "the scanner memory budget of %(budget)s MB" % MEMORY_BUDGET.stats() +
+                      " - queueing %s to be scanned later" % fd.inode)
+        MEMORY_BUDGET.skip(ddfs, fd, factories)
+        return
+
+    scanfile(ddfs, fd, factories)
+
 def resetfile(ddfs, inode,factories):
+    if not factories: return
+
+    ## Make sure no buffered completions resurrect the scanners:
+    SCANNER_CACHE.flush()
+
+    sql = "scanner_cache"
+    names = []
     for f in factories:
-        dbh=DB.DBO(ddfs.case)
         f.reset(inode)
-        dbh.execute("update inode set scanner_cache = REPLACE(scanner_cache,%r,'') where inode=%r",
-                                (f.__class__.__name__, inode))
+        sql = "REPLACE(%s,%%r,'')" % sql
+        names.append(f.__class__.__name__)
+
+    dbh=DB.DBO(ddfs.case)
+    dbh.execute("update inode set scanner_cache = %s where inode=%%r" % sql,
+                names + [inode,])
+
+config.add_option("SCANNER_CACHE_BATCH", default=100, type='int',
+                  help="Number of scanned inodes whose scanner_cache updates are buffered and written in bulk")
+
+class ScannerCache:
+    """ Keeps track of which scanners already ran on which inodes.
+
+    The scanner_cache column of the inode table records this. Rather
+    than a select and an update round trip per scanned file, the
+    column is prefetched in bulk for a whole batch of jobs (see
+    prefetch()), and the completions are buffered and written with
+    one update per distinct set of scanners (see flush()). The buffer
+    is written every config.SCANNER_CACHE_BATCH files, and by the Farm
+    whenever a worker runs out of jobs.
+    """
+    ## Prefetched entries which were never used (e.g. because the jobs
+    ## were stolen) are dropped once we have this many:
+    max_cached = 10000
 
-MESSAGE_COUNT = 0
-    
-### This is used to scan a file with all the requested scanner factories
-def scanfile(ddfs,fd,factories):
-    """ Given a file object and a list of factories, this function scans this file using the given factories
+    def __init__(self):
+        self.lock = threading.Lock()
+        ## (case, inode) -> (inode_id, scanner_cache)
+        self.cache = {}
+        ## (case, inode_id) -> [ scanner names ] not yet written
+        self.pending = {}
+
+    def prefetch(self, case, inodes):
+        """ Fetches the scanner_cache of all the inodes in one go """
+        inodes = [ i for i in inodes if (case, i) not in self.cache ]
+        dbh = DB.DBO(case)
+        for i in range(0, len(inodes), 500):
+            chunk = inodes[i:i+500]
+            dbh.execute("select inode, inode_id, scanner_cache from inode where inode in (%s)",
+                        ",".join([ DB.db_expand("%r", x) for x in chunk ]))
+            self.lock.acquire()
+            try:
+                if len(self.cache) > self.max_cached:
+                    self.cache = {}
+
+                for row in dbh:
+                    self.cache[(case, row['inode'])] = (row['inode_id'], row['scanner_cache'])
+            finally:
+                self.lock.release()
+
+    def get(self, case, inode):
+        """ Returns the inode_id of inode and the list of scanners
+        which already ran on it. inode_id is None if the inode does
+        not exist.
+        """
+        self.lock.acquire()
+        try:
+            try:
+                inode_id, scanner_cache = self.cache.pop((case, inode))
+            except KeyError:
+                inode_id = None
+        finally:
+            self.lock.release()
 
-    @arg ddfs: A filesystem object. This is sometimes used to add new files into the filesystem by the scanner
-    @arg fd: The file object of the file to scan
-    @arg factories: A list of scanner factories to use when scanning the file.
+        if inode_id is None:
+            dbh = DB.DBO(case)
+            dbh.execute("select inode_id, scanner_cache from inode where inode=%r limit 1", inode)
+            row = dbh.fetch()
+            if not row: return None, []
+
+            inode_id, scanner_cache = row['inode_id'], row['scanner_cache']
+
+        try:
+            scanners_run = scanner_cache.split(',')
+        except AttributeError:
+            scanners_run = []
+
+        return inode_id, scanners_run + self.pending.get((case, inode_id), [])
+
+    def done(self, case, inode_id, names):
+        """ Records that the scanners in names finished on inode_id """
+        self.lock.acquire()
+        try:
+            self.pending.setdefault((case, inode_id), []).extend(names)
+            count = len(self.pending)
+        finally:
+            self.lock.release()
+
+        if count >= config.SCANNER_CACHE_BATCH:
+            self.flush()
+
+    def flush(self):
+        """ Writes all buffered completions to the inode tables """
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = {}
+        finally:
+            self.lock.release()
+
+        ## Group the inodes by case and set of scanners:
+        groups = {}
+        for (case, inode_id), names in pending.items():
+            names = ",".join(names)
+            groups.setdefault((case, names), []).append(str(inode_id))
+
+        for (case, names), ids in groups.items():
+            try:
+                dbh = DB.DBO(case)
+                dbh.execute("update inode set scanner_cache = concat_ws(',',scanner_cache, %r) "
+                            "where inode_id in (%s)", (names, ",".join(ids)))
+            except DB.DBError, e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to update scanner cache: %s" % e)
+
+SCANNER_CACHE = ScannerCache()
+
+config.add_option("SCAN_PIPELINE", default=False, action='store_true',
+                  help="Run each scanner on its own thread, streaming the file through a bounded ring of buffers")
+
+config.add_option("SCAN_PIPELINE_MIN_SIZE", default=10*1024*1024, type='int',
+                  help="Only files larger than this are scanned with the scanner pipeline")
+
+config.add_option("SCAN_PIPELINE_RING", default=8, type='int',
+                  help="Number of buffers in the scanner pipeline ring")
+
+class ScanPipeline:
+    """ Scans a file with each scanner running on its own thread.
+
+    The calling thread reads the file and places the buffers into a
+    ring. Each scanner consumes the ring in turn: a scanner may only
+    process a buffer once the scanner before it (in factory order)
+    has processed it. This keeps the metadata dict semantics of the
+    serial scan (e.g. TypeScan sets the mime type before the
+    StoreAndScanType scanners look at the same buffer), while
+    different scanners work on different buffers at the same
+    time. The reader blocks when the ring is full so memory use is
+    bounded to ring size * buffer size.
+
+    A file is therefore scanned at the speed of the slowest scanner
+    rather than the sum of all of them - as long as scanners spend
+    their time in code which releases the GIL (hashing large
+    buffers, zlib, waiting on clamd etc). Note that the index trie
+    holds the GIL while it searches, so the index scanner does not
+    overlap with the Python scanners.
     """
-    stat = fd.stat()
-    if not stat: return
+    def __init__(self, fd, objs, metadata, buffsize, stats):
+        self.fd = fd
+        self.objs = objs
+        self.metadata = metadata
+        self.buffsize = buffsize
+        self.stats = stats
+        self.size = max(config.SCAN_PIPELINE_RING, 2)
+        self.ring = [None] * self.size
+        self.produced = 0
+        self.eof = False
+        self.positions = [0] * len(objs)
+        self.cond = threading.Condition()
+
+        ## Per scanner time spent processing and waiting for data
+        self.busy = [0] * len(objs)
+        self.waiting = [0] * len(objs)
+
+    def stage(self, i):
+        o = self.objs[i]
+        try:
+            while 1:
+                self.cond.acquire()
+                try:
+                    start = time.time()
+                    while 1:
+                        n = self.positions[i]
+                        if n < self.produced and (i==0 or n < self.positions[i-1]):
+                            break
 
-    buffsize = 1024 * 1024
-    # instantiate a scanner object from each of the factory. We only
-    #instantiate scanners from factories which have not been run on
-    #this inode previously. We find which factories were already run
-    #by checking the inode table.  Note that we still pass the full
-    #list of factories to the Scan class so that it may invoke all of
-    #the scanners on new files it discovers.
-    dbh = DB.DBO(ddfs.case)    
-    dbh.execute("select inode_id, scanner_cache from inode where inode=%r limit 1", fd.inode);
-    row=dbh.fetch()
+                        if self.eof and n >= self.produced:
+                            return
+
+                        self.cond.wait()
+
+                    self.waiting[i] += time.time() - start
+                    data = self.ring[n % self.size]
+                finally:
+                    self.cond.release()
+
+                if not o.ignore:
+                    start = time.time()
+                    try:
+                        self.stats.call(o, 'process', data, metadata=self.metadata)
+                    except Exception,e:
+                        pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) Error: %s" %(o,e))
+
+                    self.busy[i] += time.time() - start
+
+                self.cond.acquire()
+                self.positions[i] += 1
+                self.cond.notifyAll()
+                self.cond.release()
+        finally:
+            ## Make sure we never hold up the reader or the next
+            ## scanner - even if we die:
+            self.cond.acquire()
+            self.positions[i] = sys.maxint
+            self.cond.notifyAll()
+            self.cond.release()
+
+    def run(self):
+        threads = []
+        for i in range(len(self.objs)):
+            t = threading.Thread(target=self.stage, args=(i,))
+            t.start()
+            threads.append(t)
+
+        try:
+            while 1:
+                ## If none of the scanners are interested with this
+                ## file, we stop right here
+                if not [ o for o in self.objs if not o.ignore ]:
+                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "No interest for %s", self.fd.inode)
+                    break
+
+                try:
+                    data = self.fd.read(self.buffsize)
+                    if not data: break
+                except IOError,e:
+                    break
+
+                self.cond.acquire()
+                try:
+                    ## Wait for the slowest scanner to free a slot:
+                    while self.produced - min(self.positions) >= self.size:
+                        self.cond.wait()
+
+                    self.ring[self.produced % self.size] = data
+                    self.produced += 1
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+        finally:
+            self.cond.acquire()
+            self.eof = True
+            self.cond.notifyAll()
+            self.cond.release()
+
+            for t in threads:
+                t.join()
+
+        pyflaglog.log(pyflaglog.DEBUG, "Scanner pipeline for %s: %s" % (
+            self.fd.inode, ", ".join([ "%s %0.2fs busy %0.2fs waiting" % (
+            o.outer.__class__.__name__, self.busy[i], self.waiting[i])
+                                       for i,o in enumerate(self.objs) ])))
+
+config.add_option("SCANNER_STATS_PERIOD", default=60, type='int',
+                  help="Seconds between writing scanner statistics to the scanner_stats case table (0 disables scanner statistics)")
+
+## The columns of the scanner_stats table. Times are in milliseconds.
+STATISTICS_FIELDS = ['files', 'bytes', 'process_ms', 'process_cpu_ms',
+                     'slack_ms', 'slack_cpu_ms', 'finish_ms', 'finish_cpu_ms',
+                     'statements', 'rows_inserted']
+
+class FileStatistics:
+    """ Collects the cost of each scanner while scanning a single file.
+
+    Wall time and the DB statements and rows inserted (counted per
+    thread by DB.STATS) are accurate in both the serial and pipelined
+    modes. CPU time is measured with time.clock() which covers the
+    whole process, so it is only meaningful for serial scanning.
+
+    Files a scanner discovers are scanned from within its calls
+    (usually finish()). Their cost is counted for their own scanners
+    and subtracted from the call which found them, so each counter
+    is exclusive of nested files.
+    """
+    def __init__(self, objs):
+        self.counters = {}
+        for o in objs:
+            self.counters[o.outer.__class__.__name__] = dict.fromkeys(STATISTICS_FIELDS, 0)
+
+    def call(self, o, phase, *args, **kwargs):
+        """ Calls the phase method of scanner o and records what it cost """
+        method = getattr(o, phase)
+        if not config.SCANNER_STATS_PERIOD:
+            return method(*args, **kwargs)
+
+        counters = self.counters[o.outer.__class__.__name__]
+        nested = [0, 0, 0, 0]
+        stack = nesting_stack()
+        stack.append(nested)
+        start = current_cost()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stack.pop()
+            wall, cpu, statements, rows = [ x - y - n for x, y, n in
+                                            zip(current_cost(), start, nested) ]
+            counters[phase + "_ms"] += int(wall * 1000)
+            counters[phase + "_cpu_ms"] += int(cpu * 1000)
+            counters['statements'] += statements
+            counters['rows_inserted'] += rows
+            if phase == 'process':
+                counters['bytes'] += len(args[0])
+
+## The FileStatistics.call()s in progress in each thread. Each
+## holds the cost of the files scanned from within it.
+NESTING = threading.local()
+
+def nesting_stack():
     try:
-        scanners_run =row['scanner_cache'].split(',')
-    except:
-        ## This is not a valid inode, we skip it:
-        scanners_run = []
+        return NESTING.stack
+    except AttributeError:
+        NESTING.stack = []
+        return NESTING.stack
 
-    fd.inode_id = row['inode_id']
+def current_cost():
+    """ Returns wall time, cpu time, statements and rows so far """
+    return [ time.time(), time.clock(), DB.STATS.statements, DB.STATS.rows ]
 
-    objs = []
-    for c in factories:
-        if c.__class__.__name__ not in scanners_run:
-            objs.append(c.Scan(fd.inode,ddfs,c,factories=factories,fd=fd))
-    
-    if len(objs)==0: return
+class ScannerStatistics:
+    """ Aggregates FileStatistics per case, scanner and file type.
 
-    ## This dict stores metadata about the file which may be filled in
-    ## by some scanners in order to indicate some fact to other
-    ## scanners.
-    metadata = {}
+    The totals are written to the scanner_stats case table every
+    config.SCANNER_STATS_PERIOD seconds. Each worker adds its own rows
+    so the table must be summed to get the totals.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.last_flush = time.time()
 
-    messages = DB.expand("Scanning file %s%s (inode %s)",
-                         (stat['path'],stat['name'],stat['inode']))
-    global MESSAGE_COUNT
-    MESSAGE_COUNT += 1
-    if not MESSAGE_COUNT % 50:
-        pyflaglog.log(pyflaglog.DEBUG, messages)
-    else:
-        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, messages)
+    def add(self, case, stats, type):
+        if not config.SCANNER_STATS_PERIOD: return
 
-    while 1:
-        ## If the file is too fragmented, we skip it because it might take too long... NTFS is a shocking filesystem, with some files so fragmented that it takes a really long time to read them. In our experience these files are not important for scanning so we disable them here. Maybe this should be tunable?
+        self.lock.acquire()
+        try:
+            for scanner, counters in stats.counters.items():
+                key = (case, scanner, type or 'unknown')
+                try:
+                    totals = self.totals[key]
+                except KeyError:
+                    totals = self.totals[key] = dict.fromkeys(STATISTICS_FIELDS, 0)
+
+                for k,v in counters.items():
+                    totals[k] += v
+
+                totals['files'] += 1
+        finally:
+            self.lock.release()
+
+        if time.time() - self.last_flush > config.SCANNER_STATS_PERIOD:
+            self.flush()
+
+    def flush(self):
+        """ Writes the accumulated statistics to the case tables """
+        self.lock.acquire()
         try:
-            if len(fd.blocks)>1000 or fd.size>100000000:
-                return
+            totals = self.totals
+            self.totals = {}
+            self.last_flush = time.time()
+        finally:
+            self.lock.release()
+
+        cases = {}
+        for (case, scanner, type), counters in totals.items():
+            row = counters.copy()
+            row['scanner'] = scanner
+            row['type'] = type
+            cases.setdefault(case, []).append(row)
+
+        for case, rows in cases.items():
+            try:
+                dbh = DB.DBO(case)
+                check_case_table(dbh, 'scanner_stats')
+                dbh.mass_insert_start('scanner_stats', _fast=True)
+                for row in rows:
+                    dbh.mass_insert(**row)
+                dbh.mass_insert_commit()
+            except DB.DBError, e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to store scanner statistics for case %s: %s" % (case, e))
+
+SCANNER_STATISTICS = ScannerStatistics()
+
+def check_case_table(dbh, name):
+    """ Creates the case table name if it does not exist yet.
+
+    Cases created by older versions may be missing tables added
+    since.
+    """
+    try:
+        dbh.execute("select * from `%s` limit 1", name)
+    except DB.DBError:
+        for t in Registry.CASE_TABLES.classes:
+            if t.name == name:
+                t().create(dbh)
 
-            c=0
-            for i in fd.blocks:
-                c+=i[1]
+config.add_option("SCAN_MAX_FILE_SIZE", default=0, type='int',
+                  help="Files larger than this are not scanned (0 = no limit)")
 
-            ## If there are not enough blocks to do a reasonable chunk of the file, we skip them as well...
-            if c>0 and c*fd.block_size<fd.size:
-                pyflaglog.log(pyflaglog.WARNING, "Skipping inode %s because there are not enough blocks %s < %s", fd.inode,c*fd.block_size,fd.size)
-                return
+config.add_option("SCAN_MAX_FRAGMENTS", default=0, type='int',
+                  help="Files with more block runs than this are not scanned (0 = no limit)")
 
-        except AttributeError:
-            pass
+config.add_option("SCAN_LARGE_FILE_SIZE", default=100*1024*1024, type='int',
+                  help="Files larger than this are scanned with large coalesced reads and checkpoints")
 
+config.add_option("SCAN_READAHEAD", default=16*1024*1024, type='int',
+                  help="Size of the reads used to scan large files")
+
+config.add_option("SCAN_CHECKPOINT_BYTES", default=256*1024*1024, type='int',
+                  help="Large file scans are checkpointed every this many bytes (0 disables checkpoints)")
+
+def skip_file(fd):
+    """ Returns True if the file is not worth scanning """
+    ## Very large or very fragmented files used to be skipped
+    ## unconditionally. They are now scanned by scan_large_file()
+    ## unless the limits are set.
+    try:
+        if config.SCAN_MAX_FILE_SIZE and fd.size > config.SCAN_MAX_FILE_SIZE:
+            pyflaglog.log(pyflaglog.WARNING, "Skipping inode %s because it is larger than %s bytes",
+                          fd.inode, config.SCAN_MAX_FILE_SIZE)
+            return True
+
+        if config.SCAN_MAX_FRAGMENTS and len(fd.blocks) > config.SCAN_MAX_FRAGMENTS:
+            pyflaglog.log(pyflaglog.WARNING, "Skipping inode %s because it has more than %s fragments",
+                          fd.inode, config.SCAN_MAX_FRAGMENTS)
+            return True
+
+        c=0
+        for i in fd.blocks:
+            c+=i[1]
+
+        ## If there are not enough blocks to do a reasonable chunk of the file, we skip them as well...
+        if c>0 and c*fd.block_size<fd.size:
+            pyflaglog.log(pyflaglog.WARNING, "Skipping inode %s because there are not enough blocks %s < %s", fd.inode,c*fd.block_size,fd.size)
+            return True
+
+    except AttributeError:
+        pass
+
+    return False
+
+def scan_serially(fd, objs, metadata, buffsize, stats):
+    """ Feeds the file to each scanner in turn """
+    while 1:
         try:
             data = fd.read(buffsize)
             if not data: break
@@ -480,7 +984,7 @@ def scanfile(ddfs,fd,factories):
                 if not o.ignore:
                     interest+=1
                     pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Processing with %s", o)
-                    o.process(data,metadata=metadata)
+                    stats.call(o, 'process', data, metadata=metadata)
 
             except Exception,e:
                 pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) Error: %s" %(o,e))
@@ -491,6 +995,232 @@ def scanfile(ddfs,fd,factories):
             pyflaglog.log(pyflaglog.DEBUG, "No interest for %s", fd.inode)
             break
 
+def block_runs(fd):
+    """ Returns the runs of fd in the image as a list of (image
+    offset, length) in file order, with physically contiguous runs
+    merged. Returns None if fd can not be read directly from its
+    image (e.g. it has no block list, or its data is compressed or
+    resident).
+    """
+    try:
+        image = fd.fd
+        block_size = getattr(fd, 'block_size', None) or image.block_size
+    except AttributeError:
+        return None
+
+    if not block_size or not fd.size: return None
+
+    dbh = DB.DBO(fd.case)
+    dbh.check_index("block", "inode")
+    dbh.execute("select block, count from block where inode=%r order by `index`", fd.inode)
+    runs = []
+    total = 0
+    for row in dbh:
+        offset = row['block'] * block_size
+        length = row['count'] * block_size
+        total += length
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1][1] += length
+        else:
+            runs.append([offset, length])
+
+    ## The block list must cover the whole file:
+    if total < fd.size: return None
+
+    return runs
+
+def read_large_file(fd, start, runs=None):
+    """ A generator of the data of fd from offset start in reads of
+    config.SCAN_READAHEAD bytes.
+
+    If runs (see block_runs()) are given, the data is read straight
+    from the image, and reads never straddle a discontinuity. This
+    avoids the per read block lookups of the file drivers.
+    """
+    readahead = max(config.SCAN_READAHEAD, 1024 * 1024)
+    if not runs:
+        fd.seek(start)
+        while 1:
+            data = fd.read(readahead)
+            if not data: break
+            yield data
+
+        return
+
+    image = fd.fd
+    position = 0
+    for offset, length in runs:
+        if position >= fd.size: break
+
+        length = min(length, fd.size - position)
+        if position + length <= start:
+            position += length
+            continue
+
+        skip = max(0, start - position)
+        position += skip
+        offset += skip
+        length -= skip
+        while length > 0:
+            image.seek(offset)
+            data = image.read(min(readahead, length))
+            if not data: return
+
+            offset += len(data)
+            length -= len(data)
+            position += len(data)
+            yield data
+
+def scan_large_file(fd, objs, metadata, stats):
+    """ Scans a large file in large coalesced reads.
+
+    Progress is recorded in the scan_checkpoint case table every
+    config.SCAN_CHECKPOINT_BYTES. If the scan of this inode is
+    interrupted (e.g. the worker dies and the job is requeued),
+    resumable scanners pick up from the last checkpoint. The other
+    scanners still see the whole file.
+    """
+    dbh = DB.DBO(fd.case)
+    check_case_table(dbh, 'scan_checkpoint')
+    dbh.execute("select scanners, offset from scan_checkpoint where inode_id=%r", fd.inode_id)
+    row = dbh.fetch()
+
+    ## The offset each scanner wants its data from:
+    starts = [0] * len(objs)
+    if row:
+        resumed = row['scanners'].split(',')
+        for i in range(len(objs)):
+            o = objs[i]
+            if o.resumable and o.outer.__class__.__name__ in resumed:
+                starts[i] = o.resume(row['offset'])
+
+        pyflaglog.log(pyflaglog.INFO, "Resuming scan of inode %s from offset %s",
+                      fd.inode, row['offset'])
+
+    runs = block_runs(fd)
+    start = min(starts)
+    position = start
+    last_checkpoint = position
+    started = time.time()
+
+    try:
+        for data in read_large_file(fd, start, runs):
+            if not [ o for o in objs if not o.ignore ]:
+                pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "No interest for %s", fd.inode)
+                break
+
+            for i in range(len(objs)):
+                o = objs[i]
+                if o.ignore or position + len(data) <= starts[i]: continue
+
+                try:
+                    stats.call(o, 'process', data[max(0, starts[i] - position):],
+                               metadata=metadata)
+                except Exception,e:
+                    pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) Error: %s" %(o,e))
+
+            position += len(data)
+
+            if config.SCAN_CHECKPOINT_BYTES and \
+                   position - last_checkpoint >= config.SCAN_CHECKPOINT_BYTES:
+                names = []
+                for o in objs:
+                    if o.resumable and not o.ignore:
+                        o.checkpoint()
+                        names.append(o.outer.__class__.__name__)
+
+                if names:
+                    dbh.execute("replace into scan_checkpoint set inode_id=%r, scanners=%r, offset=%r",
+                                (fd.inode_id, ",".join(names), position))
+
+                last_checkpoint = position
+                pyflaglog.log(pyflaglog.DEBUG, "Scanned %s of %s bytes of inode %s (%0.1f Mb/s)" % (
+                    position, fd.size, fd.inode,
+                    (position - start) / (time.time() - started + 0.001) / 1024 / 1024))
+    except IOError, e:
+        pyflaglog.log(pyflaglog.WARNING, "Error reading inode %s: %s" % (fd.inode, e))
+
+    ## Leave the file pointer where the scan ended, just like a serial
+    ## scan would:
+    fd.seek(min(position, fd.size))
+    dbh.execute("delete from scan_checkpoint where inode_id=%r", fd.inode_id)
+
+MESSAGE_COUNT = 0
+    
+### This is used to scan a file with all the requested scanner factories
+def scanfile(ddfs,fd,factories):
+    """ Given a file object and a list of factories, this function scans this file using the given factories
+
+    @arg ddfs: A filesystem object. This is sometimes used to add new files into the filesystem by the scanner
+    @arg fd: The file object of the file to scan
+    @arg factories: A list of scanner factories to use when scanning the file.
+    """
+    stack = nesting_stack()
+    if not stack or not config.SCANNER_STATS_PERIOD:
+        return _scanfile(ddfs, fd, factories)
+
+    ## We are scanning a file found by another scanner - our cost is
+    ## not part of its cost:
+    start = current_cost()
+    try:
+        return _scanfile(ddfs, fd, factories)
+    finally:
+        nested = stack[-1]
+        for i, x in enumerate(current_cost()):
+            nested[i] += x - start[i]
+
+def _scanfile(ddfs,fd,factories):
+    stat = fd.stat()
+    if not stat: return
+
+    buffsize = 1024 * 1024
+    # instantiate a scanner object from each of the factory. We only
+    #instantiate scanners from factories which have not been run on
+    #this inode previously. We find which factories were already run
+    #by checking the inode table.  Note that we still pass the full
+    #list of factories to the Scan class so that it may invoke all of
+    #the scanners on new files it discovers.
+    inode_id, scanners_run = SCANNER_CACHE.get(ddfs.case, fd.inode)
+
+    ## This is not a valid inode, we skip it:
+    if inode_id is None: return
+
+    fd.inode_id = inode_id
+
+    objs = []
+    for c in factories:
+        if c.__class__.__name__ not in scanners_run:
+            objs.append(c.Scan(fd.inode,ddfs,c,factories=factories,fd=fd))
+    
+    if len(objs)==0: return
+
+    ## This dict stores metadata about the file which may be filled in
+    ## by some scanners in order to indicate some fact to other
+    ## scanners.
+    metadata = {}
+
+    messages = DB.expand("Scanning file %s%s (inode %s)",
+                         (stat['path'],stat['name'],stat['inode']))
+    global MESSAGE_COUNT
+    MESSAGE_COUNT += 1
+    if not MESSAGE_COUNT % 50:
+        pyflaglog.log(pyflaglog.DEBUG, messages)
+    else:
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, messages)
+
+    if skip_file(fd): return
+
+    stats = FileStatistics(objs)
+
+    if config.SCAN_LARGE_FILE_SIZE and fd.size > config.SCAN_LARGE_FILE_SIZE:
+        scan_large_file(fd, objs, metadata, stats)
+
+    elif config.SCAN_PIPELINE and len(objs) > 1 and \
+           fd.size > config.SCAN_PIPELINE_MIN_SIZE:
+        ScanPipeline(fd, objs, metadata, buffsize, stats).run()
+        
+    else: scan_serially(fd, objs, metadata, buffsize, stats)
+
     # call slack method of each object. fd.slack must be reset after the call
     # because the scanners actually have a copy of fd and some of them actually
     # use it and get confused if it returns slack. Also pass overread.
@@ -502,23 +1232,22 @@ def scanfile(ddfs,fd,factories):
     if data:
         for o in objs:
             try:
-                o.slack(data, metadata=metadata)
+                stats.call(o, 'slack', data, metadata=metadata)
             except Exception,e:
                 pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) Error: %s" %(o,e))
 
     # call finish method of each object
     for o in objs:
         try:
-            o.finish()
+            stats.call(o, 'finish')
         except Exception,e:
             pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) on Inode %s Error: %s" %(o,fd.inode,e))
 
     # Store the fact that we finished in the inode table:
-    scanner_names = ','.join([ c.outer.__class__.__name__ for c in objs ])
-    try:
-        dbh.execute("update inode set scanner_cache = concat_ws(',',scanner_cache, %r) where inode=%r", (scanner_names, fd.inode))
-    except DB.DBError:
-        pass
+    SCANNER_CACHE.done(ddfs.case, inode_id,
+                       [ c.outer.__class__.__name__ for c in objs ])
+
+    SCANNER_STATISTICS.add(ddfs.case, stats, metadata.get('mime'))
 
 class Drawer:
     """ This class is responsible for rendering scanners of similar classes.
@@ -702,8 +1431,35 @@ class Carver:
                         fd, factories)
         return length
 
+    def add_runs(self, fd, runs, name, factories):
+        """ Adds a VFS Inode for a fragmented file made up of runs
+        (offset, length) within fd, e.g. as given by the
+        image_runs() of a carver's Reassembler.
+
+        Returns the length of the new file.
+        """
+        run_map = format.RunMap(fd)
+        length = 0
+        for offset, run_length in runs:
+            run_map.add_run(length, offset, run_length)
+            length += run_length
+
+        if len(run_map.starts) == 1:
+            new_inode = "%s|o%s:%s" % (fd.inode, run_map.offsets[0], length)
+        else:
+            ## The runs would soon overflow the inode column, so the
+            ## binary run map goes into the runs table (see RunFile):
+            data = StringIO.StringIO()
+            run_map.save(data)
+            dbh = DB.DBO(self.fsfd.case)
+            dbh.execute("insert into runs set runs=%b", data.getvalue())
+            new_inode = "%s|R%s" % (fd.inode, dbh.autoincrement())
+
+        self._add_inode(new_inode, length, name, fd, factories)
+        return length
+
     def _add_inode(self, new_inode, length, name, fd, factories):
-        pathname = self.fsfd.lookup(inode = fd.inode)
+        pathname, inode, inode_id = self.fsfd.lookup(inode = fd.inode)
         ## By default we just add a VFS Inode for it.
         self.fsfd.VFSCreate(None,
                             new_inode,
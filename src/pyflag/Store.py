@@ -17,7 +17,16 @@ the store at any one time.
 import thread,time,re
 import pyflag.pyflaglog as pyflaglog
 
-class Store:
+## The fields of the nodes in the Store's list:
+PREV, NEXT, KEY, TIME, OBJECT, SIZE = range(6)
+
+def debug(message, key, object):
+    ## Formatting the object is expensive so only do it when needed:
+    if pyflaglog.config.LOG_LEVEL >= pyflaglog.VERBOSE_DEBUG:
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
+                      "%s %s: %s" % (message, key, ("%r" % (object,))[:100]))
+
+class Store(object):
     """ Stores objects for a length of time.
 
     Objects may expire due to their age, or the maximum size of the
@@ -27,126 +36,177 @@ class Store:
     deletion of objects from the store will not cause their
     destruction. Therefore, objects may only exist in the store or out
     of store (in the client) - never in both places.
+
+    Objects are kept in a doubly linked list in least recently used
+    first order, and indexed by key in a dict - so getting, putting
+    and refreshing objects takes constant time. Since the oldest
+    objects are always at the head of the list, expiring them by age
+    does not need to look at any others.
     """
-    def __init__(self, max_size=300, age=1800):
+    def __init__(self, max_size=300, age=1800, max_bytes=None):
         """ max_size is the maximum number of objects in the store, age is their maximum age.
+
+        If max_bytes is given we also expire objects once the sizes
+        given to put() add up to more than max_bytes.
         """
         self.max_size = max_size
         self.max_age = age
+        self.max_bytes = max_bytes
         self.mutex = thread.allocate_lock()
-
-        ## creation_times is an array of (time, key, object). The time
-        ## is ordered in oldest first and newest last time order.
-        self.creation_times = []
         self.id = 0
 
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flush()
+
     def flush(self):
         self.mutex.acquire()
-        self.creation_times = []
-        self.mutex.release()
+        try:
+            ## The list is circular around this sentinel:
+            self.head = []
+            self.head[:] = [self.head, self.head, None, 0, None, 0]
+            self.index = {}
+            self.bytes = 0
+        finally:
+            self.mutex.release()
 
     def size(self):
-        return len(self.creation_times)
-        
-    def put(self,object, prefix='', key=None):
+        return len(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def unlink(self, node):
+        """ Removes node from the list and the index """
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+        del self.index[node[KEY]]
+        self.bytes -= node[SIZE]
+
+    def link(self, node):
+        """ Adds node to the end of the list (the most recent) """
+        last = self.head[PREV]
+        node[PREV] = last
+        node[NEXT] = self.head
+        last[NEXT] = node
+        self.head[PREV] = node
+        self.index[node[KEY]] = node
+        self.bytes += node[SIZE]
+
+    def put(self,object, prefix='', key=None, size=0):
         """ Stores an object in the Store.  Returns the key for the
-        object. If key is already supplied we use that instead - Note
-        that we do not check that it doesnt already exist.
+        object. If key is already supplied we use that instead - an
+        object already stored under the key is replaced.
+
+        size is the size of the object for the purpose of max_bytes.
         """
         self.mutex.acquire()
         try:
-
-            ## Ensure that we have enough space:
-            self.check_full()
-
             ## Push the item in:
-            now = time.time()
             if not key:
                 key = "%s%s" % (prefix,self.id)
+
+            try:
+                self.unlink(self.index[key])
+            except KeyError:
+                pass
                 
-            self.creation_times.append([now,key, object])
+            self.link([None, None, key, time.time(), object, size])
             self.id+=1
 
+            ## Ensure that we have enough space:
+            self.check_full()
         finally:
             self.mutex.release()
 
-        pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
-                      "Stored key %s: %s" % (key,
-                                             ("%r" % (object,))[:100]))
+        debug("Stored key", key, object)
         return key
 
     def get(self, key, remove=False):
         """ Retrieve the key from the store.
         If remove is specified we remove it from the Store altogether.
         """
-        ## FIXME: This is slow for large stores... use a dict for
-        ## quick reference:
         self.mutex.acquire()
-
         try:
-            ## Find and remove the object from the store
-            i=0
-            for t, k, obj in self.creation_times:
-                if k==key:
-                    ## Remove the object from the store:
-                    t, k, obj = self.creation_times.pop(i)
-
-                    ## Reinsert it into the cache at the most recent
-                    ## time:
-                    if not remove:
-                        self.creation_times.append([time.time(), k, obj])
-                    
-                    self.check_full()
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
-                                  "Got key %s: %s" % (key,
-                                                      ("%r" % (obj,))[:100]))
-                    return obj
-                i+=1
-
-            ## If we are here we could not find the key:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Key %s not found" % (key,))
-            raise KeyError("Key not found %s" % (key,))
-
+            ## Old objects must not be returned:
+            self.check_full()
+            try:
+                node = self.index[key]
+            except KeyError:
+                ## If we are here we could not find the key:
+                self.misses += 1
+                debug("Key not found", key, None)
+                raise KeyError("Key not found %s" % (key,))
+
+            self.hits += 1
+            self.unlink(node)
+
+            ## Reinsert it into the cache at the most recent
+            ## time:
+            if not remove:
+                node[TIME] = time.time()
+                self.link(node)
         finally:
             self.mutex.release()
-        
+
+        debug("Got key", key, node[OBJECT])
+        return node[OBJECT]
+
     def check_full(self):
         """ Checks to ensure the Store is not full """
         ## Check to see if we store too many objects - remove oldest
         ## objects first:
-        while len(self.creation_times)>self.max_size:
-            t, key, o = self.creation_times.pop(0)
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Removed object %r because store is full" % (o,))
+        while len(self.index) > self.max_size or \
+                  (self.max_bytes is not None and self.bytes > self.max_bytes \
+                   and self.index):
+            node = self.head[NEXT]
+            self.unlink(node)
+            self.evictions += 1
+            debug("Removed because store is full", node[KEY], node[OBJECT])
 
         ## Now ensure that objects are not too old:
-        now = time.time()
-        try:
-            while 1:
-                t,key,o = self.creation_times[0]
-                if t+self.max_age < now:
-                    self.creation_times.pop(0)
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Removed object %r because it is too old" % (o,))
-                else:
-                    break
-        except IndexError:
-            pass
+        too_old = time.time() - self.max_age
+        while self.index and self.head[NEXT][TIME] < too_old:
+            node = self.head[NEXT]
+            self.unlink(node)
+            self.evictions += 1
+            debug("Removed because it is too old", node[KEY], node[OBJECT])
 
     def expire(self, regex):
         """ Automatially expire all objects with keys matching the regex """
         self.mutex.acquire()
 
         try:
-            tmp = []
-            for x in self.creation_times:
-                if not re.search(regex, x[1]):
-                    tmp.append(x)
-            self.creation_times = tmp
+            for node in self.nodes():
+                if re.search(regex, node[KEY]):
+                    self.unlink(node)
         finally:
             self.mutex.release()
 
+    def nodes(self):
+        """ Returns a list of our nodes, oldest first """
+        result = []
+        node = self.head[NEXT]
+        while node is not self.head:
+            result.append(node)
+            node = node[NEXT]
+
+        return result
+
+    def creation_times(self):
+        """ A list of [time, key, object], oldest first """
+        return [ [node[TIME], node[KEY], node[OBJECT]] for node in self.nodes() ]
+
+    creation_times = property(creation_times)
+
+    def stats(self):
+        return dict(objects = len(self.index), bytes = self.bytes, hits = self.hits,
+                    misses = self.misses, evictions = self.evictions)
+
     def __iter__(self):
-        for t, k, obj in self.creation_times:
-            yield obj
+        for node in self.nodes():
+            yield node[OBJECT]
 
 ## Store unit tests:
 import unittest
@@ -191,3 +251,27 @@ class StoreTests(unittest.TestCase):
         s.expire("test\d+")
         ## Should have 5 "testsxxx" left
         self.assertEqual(len(s.creation_times),5)
+
+    def test04ByteBudget(self):
+        """ Tests that objects are expired when the byte budget is exceeded """
+        s = Store(max_size = 100, max_bytes = 100)
+        for i in range(0,10):
+            s.put("x" * 30, key="test%s" % i, size=30)
+
+        self.assertEqual(s.size(), 3)
+        self.assertEqual(s.bytes, 90)
+        self.assertRaises(KeyError, lambda : s.get("test0"))
+        s.get("test9")
+
+        ## Replacing an object does not count it twice:
+        s.put("x" * 30, key="test9", size=30)
+        self.assertEqual(s.bytes, 90)
+
+    def test05Age(self):
+        """ Tests that objects expire by age """
+        s = Store(age = 0.5)
+        s.put(1, key="old")
+        time.sleep(1)
+        s.put(2, key="new")
+        self.assertRaises(KeyError, lambda : s.get("old"))
+        self.assertEqual(s.get("new"), 2)
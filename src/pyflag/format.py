@@ -30,7 +30,7 @@
 
 This is most useful when reading data structure with a fixed format (structs, arrays etc).
 """
-import struct,time,cStringIO
+import struct,time,cStringIO,bisect
 
 ## This is the default size that will be read when not specified
 DEFAULT_SIZE=600*1024*1024
@@ -115,6 +115,119 @@ class Buffer:
         data = self.__str__()
         return data.find(bytes)
         
+class RunMap:
+    """ A file like object made up of runs of another file.
+
+    Each run maps a range of offsets in this file to a range of
+    offsets in fd. Runs are kept sorted by file offset so we can find
+    the run for any offset by bisection. Runs which follow on from
+    each other in fd are merged, so a read only issues one read on fd
+    for each discontinuity it crosses.
+    """
+    magic = "PFRUNS01"
+
+    def __init__(self, fd, runs=()):
+        self.fd = fd
+        self.readptr = 0
+        ## The file offset, fd offset and length of each run:
+        self.starts = []
+        self.offsets = []
+        self.lengths = []
+        for file_offset, offset, length in runs:
+            self.add_run(file_offset, offset, length)
+
+    def add_run(self, file_offset, offset, length):
+        """ Adds a run at the end of the file """
+        if self.starts:
+            end = self.starts[-1] + self.lengths[-1]
+            if file_offset < end:
+                raise ValueError("Run at %s overlaps the previous run" % file_offset)
+
+            ## Merge runs which are contiguous in both files:
+            if file_offset == end and offset == self.offsets[-1] + self.lengths[-1]:
+                self.lengths[-1] += length
+                return
+
+        self.starts.append(file_offset)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def runs(self):
+        return zip(self.starts, self.offsets, self.lengths)
+
+    def size(self):
+        if not self.starts: return 0
+        return self.starts[-1] + self.lengths[-1]
+
+    def translate(self, file_offset):
+        """ Returns the fd offset for file_offset and how many bytes
+        we can read from there, or (None, length) if file_offset is in
+        a gap between runs.
+        """
+        i = bisect.bisect_right(self.starts, file_offset) - 1
+        if i < 0:
+            if not self.starts: return None, 0
+            return None, self.starts[0] - file_offset
+
+        available = self.starts[i] + self.lengths[i] - file_offset
+        if available <= 0:
+            try:
+                return None, self.starts[i+1] - file_offset
+            except IndexError:
+                return None, 0
+
+        return self.offsets[i] + file_offset - self.starts[i], available
+
+    def seek(self, offset, whence=0):
+        if whence==0:
+            self.readptr = offset
+        elif whence==1:
+            self.readptr += offset
+        elif whence==2:
+            self.readptr = self.size() + offset
+
+    def tell(self):
+        return self.readptr
+
+    def read(self, length=None):
+        if length is None:
+            length = self.size() - self.readptr
+
+        result = []
+        while length > 0:
+            offset, available = self.translate(self.readptr)
+            if not available: break
+
+            available = min(available, length)
+            if offset is None:
+                ## Gaps read as zeros:
+                data = "\x00" * available
+            else:
+                self.fd.seek(offset)
+                data = self.fd.read(available)
+                if not data: break
+
+            result.append(data)
+            self.readptr += len(data)
+            length -= len(data)
+
+        return ''.join(result)
+
+    def save(self, fd):
+        """ Writes the runs to fd in binary """
+        fd.write(self.magic + struct.pack("<q", len(self.starts)))
+        for run in self.runs():
+            fd.write(struct.pack("<qqq", *run))
+
+    def load(self, fd):
+        """ Loads runs written by save() from fd """
+        if fd.read(len(self.magic)) != self.magic:
+            raise IOError("Not a run map")
+
+        count = struct.unpack("<q", fd.read(8))[0]
+        for i in range(count):
+            self.add_run(*struct.unpack("<qqq", fd.read(24)))
+
 #### Start of data definitions:
 class DataType:
     """ Base class that reads a data type from the file."""